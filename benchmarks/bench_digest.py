@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Throughput of the v2/v3 chunked content digest with 1..N digest workers.
+#
+#   python benchmarks/bench_digest.py --size 2G
+#   python benchmarks/bench_digest.py --apk big-game.apk --workers 1 2 4 8 16 32
+
+import os
+import sys
+import mmap
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from keysigner.native_signer import ApkSections, compute_content_digest
+from synthetic_apk import make_synthetic_apk, parse_size
+
+def default_workers():
+    counts, count = [], 1
+    while count < (os.cpu_count() or 1):
+        counts.append(count)
+        count *= 2
+    return counts + [os.cpu_count() or 1]
+
+def run(apk_path, worker_counts, hash_name, repeat):
+    size = os.path.getsize(apk_path)
+    print(f"{apk_path}: {size / 1048576:.0f} MiB, {os.cpu_count()} CPUs, {hash_name}")
+    with open(apk_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as apk_map:
+        data = memoryview(apk_map)
+        sections = ApkSections(data).digest_sections(data)
+        compute_content_digest(sections, hash_name, 1)  # warm the page cache
+        baseline = None
+        reference = None
+        for workers in worker_counts:
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                digest = compute_content_digest(sections, hash_name, workers)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            if reference is None:
+                reference = digest
+            elif digest != reference:
+                raise RuntimeError(f"Digest mismatch with {workers} workers")
+            baseline = baseline or best
+            print(f"  workers {workers:>3}: {size / 1048576 / best:9.1f} MiB/s   {best:7.2f} s   speedup {baseline / best:5.2f}x")
+        del sections
+        data.release()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark parallel chunk digesting.")
+    parser.add_argument('--apk', help="Existing APK to digest (default: generate a synthetic APK)")
+    parser.add_argument('--size', default='2G', help="Size of the synthetic APK")
+    parser.add_argument('--workers', type=int, nargs='+', default=default_workers())
+    parser.add_argument('--hash', default='sha256', choices=['sha256', 'sha512'])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.apk:
+        run(args.apk, args.workers, args.hash, args.repeat)
+        return
+    with tempfile.TemporaryDirectory() as work_dir:
+        apk_path = make_synthetic_apk(os.path.join(work_dir, 'synthetic.apk'), parse_size(args.size), entries=256)
+        run(apk_path, args.workers, args.hash, args.repeat)
+
+if __name__ == '__main__':
+    main()
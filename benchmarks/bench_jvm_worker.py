@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Per-operation latency of one JVM per keytool/apksigner call versus the resident JVM worker.
+#
+#   python benchmarks/bench_jvm_worker.py --runs 20
+#   python benchmarks/bench_jvm_worker.py --runs 20 --apk app-unsigned.apk
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from keysigner.jvm_worker import enable_jvm_worker, disable_jvm_worker, run_tool
+
+def measure(label, cmds, run):
+    timings = []
+    for cmd in cmds:
+        start = time.perf_counter()
+        result = run(cmd)
+        timings.append((time.perf_counter() - start) * 1000)
+        if result.returncode != 0:
+            raise RuntimeError(f"{label} failed: {result.stderr or result.stdout}")
+    timings.sort()
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    print(f"{label:<32} mean {statistics.mean(timings):8.1f} ms   p50 {statistics.median(timings):8.1f} ms   p95 {p95:8.1f} ms")
+    return statistics.mean(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description="JVM startup versus resident worker latency.")
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--apk', help="Unsigned APK to benchmark apksigner with (optional)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        keystore = os.path.join(work_dir, 'bench.p12')
+        subprocess.run([
+            'keytool', '-genkeypair', '-keyalg', 'RSA', '-keysize', '2048',
+            '-storetype', 'PKCS12', '-keystore', keystore, '-storepass', 'benchmark',
+            '-keypass', 'benchmark', '-alias', 'bench', '-dname', 'CN=Benchmark', '-validity', '365'
+        ], check=True, capture_output=True)
+
+        benchmarks = [('keytool -list', [['keytool', '-list', '-v', '-keystore', keystore, '-storetype', 'PKCS12', '-storepass', 'benchmark']] * args.runs)]
+        if args.apk:
+            sign_cmds = []
+            for i in range(args.runs):
+                sign_cmds.append([
+                    'apksigner', 'sign', '--ks', keystore, '--ks-pass', 'pass:benchmark', '--ks-key-alias', 'bench',
+                    '--out', os.path.join(work_dir, f'signed_{i}.apk'), args.apk
+                ])
+            benchmarks.append(('apksigner sign', sign_cmds))
+
+        for name, cmds in benchmarks:
+            print(f"\n{name} ({args.runs} runs)")
+            cold = measure('  subprocess (new JVM each)', cmds, lambda cmd: subprocess.run(cmd, capture_output=True, text=True))
+
+            pool = enable_jvm_worker(1)
+            start = time.perf_counter()
+            warmup = run_tool(cmds[0], capture_output=True)
+            if pool.unavailable:
+                print("  resident worker unavailable (needs java and javac or JDK 11+ source launcher)")
+                disable_jvm_worker()
+                continue
+            print(f"  {'worker startup + first call':<30} {(time.perf_counter() - start) * 1000:8.1f} ms (returncode {warmup.returncode})")
+            warm = measure('  resident JVM worker', cmds, lambda cmd: run_tool(cmd, capture_output=True))
+            disable_jvm_worker()
+            print(f"  speedup: {cold / warm:.1f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Per-keystore latency of `keytool -list -v` versus the in-process keystore reader.
+#
+#   python benchmarks/bench_keystore_info.py --runs 10
+#   python benchmarks/bench_keystore_info.py --runs 10 --ks-pass secret release.jks upload.p12
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from keysigner.keystore_info import KeystoreInfo
+
+def measure(label, runs, call):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        call()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    print(f"  {label:<10} mean {statistics.mean(timings):8.1f} ms   p50 {statistics.median(timings):8.1f} ms   p95 {p95:8.1f} ms")
+    return statistics.mean(timings)
+
+def generate_keystores(work_dir, password):
+    keystores = []
+    for store_type, key_alg, key_size in [('JKS', 'RSA', '2048'), ('PKCS12', 'RSA', '2048'), ('PKCS12', 'EC', '256')]:
+        path = os.path.join(work_dir, f"bench_{key_alg.lower()}.{'jks' if store_type == 'JKS' else 'p12'}")
+        subprocess.run([
+            'keytool', '-genkeypair', '-keyalg', key_alg, '-keysize', key_size,
+            '-storetype', store_type, '-keystore', path, '-storepass', password,
+            '-keypass', password, '-alias', 'bench', '-dname', 'CN=Benchmark', '-validity', '365'
+        ], check=True, capture_output=True)
+        keystores.append(path)
+    return keystores
+
+def main():
+    parser = argparse.ArgumentParser(description="keytool versus in-process keystore reading.")
+    parser.add_argument('keystores', nargs='*', help="Keystores to read (default: generate JKS and PKCS12 keystores with keytool)")
+    parser.add_argument('--ks-pass', default='benchmark', help="Password of the given keystores")
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        keystores = args.keystores or generate_keystores(work_dir, args.ks_pass)
+        info = KeystoreInfo()
+        for path in keystores:
+            info.keystore_path = path
+            info.store_pass = args.ks_pass
+            info.keystore_type = info.read(path, args.ks_pass).store_type
+            cmd = info.keytool_command()
+            print(f"\n{os.path.basename(path)} ({info.keystore_type}, {args.runs} runs)")
+            keytool = measure('keytool', args.runs, lambda: subprocess.run(cmd, check=True, capture_output=True))
+            native = measure('native', args.runs, lambda: info.read(path, args.ks_pass).to_dict())
+            print(f"  speedup: {keytool / native:.1f}x")
+
+if __name__ == '__main__':
+    main()
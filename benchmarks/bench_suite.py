@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# keysigner's own overhead for every operation, without the Android SDK or a JDK. Tool backends run the
+# stand-ins in benchmarks/fake_tools, which sleep for --latency instead of working; native backends run
+# in-process on keystores and synthetic APKs generated up front. Every scenario runs in a fresh process,
+# so its peak RSS is its own.
+#
+#   python benchmarks/bench_suite.py --json results-4.0.json
+#   python benchmarks/bench_suite.py --only sign info --latency 50 --compare results-4.0.json
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+from synthetic_apk import make_synthetic_apk, parse_size
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+FAKE_TOOLS = os.path.join(BENCH_DIR, 'fake_tools')
+PASSWORD = 'benchmark'
+OPERATIONS = ['generate', 'migrate', 'pkcs12-pem', 'info', 'sign']
+BACKENDS = {
+    'generate': ['keytool', 'native'],
+    'migrate': ['keytool'],
+    'pkcs12-pem': ['openssl', 'native'],
+    'info': ['keytool', 'native'],
+    'sign': ['apksigner', 'native'],
+}
+NATIVE_BACKENDS = ['native']
+
+def scenario_names(operations=None):
+    names = []
+    for operation in operations or OPERATIONS:
+        for backend in BACKENDS[operation]:
+            for mode in ['single', 'batch']:
+                names.append(f"{operation}/{backend}/{mode}")
+    return names
+
+def percentile(timings, fraction):
+    ordered = sorted(timings)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def peak_rss_mb(who):
+    if resource is None:
+        return None
+    peak = resource.getrusage(who).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1048576 if sys.platform == 'darwin' else 1024), 1)
+
+class Fixtures:
+    def __init__(self, work_dir, args):
+        self.work_dir = work_dir
+        self.args = args
+        self.counter = 0
+
+    def path(self, name):
+        self.counter += 1
+        path = os.path.join(self.work_dir, f"{self.counter:05d}-{name}")
+        os.makedirs(path)
+        return path
+
+    def keystores(self, count, store_type, native):
+        from keysigner.keystore_writer import KeystoreWriterEntry, generate_private_key, self_signed_certificate, write_keystore
+        directory = self.path('keystores')
+        extension = 'p12' if store_type == 'PKCS12' else store_type.lower()
+        paths = []
+        private_key = certificate = None
+        for index in range(count):
+            path = os.path.join(directory, f"bench_{index}.{extension}")
+            if native:
+                if private_key is None:
+                    # Parsing cost does not depend on the key, one keypair serves every keystore
+                    private_key = generate_private_key('RSA', 2048)
+                    certificate = self_signed_certificate(private_key, 'CN=Benchmark')
+                write_keystore(path, store_type, [KeystoreWriterEntry('bench', private_key, [certificate])], PASSWORD)
+            else:
+                with open(path, 'wb') as f:
+                    f.write(os.urandom(2048))
+            paths.append(path)
+        return paths
+
+    def apks(self, count):
+        directory = self.path('apks')
+        first = make_synthetic_apk(os.path.join(directory, 'bench_0.apk'), parse_size(self.args.apk_size), self.args.apk_entries)
+        paths = [first]
+        for index in range(1, count):
+            path = os.path.join(directory, f"bench_{index}.apk")
+            os.link(first, path)
+            paths.append(path)
+        return paths
+
+def check(results):
+    failed = [result for result in results if not result['success']]
+    if failed:
+        raise RuntimeError(failed[0]['error'])
+
+def generate_operation(fixtures, backend, batch):
+    from keysigner.keystore_generator import BulkKeystoreGenerator
+    generator = BulkKeystoreGenerator('PKCS12', PASSWORD, key_algorithm=fixtures.args.key_alg, backend=backend)
+
+    def run():
+        generator.output_path = fixtures.path('generate')
+        if batch:
+            check(generator.generate_many([{'name': f"bench_{index}"} for index in range(batch)], fixtures.args.workers))
+        else:
+            check([generator.generate_one({'name': 'bench'})])
+    return run
+
+def migrate_operation(fixtures, backend, batch):
+    from keysigner.keystore_migrator import BulkKeystoreMigrator
+    sources = fixtures.keystores(batch or 1, 'JKS', False)
+    migrator = BulkKeystoreMigrator('PKCS12', PASSWORD, output_path=fixtures.path('migrate'))
+
+    def run():
+        if batch:
+            check(migrator.migrate_many(sources, fixtures.args.workers))
+        else:
+            check([migrator.migrate_one(sources[0])])
+    return run
+
+def pkcs12_pem_operation(fixtures, backend, batch):
+    from keysigner.pkcs12_to_pem import PKCS12ToPEM
+    keystores = fixtures.keystores(batch or 1, 'PKCS12', backend in NATIVE_BACKENDS)
+    output_path = fixtures.path('pem')
+
+    def export(path):
+        PKCS12ToPEM(backend).export(path, PASSWORD, output_path)
+
+    def run():
+        if batch:
+            with ThreadPoolExecutor(max_workers=fixtures.args.workers) as executor:
+                list(executor.map(export, keystores))
+        else:
+            export(keystores[0])
+    return run
+
+def info_operation(fixtures, backend, batch):
+    from keysigner.jvm_worker import run_tool
+    from keysigner.keystore_info import KeystoreInfo
+    keystores = fixtures.keystores(batch or 1, 'PKCS12', backend in NATIVE_BACKENDS)
+
+    def read(path):
+        info = KeystoreInfo(backend)
+        if backend == 'native':
+            return info.read(path, PASSWORD).to_dict()
+        info.keystore_path, info.store_pass, info.keystore_type = path, PASSWORD, 'PKCS12'
+        result = run_tool(info.keytool_command(), capture_output=True)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr or result.stdout)
+
+    def run():
+        if batch:
+            with ThreadPoolExecutor(max_workers=fixtures.args.workers) as executor:
+                list(executor.map(read, keystores))
+        else:
+            read(keystores[0])
+    return run
+
+def sign_operation(fixtures, backend, batch):
+    from keysigner.apk_signer import APKSigner
+    keystore = fixtures.keystores(1, 'PKCS12', backend in NATIVE_BACKENDS)[0]
+    key_spec = {'type': 'p12', 'keystore': keystore, 'store_pass': PASSWORD, 'alias': 'bench'}
+    apks = fixtures.apks(batch or 1)
+    signer = APKSigner()
+    signer.engine = backend if backend in NATIVE_BACKENDS else 'apksigner'
+    signer.output_cache = None
+
+    def run():
+        output_path = fixtures.path('signed')
+        if batch:
+            check(signer.sign_many(apks, key_spec, workers=fixtures.args.workers, output_path=output_path))
+        else:
+            check([signer.sign_one(apks[0], signer.signed_apk_path(apks[0], output_path), key_spec)])
+    return run
+
+SETUPS = {
+    'generate': generate_operation,
+    'migrate': migrate_operation,
+    'pkcs12-pem': pkcs12_pem_operation,
+    'info': info_operation,
+    'sign': sign_operation,
+}
+
+def run_scenario(name, args):
+    operation, backend, mode = name.split('/')
+    batch = args.batch if mode == 'batch' else 0
+    with tempfile.TemporaryDirectory() as work_dir:
+        run = SETUPS[operation](Fixtures(work_dir, args), backend, batch)
+        run()  # warm up imports, caches and the page cache
+        timings = []
+        start = time.perf_counter()
+        for _ in range(args.runs):
+            op_start = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - op_start)
+        elapsed = time.perf_counter() - start
+    operations = args.runs * (batch or 1)
+    return {
+        'scenario': name,
+        'operation': operation,
+        'backend': backend,
+        'mode': mode,
+        'runs': args.runs,
+        'batch_size': batch or 1,
+        'ops_per_sec': round(operations / elapsed, 2),
+        'p50_ms': round(statistics.median(timings) * 1000, 2),
+        'p99_ms': round(percentile(timings, 0.99) * 1000, 2),
+        'mean_ms': round(statistics.mean(timings) * 1000, 2),
+        'peak_rss_mb': peak_rss_mb(resource.RUSAGE_SELF) if resource else None,
+        'children_peak_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN) if resource else None,
+    }
+
+def scenario_environment(args):
+    env = dict(os.environ)
+    env['PATH'] = FAKE_TOOLS + os.pathsep + env.get('PATH', '')
+    env['KEYSIGNER_FAKE_LATENCY_MS'] = str(args.latency)
+    # Only the code paths under test: no resident JVM, no caches carried over from earlier runs
+    for name in ['KEYSIGNER_JVM_WORKER', 'KEYSIGNER_OUTPUT_CACHE', 'KEYSIGNER_KEY_POOL', 'KEYSIGNER_TOOL_TIMEOUT']:
+        env.pop(name, None)
+    return env
+
+def child_arguments(args):
+    return [
+        '--runs', str(args.runs), '--batch', str(args.batch), '--workers', str(args.workers),
+        '--latency', str(args.latency), '--key-alg', args.key_alg,
+        '--apk-size', args.apk_size, '--apk-entries', str(args.apk_entries),
+    ]
+
+def native_available():
+    try:
+        import cryptography
+    except ImportError:
+        return False
+    return True
+
+def keysigner_version():
+    try:
+        from importlib.metadata import version
+        return version('keysigner')
+    except Exception:
+        return None
+
+def git_revision():
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR, capture_output=True, text=True)
+        return result.stdout.strip() or None
+    except OSError:
+        return None
+
+def print_result(result):
+    rss = f"{result['peak_rss_mb']:7.1f} MiB" if result['peak_rss_mb'] is not None else '        n/a'
+    print(f"{result['scenario']:<28} {result['ops_per_sec']:9.1f} ops/s   p50 {result['p50_ms']:9.1f} ms   p99 {result['p99_ms']:9.1f} ms   rss {rss}")
+
+def compare(results, settings, baseline_path, threshold):
+    with open(baseline_path, 'r') as f:
+        report = json.load(f)
+    baseline = {result['scenario']: result for result in report['results']}
+    regressions = 0
+    print(f"\nChange against {baseline_path} (regression: more than {threshold:g}% slower)")
+    changed = sorted(key for key in settings if report.get('settings', {}).get(key) != settings[key])
+    if changed:
+        print(f"Warning: the runs differ in {', '.join(changed)}, the numbers are not comparable.")
+    for result in results:
+        previous = baseline.get(result['scenario'])
+        if previous is None or 'error' in result or 'error' in previous:
+            continue
+        throughput = (result['ops_per_sec'] / previous['ops_per_sec'] - 1) * 100
+        tail = (result['p99_ms'] / previous['p99_ms'] - 1) * 100 if previous['p99_ms'] else 0.0
+        regressed = throughput < -threshold or tail > threshold
+        regressions += regressed
+        print(f"{result['scenario']:<28} ops/s {throughput:+7.1f}%   p99 {tail:+7.1f}%" + ('   REGRESSION' if regressed else ''))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="keysigner overhead benchmarks with stand-in tools.")
+    parser.add_argument('--only', nargs='+', choices=OPERATIONS, help="Operations to run (default: all)")
+    parser.add_argument('--runs', type=int, default=20, help="Measured runs per scenario")
+    parser.add_argument('--batch', type=int, default=16, help="Items per run in batch mode")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Concurrency of batch mode")
+    parser.add_argument('--latency', type=float, default=0, help="Milliseconds each stand-in tool sleeps")
+    parser.add_argument('--key-alg', default='RSA-2048', help="Key algorithm of generated keystores")
+    parser.add_argument('--apk-size', default='8M', help="Payload size of each synthetic APK")
+    parser.add_argument('--apk-entries', type=int, default=200, help="Entries of each synthetic APK")
+    parser.add_argument('--json', metavar='PATH', help="Write the results as JSON")
+    parser.add_argument('--compare', metavar='PATH', help="Compare with the JSON results of an earlier run")
+    parser.add_argument('--threshold', type=float, default=10.0, help="Percent change reported as a regression by --compare")
+    parser.add_argument('--scenario', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario:
+        # Child process of one scenario: the result goes to the parent as JSON on stdout
+        print(json.dumps(run_scenario(args.scenario, args)))
+        return 0
+
+    names = [name for name in scenario_names(args.only) if native_available() or name.split('/')[1] not in NATIVE_BACKENDS]
+    print(f"{len(names)} scenarios, {args.runs} runs each, batch {args.batch}, {args.workers} workers, tool latency {args.latency:g} ms\n")
+    results = []
+    for name in names:
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--scenario', name] + child_arguments(args),
+            env=scenario_environment(args), capture_output=True, text=True
+        )
+        if completed.returncode != 0:
+            error = (completed.stderr.strip().splitlines() or [f"exit status {completed.returncode}"])[-1]
+            results.append({'scenario': name, 'error': error})
+            print(f"{name:<28} failed: {error}")
+            continue
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        results.append(result)
+        print_result(result)
+
+    settings = {
+        'runs': args.runs, 'batch': args.batch, 'workers': args.workers, 'latency_ms': args.latency,
+        'key_alg': args.key_alg, 'apk_size': args.apk_size, 'apk_entries': args.apk_entries,
+    }
+    report = {
+        'keysigner': keysigner_version(),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'settings': settings,
+        'results': results,
+    }
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.json}")
+    failed = sum('error' in result for result in results)
+    if args.compare:
+        failed += compare(results, settings, args.compare, args.threshold)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
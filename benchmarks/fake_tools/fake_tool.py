@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+# Stand-ins for keytool, apksigner and openssl that keysigner's benchmarks put first on PATH. They accept the
+# arguments keysigner passes, produce the output files and the console output keysigner parses, and sleep
+# for a configurable time instead of doing the work:
+#
+#   KEYSIGNER_FAKE_LATENCY_MS=200            latency of every tool
+#   KEYSIGNER_FAKE_KEYTOOL_LATENCY_MS=300    latency of one tool (KEYTOOL, APKSIGNER or OPENSSL)
+#   KEYSIGNER_FAKE_FAIL=keytool              make a tool exit with status 1
+
+import os
+import sys
+import time
+import shutil
+
+def latency(tool):
+    value = os.environ.get(f'KEYSIGNER_FAKE_{tool.upper()}_LATENCY_MS', os.environ.get('KEYSIGNER_FAKE_LATENCY_MS', '0'))
+    return float(value or 0) / 1000
+
+def option(args, name, default=None):
+    return args[args.index(name) + 1] if name in args and args.index(name) + 1 < len(args) else default
+
+def write_file(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def copy_or_write(source, destination, data):
+    if source and os.path.isfile(source):
+        shutil.copyfile(source, destination)
+    else:
+        write_file(destination, data)
+
+def keytool(args):
+    if '-genkeypair' in args:
+        path = option(args, '-keystore')
+        if os.path.exists(path):
+            print(f"keytool error: java.lang.Exception: Key pair not generated, alias <{option(args, '-alias')}> already exists")
+            return 1
+        write_file(path, os.urandom(2048))
+        return 0
+    if '-importkeystore' in args:
+        alias = option(args, '-srcalias', 'fake')
+        copy_or_write(option(args, '-srckeystore'), option(args, '-destkeystore'), os.urandom(2048))
+        sys.stderr.write(f"Importing keystore {option(args, '-srckeystore')} to {option(args, '-destkeystore')}...\n")
+        sys.stderr.write(f"Entry for alias {alias} successfully imported.\n")
+        if '-srcalias' not in args:
+            sys.stderr.write("Import command completed:  1 entries successfully imported, 0 entries failed or cancelled\n")
+        return 0
+    if '-list' in args:
+        print(f"Keystore type: {option(args, '-storetype', 'PKCS12')}\nKeystore provider: FAKE\n")
+        print("Your keystore contains 1 entry\n")
+        print("Alias name: fake\nCreation date: Jan 1, 2024\nEntry type: PrivateKeyEntry\nCertificate chain length: 1")
+        print("Certificate[1]:\nOwner: CN=Fake\nIssuer: CN=Fake\nSerial number: 1\n")
+        return 0
+    print("keytool error: unsupported command")
+    return 1
+
+def apksigner(args):
+    if args and args[0] == 'sign':
+        output = option(args, '--out')
+        shutil.copyfile(args[-1], output)
+        return 0
+    if args and args[0] == 'verify':
+        print("Verifies")
+        return 0
+    sys.stderr.write("apksigner: unsupported command\n")
+    return 1
+
+def openssl(args):
+    output = option(args, '-out')
+    if output:
+        # The stand-in writes placeholder PEM/DER data, consumers of the files are not exercised
+        copy_or_write(option(args, '-in'), output, b'-----BEGIN FAKE-----\n-----END FAKE-----\n')
+    return 0
+
+TOOLS = {'keytool': keytool, 'apksigner': apksigner, 'openssl': openssl}
+
+def main(tool, args):
+    time.sleep(latency(tool))
+    if tool in os.environ.get('KEYSIGNER_FAKE_FAIL', '').split(','):
+        sys.stderr.write(f"{tool}: failure requested by KEYSIGNER_FAKE_FAIL\n")
+        return 1
+    return TOOLS[tool](args)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Generates unsigned synthetic APKs of a given size and entry count.
+#
+#   python benchmarks/synthetic_apk.py out.apk --size 2G --entries 500
+
+import os
+import sys
+import struct
+import zipfile
+import argparse
+
+BLOCK_SIZE = 1024 * 1024
+ANDROID_NS = 'http://schemas.android.com/apk/res/android'
+
+def parse_size(value):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    value = value.strip().upper().rstrip('B').rstrip('I')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+def binary_manifest(min_sdk, target_sdk=34):
+    # Minimal binary AndroidManifest.xml: <manifest><uses-sdk android:minSdkVersion android:targetSdkVersion/></manifest>
+    strings = ['minSdkVersion', 'targetSdkVersion', 'android', ANDROID_NS, 'manifest', 'uses-sdk']
+    encoded = [struct.pack('<H', len(text)) + text.encode('utf-16-le') + b'\x00\x00' for text in strings]
+    offsets, position = [], 0
+    for item in encoded:
+        offsets.append(position)
+        position += len(item)
+    pool_data = b''.join(encoded)
+    pool_data += b'\x00' * (-len(pool_data) % 4)
+    header_size = 28 + 4 * len(strings)
+    pool = struct.pack('<HHIIIIII', 0x0001, 28, header_size + len(pool_data), len(strings), 0, 0, header_size, 0)
+    pool += struct.pack(f'<{len(strings)}I', *offsets) + pool_data
+    resource_map = struct.pack('<HHI', 0x0180, 8, 16) + struct.pack('<II', 0x0101020c, 0x01010270)
+
+    def node(chunk_type, body):
+        return struct.pack('<HHIII', chunk_type, 16, 16 + len(body), 1, 0xFFFFFFFF) + body
+
+    def start_element(name, attributes):
+        body = struct.pack('<IIHHHHHH', 0xFFFFFFFF, name, 20, 20, len(attributes), 0, 0, 0)
+        for attribute_name, value in attributes:
+            body += struct.pack('<IIIHBBI', 3, attribute_name, 0xFFFFFFFF, 8, 0, 0x10, value)
+        return node(0x0102, body)
+
+    body = (
+        node(0x0100, struct.pack('<II', 2, 3))
+        + start_element(4, [])
+        + start_element(5, [(0, min_sdk), (1, target_sdk)])
+        + node(0x0103, struct.pack('<II', 0xFFFFFFFF, 5))
+        + node(0x0103, struct.pack('<II', 0xFFFFFFFF, 4))
+        + node(0x0101, struct.pack('<II', 2, 3))
+    )
+    content = pool + resource_map + body
+    return struct.pack('<HHI', 0x0003, 8, 8 + len(content)) + content
+
+def make_synthetic_apk(path, size, entries=100, compress_ratio=0.0, min_sdk=21):
+    # Stored entries carry incompressible random data, a share of them is deflated text like resources
+    block = os.urandom(BLOCK_SIZE)
+    text_block = (b'<resource name="value">synthetic</resource>\n' * (BLOCK_SIZE // 45 + 1))[:BLOCK_SIZE]
+    entries = max(1, entries)
+    entry_size = max(1, size // entries)
+    with zipfile.ZipFile(path, 'w') as apk:
+        apk.writestr('AndroidManifest.xml', binary_manifest(min_sdk), compress_type=zipfile.ZIP_DEFLATED)
+        for index in range(entries):
+            compressed = index < entries * compress_ratio
+            name = f'res/raw/entry_{index:06d}.xml' if compressed else f'assets/blob_{index:06d}.bin'
+            info = zipfile.ZipInfo(name, date_time=(2024, 1, 1, 0, 0, 0))
+            info.compress_type = zipfile.ZIP_DEFLATED if compressed else zipfile.ZIP_STORED
+            with apk.open(info, 'w') as entry:
+                remaining = entry_size
+                while remaining > 0:
+                    data = text_block if compressed else block
+                    entry.write(data[:min(remaining, BLOCK_SIZE)])
+                    remaining -= BLOCK_SIZE
+    return path
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic unsigned APK.")
+    parser.add_argument('output')
+    parser.add_argument('--size', default='64M', help="Approximate uncompressed payload size, e.g. 512M or 2G")
+    parser.add_argument('--entries', type=int, default=100)
+    parser.add_argument('--compress-ratio', type=float, default=0.0, help="Share of entries stored deflated (0-1)")
+    parser.add_argument('--min-sdk', type=int, default=21, help="minSdkVersion of the generated manifest")
+    args = parser.parse_args()
+    make_synthetic_apk(args.output, parse_size(args.size), args.entries, args.compress_ratio, args.min_sdk)
+    print(f"{args.output}: {os.path.getsize(args.output) / 1048576:.1f} MiB")
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Writes JKS, BKS and PKCS12 keystores with mixed-case aliases in-process and checks them against Java's semantics:
+# the aliases stored in a JKS file must be lowercase, and keytool must find every entry by the alias it was given.
+# keytool is skipped when it is not on PATH, and for BKS when the BouncyCastle jar is not in keysigner/lib.
+#
+#   python benchmarks/verify_keystore_writer.py
+
+import os
+import sys
+import struct
+import shutil
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from keysigner.keystore_writer import KeystoreWriterEntry, write_keystore, generate_private_key, self_signed_certificate
+from keysigner.keystore_reader import read_keystore
+from keysigner.jvm_worker import provider_arguments
+
+PASSWORD = 'verify123'
+ALIASES = ['Release', 'upload_KEY', 'lower']
+
+def jks_aliases(path):
+    # The raw aliases of a JKS file, as JavaKeyStore.engineLoad reads them
+    with open(path, 'rb') as f:
+        data = f.read()
+    count = struct.unpack_from('>I', data, 8)[0]
+    offset = 12
+    aliases = []
+    for _ in range(count):
+        tag = struct.unpack_from('>I', data, offset)[0]
+        length = struct.unpack_from('>H', data, offset + 4)[0]
+        aliases.append(data[offset + 6:offset + 6 + length].decode('utf-8'))
+        offset += 6 + length + 8
+        if tag == 1:
+            offset += 4 + struct.unpack_from('>I', data, offset)[0]
+            chain = struct.unpack_from('>I', data, offset)[0]
+            offset += 4
+        else:
+            chain = 1
+        for _ in range(chain):
+            offset += 2 + struct.unpack_from('>H', data, offset)[0]
+            offset += 4 + struct.unpack_from('>I', data, offset)[0]
+    return aliases
+
+def keytool_finds(path, store_type, alias):
+    cmd = ['keytool', '-list', '-keystore', path, '-storetype', store_type, '-storepass', PASSWORD, '-alias', alias]
+    if store_type == 'BKS':
+        cmd += provider_arguments()
+    return subprocess.run(cmd, capture_output=True, text=True).returncode == 0
+
+def main():
+    entries = []
+    for alias in ALIASES:
+        private_key = generate_private_key('EC', 256)
+        entries.append(KeystoreWriterEntry(alias, private_key, [self_signed_certificate(private_key, f"CN={alias}")], PASSWORD))
+    keytool = shutil.which('keytool')
+    failures = 0
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for store_type, extension in [('JKS', 'jks'), ('BKS', 'bks'), ('PKCS12', 'p12')]:
+            path = os.path.join(temp_dir, f"verify.{extension}")
+            write_keystore(path, store_type, entries, PASSWORD)
+            problems = []
+            if store_type == 'JKS':
+                stored = jks_aliases(path)
+                if stored != [alias.lower() for alias in ALIASES]:
+                    problems.append(f"stored aliases {stored} are not lowercase")
+            read_aliases = [entry.alias.lower() for entry in read_keystore(path, PASSWORD, store_type).entries]
+            if sorted(read_aliases) != sorted(alias.lower() for alias in ALIASES):
+                problems.append(f"read back {read_aliases}")
+            checked = keytool and (store_type != 'BKS' or os.path.exists(provider_arguments()[-1]))
+            if checked:
+                problems += [f"keytool cannot find '{alias}'" for alias in ALIASES if not keytool_finds(path, store_type, alias)]
+            if problems:
+                failures += 1
+                print(f"FAIL  {store_type}: {'; '.join(problems)}")
+            else:
+                print(f"OK    {store_type}{'' if checked else ' (not checked with keytool)'}")
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
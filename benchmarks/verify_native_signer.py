@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Signs every APK of a corpus with the native engine and checks the result with `apksigner verify`.
+#
+#   python benchmarks/verify_native_signer.py path/to/apk_corpus
+#   python benchmarks/verify_native_signer.py path/to/apk_corpus --cert release.x509.pem --key release.pk8
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from keysigner.apk_signer import APKSigner
+
+EXPECTED = {
+    'v2': 'Verified using v2 scheme (APK Signature Scheme v2): true',
+    'v3': 'Verified using v3 scheme (APK Signature Scheme v3): true',
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate the native signing engine against apksigner verify.")
+    parser.add_argument('corpus', help="Directory of unsigned or signed APKs")
+    parser.add_argument('--cert', help="x509 certificate (default: bundled test key)")
+    parser.add_argument('--key', help="PKCS8 private key (default: bundled test key)")
+    parser.add_argument('--no-v3', action='store_true', help="Sign with v2 only")
+    args = parser.parse_args()
+
+    key_spec = {'type': 'pem', 'cert': args.cert, 'key': args.key} if args.cert and args.key else {'type': 'test'}
+    schemes = ['v2'] if args.no_v3 else ['v2', 'v3']
+    apks = sorted(os.path.join(args.corpus, name) for name in os.listdir(args.corpus) if name.lower().endswith('.apk'))
+
+    signer = APKSigner()
+    signer.set_schemes(schemes)
+    failures = 0
+    with tempfile.TemporaryDirectory() as output_dir:
+        for apk in apks:
+            signed_apk = signer.signed_apk_path(apk, output_dir)
+            start = time.perf_counter()
+            try:
+                signer.sign_native(apk, signed_apk, key_spec)
+            except Exception as e:
+                failures += 1
+                print(f"FAIL  {os.path.basename(apk)}: native signing failed: {e}")
+                continue
+            elapsed = (time.perf_counter() - start) * 1000
+
+            result = subprocess.run(['apksigner', 'verify', '-v', signed_apk], capture_output=True, text=True)
+            missing = [scheme for scheme in schemes if EXPECTED[scheme] not in result.stdout]
+            if result.returncode != 0 or missing:
+                failures += 1
+                print(f"FAIL  {os.path.basename(apk)}: {result.stdout.strip()} {result.stderr.strip()}")
+            else:
+                print(f"OK    {os.path.basename(apk)} ({os.path.getsize(apk) / 1048576:.1f} MiB, signed in {elapsed:.0f} ms)")
+
+    print(f"\n{len(apks) - failures}/{len(apks)} APKs verified.")
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
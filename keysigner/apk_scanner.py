@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+import mmap
+import zlib
+import struct
+from .native_signer import ApkSections, V2_BLOCK_ID, V3_BLOCK_ID
+from .jar_signer import read_central_directory, SIGNATURE_FILE, LOCAL_HEADER_SIZE
+from .trace import traced
+
+V31_BLOCK_ID = 0x1b93ad61
+MANIFEST_NAME = 'AndroidManifest.xml'
+MAX_MANIFEST_SIZE = 16 * 1024 * 1024
+
+# Binary XML (AXML) chunk types
+RES_XML_TYPE = 0x0003
+RES_STRING_POOL_TYPE = 0x0001
+RES_XML_RESOURCE_MAP_TYPE = 0x0180
+RES_XML_START_ELEMENT_TYPE = 0x0102
+UTF8_FLAG = 0x100
+TYPE_STRING = 0x03
+TYPE_INT_DEC = 0x10
+TYPE_INT_HEX = 0x11
+
+# android:minSdkVersion / android:targetSdkVersion
+SDK_ATTRIBUTES = {0x0101020c: 'min_sdk', 0x01010270: 'target_sdk'}
+SDK_ATTRIBUTE_NAMES = {'minSdkVersion': 'min_sdk', 'targetSdkVersion': 'target_sdk'}
+# Preview codenames (e.g. "VanillaIceCream") are newer than any released API level
+PREVIEW_SDK = 10000
+
+# First API level verifying each scheme
+V2_MIN_SDK = 24
+V3_MIN_SDK = 28
+
+class ManifestParser:
+    def __init__(self, data):
+        self.data = data
+        self.strings = []
+        self.resource_ids = []
+
+    def parse(self):
+        data = self.data
+        if len(data) < 8 or struct.unpack('<H', data[:2])[0] != RES_XML_TYPE:
+            raise ValueError("AndroidManifest.xml is not a binary XML file.")
+        result = {'min_sdk': None, 'target_sdk': None}
+        uses_sdk = False
+        position = struct.unpack('<H', data[2:4])[0]
+        while position + 8 <= len(data):
+            chunk_type, header_size, chunk_size = struct.unpack('<HHI', data[position:position + 8])
+            if chunk_size < 8 or position + chunk_size > len(data):
+                raise ValueError("Malformed chunk in AndroidManifest.xml.")
+            if chunk_type == RES_STRING_POOL_TYPE:
+                self.read_string_pool(position, header_size)
+            elif chunk_type == RES_XML_RESOURCE_MAP_TYPE:
+                count = (chunk_size - header_size) // 4
+                self.resource_ids = list(struct.unpack(f'<{count}I', data[position + header_size:position + header_size + count * 4]))
+            elif chunk_type == RES_XML_START_ELEMENT_TYPE and self.string(struct.unpack('<I', data[position + 20:position + 24])[0]) == 'uses-sdk':
+                # The manifest's only uses-sdk element, nothing after it is needed
+                uses_sdk = True
+                result.update(self.sdk_attributes(position + header_size))
+                break
+            position += chunk_size
+        if not uses_sdk or result['min_sdk'] is None:
+            # Without android:minSdkVersion the platform assumes API level 1
+            result['min_sdk'] = 1
+        return result
+
+    def read_string_pool(self, start, header_size):
+        data = self.data
+        count, _, flags, strings_start = struct.unpack('<IIII', data[start + 8:start + 24])
+        offsets = struct.unpack(f'<{count}I', data[start + header_size:start + header_size + count * 4])
+        utf8 = flags & UTF8_FLAG
+        for offset in offsets:
+            position = start + strings_start + offset
+            if utf8:
+                # UTF-16 length, then UTF-8 length, each 1 or 2 bytes
+                position += 2 if data[position] & 0x80 else 1
+                length = data[position]
+                if length & 0x80:
+                    length = ((length & 0x7F) << 8) | data[position + 1]
+                    position += 1
+                position += 1
+                self.strings.append(bytes(data[position:position + length]).decode('utf-8', 'replace'))
+            else:
+                (length,) = struct.unpack('<H', data[position:position + 2])
+                position += 2
+                if length & 0x8000:
+                    length = ((length & 0x7FFF) << 16) | struct.unpack('<H', data[position:position + 2])[0]
+                    position += 2
+                self.strings.append(bytes(data[position:position + length * 2]).decode('utf-16-le', 'replace'))
+
+    def string(self, index):
+        return self.strings[index] if 0 <= index < len(self.strings) else None
+
+    def sdk_attributes(self, position):
+        data = self.data
+        attribute_start, attribute_size, attribute_count = struct.unpack('<HHH', data[position + 8:position + 14])
+        values = {}
+        for index in range(attribute_count):
+            offset = position + attribute_start + index * attribute_size
+            _, name, raw_value, _, _, data_type, value = struct.unpack('<IIIHBBI', data[offset:offset + 20])
+            resource_id = self.resource_ids[name] if name < len(self.resource_ids) else None
+            key = SDK_ATTRIBUTES.get(resource_id) or SDK_ATTRIBUTE_NAMES.get(self.string(name))
+            if key is None:
+                continue
+            if data_type in [TYPE_INT_DEC, TYPE_INT_HEX]:
+                values[key] = value
+            elif data_type == TYPE_STRING:
+                text = self.string(raw_value) or ''
+                values[key] = int(text) if text.isdigit() else PREVIEW_SDK
+        return values
+
+class APKScanner:
+    # Reads the ZIP Central Directory and AndroidManifest.xml only, through a memory map, so
+    # scanning costs the same for a 10 MB and a 4 GB APK: the other entries are never paged in.
+    @traced('scan apk', 'apk')
+    def scan(self, apk_file):
+        with open(apk_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as apk_map:
+            data = memoryview(apk_map)
+            try:
+                return self.scan_data(data)
+            finally:
+                data.release()
+
+    def scan_data(self, data):
+        apk = ApkSections(data)
+        entries = read_central_directory(data, apk.cd_offset, apk.cd_size)
+        result = {
+            'entries': len(entries),
+            'v1_signed': any(SIGNATURE_FILE.match(entry.name) and entry.name.upper().endswith('.SF') for entry in entries),
+            'signing_block': apk.has_signing_block,
+            'signed_schemes': self.signing_block_schemes(data, apk) if apk.has_signing_block else [],
+            'min_sdk': None,
+            'target_sdk': None,
+            'manifest_error': None,
+        }
+        manifest = next((entry for entry in entries if entry.name == MANIFEST_NAME), None)
+        if manifest is None:
+            result['manifest_error'] = f"{MANIFEST_NAME} not found"
+            return result
+        try:
+            result.update(ManifestParser(self.read_entry(data, manifest)).parse())
+        except (ValueError, IndexError, struct.error, zlib.error) as e:
+            # An unreadable manifest leaves min_sdk unknown, which keeps every scheme enabled
+            result['manifest_error'] = str(e) or type(e).__name__
+        return result
+
+    def signing_block_schemes(self, data, apk):
+        schemes = []
+        position = apk.content_end + 8
+        end = apk.cd_offset - 24
+        while position + 12 <= end:
+            pair_size, block_id = struct.unpack('<QI', data[position:position + 12])
+            schemes.extend({V2_BLOCK_ID: ['v2'], V3_BLOCK_ID: ['v3'], V31_BLOCK_ID: ['v3.1']}.get(block_id, []))
+            position += 8 + pair_size
+        return schemes
+
+    def read_entry(self, data, entry):
+        if entry.uncompressed_size > MAX_MANIFEST_SIZE:
+            raise ValueError(f"{entry.name} is too large ({entry.uncompressed_size} bytes).")
+        offset = entry.local_header_offset
+        name_length, extra_length = struct.unpack('<HH', data[offset + 26:offset + 30])
+        start = offset + LOCAL_HEADER_SIZE + name_length + extra_length
+        payload = data[start:start + entry.compressed_size]
+        if entry.method == 0:
+            return bytes(payload)
+        if entry.method == 8:
+            return zlib.decompress(payload, -15)
+        raise ValueError(f"Unsupported compression method {entry.method} in {entry.name}.")
+
+def select_schemes(scan, v4_enabled=False):
+    # Smallest scheme set that every device from minSdkVersion upwards verifies:
+    # v1 only below API 24, v2 only below API 28, v3 always (key rotation needs it).
+    min_sdk = scan.get('min_sdk')
+    if min_sdk is None:
+        return {'v1': True, 'v2': True, 'v3': True, 'v4': v4_enabled}
+    return {'v1': min_sdk < V2_MIN_SDK, 'v2': min_sdk < V3_MIN_SDK, 'v3': True, 'v4': v4_enabled}
@@ -1,11 +1,21 @@
 # -*- coding: utf-8 -*-
 
 import os
-import subprocess
+import copy
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from .jvm_worker import run_tool
+from .native_signer import NativeAPKSigner, load_signing_key, native_signing_available
+from .apk_scanner import APKScanner, select_schemes
+from .output_cache import SignedOutputCache, signer_identity, detach_output
+from .checkpoint import Checkpoint, file_state
+from .key_cache import KeyCache, DEFAULT_TTL
+from .journal import record, journal_batch
+from .trace import traced, span
 from .utils import *
 
 class APKSigner:
-    def __init__(self):
+    def __init__(self, timeout=None):
         self.root_dir = os.path.dirname(__file__)
         self.lib_path = os.path.join(self.root_dir, 'lib')
         self.apksigner_jar = os.path.join(self.lib_path, 'apksigner.jar')
@@ -15,29 +25,71 @@ class APKSigner:
         self.v4_enabled = False
         self.output_path = None
         self.apk_file = None
+        self.timeout = timeout
+        self.engine = os.environ.get('KEYSIGNER_SIGNING_ENGINE', 'apksigner').lower()
+        self.digest_workers = int(os.environ.get('KEYSIGNER_DIGEST_WORKERS', '1'))
+        self.digest_cache = None
+        self.min_sdk = None
+        self.auto_schemes = False
+        output_cache = os.environ.get('KEYSIGNER_OUTPUT_CACHE')
+        self.output_cache = SignedOutputCache(None if output_cache in ['1', 'default'] else output_cache) if output_cache else None
+        key_cache_ttl = int(os.environ.get('KEYSIGNER_KEY_CACHE_TTL', DEFAULT_TTL))
+        self.key_cache = KeyCache(key_cache_ttl) if key_cache_ttl > 0 else None
 
+    @traced('input schemes', 'prompt')
     def set_signing_schemes(self):
-        scheme_choice = validate_input(cyan_text("(Scheme v1/v2/v3 Enabled!) Press enter to skip or 'y' to change: "), required=False)
+        scan = self.preflight(self.apk_file)
+        if scan is not None:
+            self.set_schemes(select_schemes(scan, self.v4_enabled))
+            min_sdk = scan['min_sdk'] if scan['min_sdk'] is not None else f"unknown ({scan['manifest_error']})"
+            print_blue(f"minSdkVersion: {min_sdk}, existing signatures: {', '.join(self.existing_signatures(scan)) or 'none'}")
+
+        scheme_choice = validate_input(cyan_text(f"(Scheme {'/'.join(self.enabled_schemes())} Enabled!) Press enter to skip or 'y' to change: "), required=False)
         if scheme_choice == 'y':
             print_blue("\n--- Set Signing Schemes (press Enter to use default values) ---")
-            self.v1_enabled = validate_input(cyan_text("Enable V1 signing? (default: True): "), required=False) or True
-            self.v2_enabled = validate_input(cyan_text("Enable V2 signing? (default: True): "), required=False) or True
-            self.v3_enabled = validate_input(cyan_text("Enable V3 signing? (default: True): "), required=False) or True
-            self.v4_enabled = validate_input(cyan_text("Enable V4 signing? (default: False): "), required=False) or False
+            for name in ['v1', 'v2', 'v3', 'v4']:
+                setattr(self, f"{name}_enabled", self.ask_scheme(name, getattr(self, f"{name}_enabled")))
+
+    def ask_scheme(self, name, default):
+        while True:
+            answer = validate_input(cyan_text(f"Enable {name.upper()} signing? (default: {default}): "), required=False).strip().lower()
+            if not answer:
+                return default
+            if answer in ['true', 't', 'yes', 'y', '1']:
+                return True
+            if answer in ['false', 'f', 'no', 'n', '0']:
+                return False
+            print_red("Please answer yes or no.")
+
+    def enabled_schemes(self):
+        return [name for name in ['v1', 'v2', 'v3', 'v4'] if getattr(self, f"{name}_enabled")]
+
+    def existing_signatures(self, scan):
+        return (['v1'] if scan['v1_signed'] else []) + scan['signed_schemes']
+
+    @traced('preflight scan', 'apk')
+    def preflight(self, apk_file):
+        # Central Directory and AndroidManifest.xml only, the APK payload is not read
+        try:
+            scan = APKScanner().scan(apk_file)
+        except Exception as e:
+            print_yellow(f"Could not scan {os.path.basename(apk_file)} ({e}), keeping the selected signing schemes.")
+            return None
+        self.min_sdk = scan['min_sdk']
+        return scan
 
     def sign_with_test_key(self):
         print_blue("\n--- Signing APK with Test Key ---")
         cert = os.path.join(self.lib_path, 'testkey.x509.pem')
         key = os.path.join(self.lib_path, 'testkey.pk8')
-        base_name = os.path.splitext(os.path.basename(self.apk_file))[0]
-        signed_apk = os.path.join(self.output_path, f"{base_name}_signed.apk")
+        signed_apk = self.signed_apk_path(self.apk_file)
         self.run_apksigner(signed_apk, cert, key)
 
     def sign_with_keystores(self):
         try:
-            self.apk_file = validate_input(cyan_text("Enter the APK file to sign: "), path=True)
-            
-            self.output_path = validate_input(cyan_text(f"Enter output path (default: {os.path.abspath('signed_apks')}): "), required=False)
+            with span('input', 'prompt'):
+                self.apk_file = validate_input(cyan_text("Enter the APK file to sign: "), path=True)
+                self.output_path = validate_input(cyan_text(f"Enter output path (default: {os.path.abspath('signed_apks')}): "), required=False)
             if not self.output_path or not os.path.exists(self.output_path):
                 self.output_path = ensure_directory(self.output_path, caller='signer')
             
@@ -45,13 +97,14 @@ class APKSigner:
             
             valid_options = ['jks', 'p12', 'pem', 'test']
     
-            while True:
-                store_type = validate_input(cyan_text("Enter keystore type (jks/p12/pem/test): ")).lower()
+            with span('input keystore type', 'prompt'):
+                while True:
+                    store_type = validate_input(cyan_text("Enter keystore type (jks/p12/pem/test): ")).lower()
     
-                if store_type in valid_options:
-                    break
-                else:
-                    print_red(f"Invalid keystore type '{store_type}'. Please enter one of the following: jks, p12, pem, test.")
+                    if store_type in valid_options:
+                        break
+                    else:
+                        print_red(f"Invalid keystore type '{store_type}'. Please enter one of the following: jks, p12, pem, test.")
     
             print_blue("\n--- Signing APK with Keystore ---")
             
@@ -68,30 +121,16 @@ class APKSigner:
             exit()
 
     def sign_with_keystore(self, keystore_type):
-        keystore_path = validate_input(cyan_text(f"Enter {keystore_type.upper()} keystore path: "), path=True)
-        store_pass = validate_input(cyan_text("Enter keystore password: "), password=True, min_length=6)
-        alias = validate_input(cyan_text("Enter alias name: "))
-        base_name = os.path.splitext(os.path.basename(self.apk_file))[0]
-        signed_apk = os.path.join(self.output_path, f"{base_name}_signed.apk")
+        with span('input keystore', 'prompt'):
+            keystore_path = validate_input(cyan_text(f"Enter {keystore_type.upper()} keystore path: "), path=True)
+            store_pass = validate_input(cyan_text("Enter keystore password: "), password=True, min_length=6)
+            alias = validate_input(cyan_text("Enter alias name: "))
+            key_spec = {'type': keystore_type.lower(), 'keystore': keystore_path, 'store_pass': store_pass, 'alias': alias}
+            if keystore_type.lower() == 'jks':
+                key_spec['key_pass'] = validate_input(cyan_text("Enter alias password (default: same as keystore password): "), pass_opt=store_pass, min_length=6)
+        signed_apk = self.signed_apk_path(self.apk_file)
     
-        cmd = [
-            'apksigner', 'sign',
-            '--ks', keystore_path,
-            '--ks-pass', f'pass:{store_pass}',
-            '--ks-key-alias', alias,
-            f'--v1-signing-enabled={str(self.v1_enabled).lower()}',
-            f'--v2-signing-enabled={str(self.v2_enabled).lower()}',
-            f'--v3-signing-enabled={str(self.v3_enabled).lower()}',
-            f'--v4-signing-enabled={str(self.v4_enabled).lower()}',
-            '--out', signed_apk
-        ]
-    
-        if keystore_type.lower() == 'jks':
-            key_pass = validate_input(cyan_text("Enter alias password (default: same as keystore password): "), pass_opt=store_pass, min_length=6)
-            cmd.extend(['--key-pass', f'pass:{key_pass}'])
-    
-        cmd.extend([self.apk_file])
-        self.run_command(cmd, signed_apk)
+        self.sign_apk(key_spec, signed_apk)
     
     def sign_with_jks(self):
         self.sign_with_keystore('jks')
@@ -100,32 +139,246 @@ class APKSigner:
         self.sign_with_keystore('p12')
         
     def sign_with_pem(self):
-        x509_path = validate_input(cyan_text("Enter x509 certificate path: "), path=True)
-        key_path = validate_input(cyan_text("Enter private key path: "), path=True)
-        base_name = os.path.splitext(os.path.basename(self.apk_file))[0]
-        signed_apk = os.path.join(self.output_path, f"{base_name}_signed.apk")
+        with span('input keys', 'prompt'):
+            x509_path = validate_input(cyan_text("Enter x509 certificate path: "), path=True)
+            key_path = validate_input(cyan_text("Enter private key path: "), path=True)
+        signed_apk = self.signed_apk_path(self.apk_file)
         self.run_apksigner(signed_apk, x509_path, key_path)
 
     def run_apksigner(self, signed_apk, cert, key):
-        cmd = [
-            'apksigner', 'sign',
+        self.sign_apk({'type': 'pem', 'cert': cert, 'key': key}, signed_apk)
+
+    def sign_apk(self, key_spec, signed_apk):
+        key = None
+        if self.output_cache is not None:
+            key = self.output_cache_key(self.apk_file, key_spec)
+            method = self.output_cache.fetch(key, signed_apk)
+            if method:
+                print_green(f"APK successfully signed at {signed_apk} (cached output, {method})")
+                return
+            detach_output(signed_apk)
+        if self.sign_apk_uncached(key_spec, signed_apk) and key:
+            self.output_cache.store(key, signed_apk)
+
+    def sign_apk_uncached(self, key_spec, signed_apk):
+        if self.engine == 'native':
+            reason = self.native_unsupported_reason(key_spec)
+            if reason is None:
+                try:
+                    self.sign_native(self.apk_file, signed_apk, key_spec)
+                    print_green(f"APK successfully signed at {signed_apk}")
+                    return True
+                except (ImportError, NotImplementedError) as e:
+                    reason = str(e)
+                except Exception as e:
+                    print_red(f"Error occurred: {e}")
+                    exit()
+            print_yellow(f"Native signing engine not used ({reason}), falling back to apksigner.")
+        cmd = self.build_command(self.apk_file, signed_apk, key_spec)
+        return self.run_command(cmd, signed_apk)
+
+    def output_cache_key(self, apk_file, key_spec):
+        schemes = {name: getattr(self, f"{name}_enabled") for name in ['v1', 'v2', 'v3', 'v4']}
+        return self.output_cache.cache_key(apk_file, signer_identity(key_spec, self.lib_path), schemes)
+
+    def native_unsupported_reason(self, key_spec):
+        if not native_signing_available():
+            return "cryptography is not installed"
+        if self.v4_enabled:
+            return "v4 signing is enabled"
+        if not self.v1_enabled and not self.v2_enabled and not self.v3_enabled:
+            return "all signing schemes are disabled"
+        if key_spec.get('type', '').lower() not in ['jks', 'p12', 'pem', 'test']:
+            return f"{key_spec.get('type', '').upper()} keys are not supported"
+        return None
+
+    @traced('native sign', 'apk')
+    def sign_native(self, apk_file, signed_apk, key_spec):
+        if self.key_cache is not None:
+            private_key, certificates = self.key_cache.get(key_spec, self.lib_path)
+        else:
+            private_key, certificates = load_signing_key(key_spec, self.lib_path)
+        signer = NativeAPKSigner(
+            private_key, certificates, v2_enabled=self.v2_enabled, v3_enabled=self.v3_enabled,
+            digest_workers=self.digest_workers, digest_cache=self.digest_cache,
+            v1_enabled=self.v1_enabled, min_sdk=self.min_sdk
+        )
+        return signer.sign(apk_file, signed_apk)
+
+    def scheme_flags(self):
+        return [
             f'--v1-signing-enabled={str(self.v1_enabled).lower()}',
             f'--v2-signing-enabled={str(self.v2_enabled).lower()}',
             f'--v3-signing-enabled={str(self.v3_enabled).lower()}',
             f'--v4-signing-enabled={str(self.v4_enabled).lower()}',
+        ]
+
+    def build_keystore_command(self, apk_file, signed_apk, keystore_path, store_pass, alias, key_pass=None):
+        cmd = [
+            'apksigner', 'sign',
+            '--ks', keystore_path,
+            '--ks-pass', f'pass:{store_pass}',
+            '--ks-key-alias', alias,
+        ]
+        cmd.extend(self.scheme_flags())
+        cmd.extend(['--out', signed_apk])
+        if key_pass:
+            cmd.extend(['--key-pass', f'pass:{key_pass}'])
+        cmd.extend([apk_file])
+        return cmd
+
+    def build_pem_command(self, apk_file, signed_apk, cert, key):
+        cmd = ['apksigner', 'sign']
+        cmd.extend(self.scheme_flags())
+        cmd.extend([
             '--cert', cert,
             '--key', key,
-            '--out', signed_apk, self.apk_file
-        ]
-        self.run_command(cmd, signed_apk)
+            '--out', signed_apk, apk_file
+        ])
+        return cmd
+
+    def signed_apk_path(self, apk_file, output_path=None):
+        base_name = os.path.splitext(os.path.basename(apk_file))[0]
+        return os.path.join(output_path or self.output_path, f"{base_name}_signed.apk")
 
     def run_command(self, cmd, signed_apk):
         try:
-            result = subprocess.run(cmd)
+            result = run_tool(cmd, apksigner_jar=self.apksigner_jar, timeout=self.timeout)
             if result.returncode != 0:
                 print_red("Command execution failed.")
-                return
+                return False
             print_green(f"APK successfully signed at {signed_apk}")
+            return True
         except Exception as e:
             print_red(f"Error occurred: {e}")
             exit()
+
+    def set_schemes(self, schemes):
+        if schemes is None:
+            return
+        if isinstance(schemes, dict):
+            for name, enabled in schemes.items():
+                setattr(self, f"{name.lower()}_enabled", bool(enabled))
+        else:
+            enabled = {name.lower() for name in schemes}
+            for name in ['v1', 'v2', 'v3', 'v4']:
+                setattr(self, f"{name}_enabled", name in enabled)
+
+    @traced('build command', 'command')
+    def build_command(self, apk_file, signed_apk, key_spec):
+        store_type = key_spec.get('type', '').lower()
+        if store_type in ['jks', 'p12']:
+            return self.build_keystore_command(
+                apk_file, signed_apk,
+                key_spec['keystore'], key_spec['store_pass'], key_spec['alias'],
+                key_spec.get('key_pass')
+            )
+        if store_type == 'pem':
+            return self.build_pem_command(apk_file, signed_apk, key_spec['cert'], key_spec['key'])
+        if store_type == 'test':
+            cert = os.path.join(self.lib_path, 'testkey.x509.pem')
+            key = os.path.join(self.lib_path, 'testkey.pk8')
+            return self.build_pem_command(apk_file, signed_apk, cert, key)
+        raise ValueError(f"Invalid keystore type '{store_type}'. Expected one of: jks, p12, pem, test.")
+
+    @traced('sign apk', 'apk')
+    def sign_one(self, apk_file, signed_apk, key_spec):
+        # The v1 digest algorithm and automatic schemes depend on the minSdkVersion of each APK
+        signer = self
+        if self.auto_schemes or (self.engine == 'native' and self.v1_enabled):
+            signer = copy.copy(self)
+            try:
+                scan = APKScanner().scan(apk_file)
+                signer.min_sdk = scan['min_sdk']
+                if self.auto_schemes:
+                    signer.set_schemes(select_schemes(scan, self.v4_enabled))
+            except Exception as e:
+                if self.auto_schemes:
+                    return {'apk': apk_file, 'signed_apk': signed_apk, 'success': False, 'returncode': None, 'error': f"Pre-flight scan failed: {e}", 'engine': None, 'schemes': []}
+        return signer.sign_prepared(apk_file, signed_apk, key_spec)
+
+    def sign_prepared(self, apk_file, signed_apk, key_spec):
+        if self.output_cache is None:
+            return self.sign_uncached(apk_file, signed_apk, key_spec)
+        try:
+            key = self.output_cache_key(apk_file, key_spec)
+            method = self.output_cache.fetch(key, signed_apk)
+        except Exception as e:
+            return {'apk': apk_file, 'signed_apk': signed_apk, 'success': False, 'returncode': None, 'error': f"Output cache: {e}", 'engine': None, 'schemes': self.enabled_schemes()}
+        if method:
+            return {'apk': apk_file, 'signed_apk': signed_apk, 'success': True, 'returncode': 0, 'error': None, 'engine': 'cache', 'cached': method, 'schemes': self.enabled_schemes()}
+
+        detach_output(signed_apk)
+        result = self.sign_uncached(apk_file, signed_apk, key_spec)
+        if result['success']:
+            try:
+                self.output_cache.store(key, signed_apk)
+            except Exception as e:
+                result['cache_error'] = str(e)
+        return result
+
+    def sign_uncached(self, apk_file, signed_apk, key_spec):
+        result = {'apk': apk_file, 'signed_apk': signed_apk, 'success': False, 'returncode': None, 'error': None, 'engine': 'apksigner', 'schemes': self.enabled_schemes()}
+        if self.engine == 'native' and self.native_unsupported_reason(key_spec) is None:
+            try:
+                self.sign_native(apk_file, signed_apk, key_spec)
+                result.update({'success': True, 'returncode': 0, 'engine': 'native'})
+                return result
+            except (ImportError, NotImplementedError):
+                pass
+            except Exception as e:
+                result.update({'error': str(e), 'engine': 'native'})
+                return result
+        try:
+            cmd = self.build_command(apk_file, signed_apk, key_spec)
+            completed = run_tool(cmd, capture_output=True, apksigner_jar=self.apksigner_jar, timeout=self.timeout)
+            result['returncode'] = completed.returncode
+            if completed.returncode != 0:
+                result['error'] = (completed.stderr or completed.stdout).strip() or "Command execution failed."
+            else:
+                result['success'] = True
+        except Exception as e:
+            result['error'] = str(e)
+        return result
+
+    def checkpoint_inputs(self, apk_file, identity):
+        return {'apk': file_state(apk_file), 'signer': identity, 'schemes': self.enabled_schemes(), 'auto_schemes': self.auto_schemes}
+
+    @journal_batch()
+    def sign_many(self, apks, key_spec, schemes=None, workers=None, output_path=None, checkpoint=None):
+        self.set_schemes(schemes)
+        self.output_path = ensure_directory(output_path or self.output_path, caller='signer')
+        apks = [os.path.abspath(apk) for apk in apks]
+
+        signed_apks = [self.signed_apk_path(apk) for apk in apks]
+        duplicates = {path for path in signed_apks if signed_apks.count(path) > 1}
+        if duplicates:
+            raise ValueError(f"Multiple APKs would be written to the same output: {', '.join(sorted(duplicates))}")
+
+        checkpoint = (checkpoint or Checkpoint('sign', retries=0, enabled=False)).start(self.output_path)
+        identity = None
+        if checkpoint.enabled:
+            # Once per batch, not per APK
+            try:
+                identity = signer_identity(key_spec, self.lib_path)
+            except (OSError, ValueError):
+                # Reported by every APK, none of them completes
+                pass
+        workers = max(1, workers or os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=min(workers, len(apks) or 1)) as executor:
+            futures = [
+                executor.submit(
+                    checkpoint.run, apk, functools.partial(self.sign_one, apk, signed_apk, key_spec),
+                    functools.partial(self.checkpoint_inputs, apk, identity), lambda result: [result['signed_apk']]
+                )
+                for apk, signed_apk in zip(apks, signed_apks)
+            ]
+            results = [future.result() for future in futures]
+        for result in results:
+            if result.get('resumed'):
+                continue
+            record(
+                self.output_path, 'sign', apk=result['apk'], signed_apk=result['signed_apk'], keystore=key_spec.get('keystore') or key_spec.get('cert'),
+                alias=key_spec.get('alias'), key_type=key_spec.get('type'), engine=result['engine'], schemes=result['schemes'], success=result['success'], error=result['error']
+            )
+        return results
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import datetime
+import threading
+from .journal import Journal, cache_file_name
+from .trace import span
+
+DEFAULT_RETRIES = 0
+DEFAULT_BACKOFF = 1.0
+
+def checkpoint_dir():
+    return os.path.join(os.path.expanduser('~'), '.cache', 'keysigner', 'checkpoints')
+
+def default_checkpoint_path(operation, output_path):
+    # Kept out of the output directory, where it would be picked up with the deliverables; one per command and output directory
+    return os.path.join(checkpoint_dir(), cache_file_name(operation, output_path))
+
+def file_state(path):
+    # Size and mtime like make and rsync: a stat per file, where hashing would read multi-GB APKs again
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+class Checkpoint:
+    # Completed items of a batch, one JSON line per item: its key, the state of its inputs and of its outputs, and
+    # its result. Each line is written and fsynced as soon as the item is done, so after a crash a run with resume
+    # skips the finished items whose inputs are unchanged and whose outputs are still the ones it wrote.
+    # With retries, failed items are retried, waiting backoff, then twice as long, and so on, while the rest of the batch goes on.
+    def __init__(self, operation, path=None, resume=False, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, enabled=True):
+        self.operation = operation
+        self.path = os.path.abspath(path) if path else None
+        self.resume = resume
+        self.retries = max(0, retries)
+        self.backoff = backoff
+        self.enabled = enabled
+        self.done = {}
+        self.journal = None
+        self.lock = threading.Lock()
+        self.resumed = 0
+        self.retried = 0
+
+    def start(self, output_path):
+        # Called by the batch once its output directory is known, which selects the default checkpoint
+        if not self.enabled:
+            return self
+        if self.path is None:
+            self.path = default_checkpoint_path(self.operation, output_path)
+        self.done = self.load() if self.resume else {}
+        if not self.resume and os.path.exists(self.path):
+            os.remove(self.path)
+        # Unbuffered and never rotated: every completed item is on disk before the next one is reported
+        self.journal = Journal(self.path, max_size=sys.maxsize, backups=0, flush_records=1)
+        return self
+
+    def load(self):
+        done = {}
+        if not os.path.exists(self.path):
+            return done
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line of a run that was killed while writing it
+                    continue
+                if entry.get('operation') == self.operation:
+                    done[entry['key']] = entry
+        return done
+
+    def completed(self, key, inputs):
+        entry = self.done.get(key)
+        if entry is None or entry['inputs'] != inputs:
+            return None
+        for path, state in entry['outputs'].items():
+            try:
+                if file_state(path) != state:
+                    return None
+            except OSError:
+                return None
+        return entry
+
+    def run(self, key, run, inputs=None, outputs=None):
+        # run() returns a result with 'success', inputs() what identifies the work and outputs(result) its files
+        recording = self.enabled and self.journal is not None
+        item_inputs = {}
+        if recording and inputs is not None:
+            try:
+                with span('checkpoint inputs', 'io'):
+                    item_inputs = inputs()
+            except OSError:
+                # A missing input, run() reports it
+                item_inputs = None
+                recording = False
+            entry = self.completed(key, item_inputs) if self.resume and recording else None
+            if entry is not None:
+                with self.lock:
+                    self.resumed += 1
+                return dict(entry['result'], resumed=True)
+        attempt = 0
+        while True:
+            result = run()
+            if result['success'] or attempt >= self.retries:
+                break
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+            with self.lock:
+                self.retried += 1
+        if attempt:
+            result['attempts'] = attempt + 1
+        if result['success'] and recording:
+            self.complete(key, item_inputs, outputs(result) if outputs else [], result)
+        return result
+
+    def complete(self, key, inputs, outputs, result):
+        self.journal.append({
+            'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            'operation': self.operation,
+            'key': key,
+            'inputs': inputs,
+            'outputs': {os.path.abspath(path): file_state(path) for path in outputs},
+            'result': result,
+        })
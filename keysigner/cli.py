@@ -0,0 +1,759 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import signal
+import argparse
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from .apk_signer import APKSigner
+from .jvm_worker import enable_jvm_worker, run_tool
+from .pkcs12_to_pem import PKCS12ToPEM, BACKENDS
+from .pem_to_pkcs12 import PEMToPKCS12
+from .digest_cache import DigestCache, DEFAULT_MAX_ENTRIES
+from .output_cache import SignedOutputCache, DEFAULT_MAX_SIZE
+from .key_cache import KeyCache
+from .keystore_info import KeystoreInfo, format_keystore, BACKENDS as KEYSTORE_BACKENDS
+from .keystore_reader import KeystorePasswordError
+from .keystore_generator import BulkKeystoreGenerator, KeystoreBuilder
+from .keystore_writer import DEFAULT_VALIDITY, PKCS12_KEY_ENCRYPTIONS, PKCS12_CERT_ENCRYPTIONS, PKCS12_MACS
+from .job_runner import JobRunner, load_manifest
+from .keystore_migrator import BulkKeystoreMigrator, collect_keystores, write_migration_report, STORE_TYPES as KEYSTORE_STORE_TYPES
+from .signing_service import SigningService, SigningClient, create_server, parse_address, DEFAULT_ADDRESS, DEFAULT_QUEUE, DEFAULT_MAX_APK_SIZE
+from .keystore_index import KeystoreIndex, format_certificate
+from .spool_watcher import SpoolWatcher, DEFAULT_BATCH_WINDOW, DEFAULT_BATCH_SIZE, DEFAULT_POLL_INTERVAL, DEFAULT_SETTLE, METRICS_NAME
+from .checkpoint import Checkpoint, DEFAULT_RETRIES, DEFAULT_BACKOFF
+from .journal import read_journal, journal_files, default_journals, parse_time, format_entry, enable_timed_flush
+from .tool_runner import configure_tool_runner
+from .trace import Profiler, enable_tracing, disable_tracing, span
+from .utils import *
+
+def str_to_bool(value):
+    if isinstance(value, bool):
+        return value
+    if value.lower() in ['true', 't', 'yes', 'y', '1']:
+        return True
+    if value.lower() in ['false', 'f', 'no', 'n', '0']:
+        return False
+    raise argparse.ArgumentTypeError(f"Expected true or false, got '{value}'.")
+
+def parse_size(value):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    text = value.strip().upper().rstrip('B').rstrip('I')
+    try:
+        if text and text[-1] in units:
+            return int(float(text[:-1]) * units[text[-1]])
+        return int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected a size such as 500M or 5G, got '{value}'.")
+
+def collect_apks(paths):
+    apks = []
+    for path in paths:
+        if os.path.isdir(path):
+            apks.extend(sorted(os.path.join(path, name) for name in os.listdir(path) if name.lower().endswith('.apk')))
+        else:
+            apks.append(path)
+    return apks
+
+def add_signing_arguments(parser):
+    add_key_arguments(parser)
+    add_scheme_arguments(parser)
+
+def add_key_arguments(parser, required=True):
+    parser.add_argument('--key-type', choices=['jks', 'p12', 'pem', 'test'], required=required, help="Type of signing key")
+    parser.add_argument('--ks', help="Keystore path (jks/p12)")
+    parser.add_argument('--ks-pass', help="Keystore password: pass:<password>, env:<name> or file:<path>")
+    parser.add_argument('--ks-key-alias', help="Alias of the signing key (jks/p12)")
+    parser.add_argument('--key-pass', help="Alias password (jks, default: same as keystore password)")
+    parser.add_argument('--cert', help="x509 certificate path (pem)")
+    parser.add_argument('--key', help="PKCS8 private key path (pem)")
+
+def add_scheme_arguments(parser):
+    for version, default in [('v1', True), ('v2', True), ('v3', True), ('v4', False)]:
+        parser.add_argument(f'--{version}-signing-enabled', type=str_to_bool, default=default, metavar='true|false')
+
+def add_checkpoint_arguments(parser):
+    parser.add_argument('--resume', action='store_true', help="Skip the items a previous run completed, when their inputs and outputs are unchanged")
+    parser.add_argument('--checkpoint', metavar='PATH', help="Checkpoint of completed items (default: one per command and --out directory in ~/.cache/keysigner/checkpoints)")
+    parser.add_argument('--no-checkpoint', action='store_true', help="Do not record completed items")
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES, help=f"Times a failed item is retried (default: {DEFAULT_RETRIES})")
+    parser.add_argument('--retry-backoff', type=float, default=DEFAULT_BACKOFF, metavar='SECONDS', help=f"Wait before the first retry, doubled for each further retry (default: {DEFAULT_BACKOFF})")
+
+def checkpoint_from_args(args, operation):
+    if args.resume and args.no_checkpoint:
+        raise ValueError("--resume needs the checkpoint, remove --no-checkpoint.")
+    return Checkpoint(operation, args.checkpoint, args.resume, args.retries, args.retry_backoff, enabled=not args.no_checkpoint)
+
+def resumed_summary(checkpoint):
+    return f" ({checkpoint.resumed} already done)" if checkpoint.resumed else ''
+
+def attempts_summary(result):
+    return f" ({result['attempts']} attempts)" if result.get('attempts') else ''
+
+def key_spec_from_args(args):
+    key_spec = {'type': args.key_type}
+    if args.key_type in ['jks', 'p12']:
+        if not args.ks or not args.ks_key_alias:
+            raise ValueError("--ks and --ks-key-alias are required for jks/p12 keys.")
+        key_spec['keystore'] = os.path.abspath(args.ks)
+        key_spec['store_pass'] = read_secret(args.ks_pass, "Enter keystore password: ")
+        key_spec['alias'] = args.ks_key_alias
+        if args.key_type == 'jks':
+            key_spec['key_pass'] = read_secret(args.key_pass, "Enter alias password: ") if args.key_pass else key_spec['store_pass']
+    elif args.key_type == 'pem':
+        if not args.cert or not args.key:
+            raise ValueError("--cert and --key are required for pem keys.")
+        key_spec['cert'] = os.path.abspath(args.cert)
+        key_spec['key'] = os.path.abspath(args.key)
+    return key_spec
+
+def schemes_from_args(args):
+    return {
+        'v1': args.v1_signing_enabled,
+        'v2': args.v2_signing_enabled,
+        'v3': args.v3_signing_enabled,
+        'v4': args.v4_signing_enabled,
+    }
+
+def sign_batch(args):
+    apks = collect_apks(args.apks)
+    if not apks:
+        print_red("No APK files found.")
+        return 1
+
+    signer = APKSigner()
+    if args.engine:
+        signer.engine = args.engine
+    if args.digest_workers:
+        signer.digest_workers = args.digest_workers
+    if args.digest_cache:
+        signer.digest_cache = DigestCache(None if args.digest_cache == 'default' else args.digest_cache, args.digest_cache_entries, args.digest_cache_verify)
+    signer.auto_schemes = args.auto_schemes
+    if args.key_cache_ttl is not None:
+        signer.key_cache = KeyCache(args.key_cache_ttl) if args.key_cache_ttl > 0 else None
+    if args.output_cache:
+        signer.output_cache = SignedOutputCache(None if args.output_cache == 'default' else args.output_cache, args.output_cache_size)
+    if args.jvm_worker:
+        enable_jvm_worker(args.workers or 1, signer.apksigner_jar)
+    print_blue(f"\n--- Signing {len(apks)} APK(s) ---")
+    try:
+        checkpoint = checkpoint_from_args(args, 'sign')
+        results = signer.sign_many(apks, key_spec_from_args(args), schemes_from_args(args), workers=args.workers, output_path=args.out, checkpoint=checkpoint)
+    finally:
+        if signer.key_cache is not None:
+            signer.key_cache.clear()
+
+    failed = 0
+    for result in results:
+        if result['success']:
+            details = ([', '.join(result['schemes'])] if args.auto_schemes else []) + ([f"cached, {result['cached']}"] if result.get('cached') else [])
+            details += (['already signed'] if result.get('resumed') else []) + ([f"{result['attempts']} attempts"] if result.get('attempts') else [])
+            print_green(f"Signed: {result['signed_apk']}" + (f" ({'; '.join(details)})" if details else ''))
+            if result.get('cache_error'):
+                print_yellow(f"Could not store {result['signed_apk']} in the output cache: {result['cache_error']}")
+        else:
+            failed += 1
+            print_red(f"Failed: {result['apk']}: {result['error']}" + attempts_summary(result))
+
+    print_blue(f"\n{len(results) - failed} signed{resumed_summary(checkpoint)}, {failed} failed.")
+    if signer.digest_cache is not None:
+        stats = signer.digest_cache.stats()
+        print_blue(f"Digest cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%}), {stats['entries']} entries in {stats['path']}")
+        if stats['skipped']:
+            print_yellow(f"Digest cache not used for {stats['skipped']} APK(s): keys with SHA-256 content digests (RSA up to 3072 bits, EC P-256) are digested as fast as the cache could look them up.")
+        if stats['mismatches']:
+            failed += 1
+            print_red(f"Digest cache returned {stats['mismatches']} stale digest(s), uncached digests were used instead.")
+    if signer.output_cache is not None:
+        print_output_cache_stats(signer.output_cache.stats())
+    return 1 if failed else 0
+
+def print_output_cache_stats(stats):
+    usage = f"{stats['entries']} outputs, {stats['size'] / 1048576:.1f} of {stats['max_size'] / 1048576:.0f} MiB in {stats['path']}"
+    if stats['hits'] or stats['misses']:
+        print_blue(f"Output cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%}), {usage}")
+    else:
+        print_blue(f"Output cache: {usage}")
+
+def cache_command(args):
+    cache = SignedOutputCache(args.path, args.max_size)
+    if args.action == 'prune':
+        removed = cache.prune(0 if args.all else None)
+        print_green(f"Removed {removed} cached output(s).")
+    print_output_cache_stats(cache.stats())
+    return 0
+
+def keystore_info(args):
+    info = KeystoreInfo(args.backend)
+    if args.json and info.backend == 'keytool':
+        raise ValueError("--json needs the native backend, keytool only prints text.")
+    store_pass = read_secret(args.ks_pass, "Enter keystore password: ")
+    results = []
+    failed = 0
+    for path in args.keystores:
+        if info.backend == 'native':
+            try:
+                keystore = info.read(path, store_pass, args.store_type)
+            except Exception as e:
+                if args.json:
+                    failed += 1
+                    results.append({'path': os.path.abspath(path), 'error': str(e)})
+                elif isinstance(e, (KeystorePasswordError, OSError)) or args.no_fallback:
+                    failed += 1
+                    print_red(f"{path}: {e}")
+                else:
+                    # Formats or algorithms the reader does not handle are left to keytool
+                    print_yellow(f"{path}: {e}, falling back to keytool.")
+                    failed += keystore_info_keytool(info, path, store_pass, args.store_type) != 0
+                continue
+            results.append(keystore.to_dict())
+            if not args.json:
+                print_blue(f"\n--- {path} ---")
+                print(format_keystore(keystore))
+        else:
+            failed += keystore_info_keytool(info, path, store_pass, args.store_type) != 0
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    return 1 if failed else 0
+
+def keystore_info_keytool(info, path, store_pass, store_type):
+    info.keystore_path = path
+    info.store_pass = store_pass
+    info.keystore_type = (store_type or '').upper()
+    if not info.keystore_type:
+        info.determine_keystore_type()
+    print_blue(f"\n--- keytool: {path} ---")
+    return run_tool(info.keytool_command()).returncode
+
+def generate_keystores(args):
+    generator = BulkKeystoreGenerator(args.store_type, key_algorithm=args.key_alg, validity=args.validity, output_path=args.out, backend=args.backend)
+    specs = generator.load_specs(args.specs)
+    if not specs:
+        print_red("No keystores listed.")
+        return 1
+    if args.ks_pass or any(not spec.get('store_pass') for spec in specs):
+        generator.store_pass = read_secret(args.ks_pass, "Enter keystore password: ")
+    if args.key_pass:
+        generator.key_pass = read_secret(args.key_pass, "Enter alias password: ")
+    if args.jvm_worker:
+        enable_jvm_worker(args.workers or 1)
+    print_blue(f"\n--- Generating {len(specs)} keystore(s) ---")
+    checkpoint = checkpoint_from_args(args, 'generate')
+    results = generator.generate_many(specs, workers=args.workers, checkpoint=checkpoint)
+
+    failed = 0
+    for result in results:
+        if result['success']:
+            print_green(f"{'Already generated' if result.get('resumed') else 'Generated'}: {result['path']} ({result['alias']}, {result['key_algorithm']})")
+        else:
+            failed += 1
+            print_red(f"Failed: {result['name']}: {result['error']}" + attempts_summary(result))
+    print_blue(f"\n{len(results) - failed} generated{resumed_summary(checkpoint)}, {failed} failed.")
+    if args.report:
+        write_json(args.report, {'generated': len(results) - failed, 'failed': failed, 'results': results})
+        print_blue(f"Report written to {os.path.abspath(args.report)}")
+    return 1 if failed else 0
+
+def migrate_keystores(args):
+    keystores = collect_keystores(args.keystores)
+    if not keystores:
+        print_red("No keystore files found.")
+        return 1
+
+    store_pass = read_secret(args.ks_pass, "Enter source keystore password: ")
+    migrator = BulkKeystoreMigrator(
+        args.dest_type,
+        store_pass,
+        dest_store_pass=read_secret(args.dest_pass, "Enter destination keystore password: ") if args.dest_pass else None,
+        src_key_pass=read_secret(args.key_pass, "Enter source alias password: ") if args.key_pass else None,
+        dest_key_pass=read_secret(args.dest_key_pass, "Enter destination alias password: ") if args.dest_key_pass else None,
+        aliases=args.alias,
+        output_path=args.out
+    )
+    if args.jvm_worker:
+        enable_jvm_worker(args.workers or 1)
+    print_blue(f"\n--- Migrating {len(keystores)} keystore(s) to {migrator.dest_store_type} ---")
+    checkpoint = checkpoint_from_args(args, 'migrate')
+    results = migrator.migrate_many(keystores, workers=args.workers, checkpoint=checkpoint)
+
+    failed = 0
+    for result in results:
+        if result['success']:
+            print_green(f"{'Already migrated' if result.get('resumed') else 'Migrated'}: {result['destination']} ({len(result['aliases'])} alias(es): {', '.join(result['aliases'])})")
+        else:
+            failed += 1
+            print_red(f"Failed: {result['source']}: {result['error']}" + attempts_summary(result))
+    print_blue(f"\n{len(results) - failed} migrated{resumed_summary(checkpoint)}, {failed} failed.")
+    if args.report:
+        write_migration_report(results, args.report)
+        print_blue(f"Report written to {os.path.abspath(args.report)}")
+    return 1 if failed else 0
+
+def run_jobs(args):
+    manifest = load_manifest(args.manifest)
+    state_path = None if args.no_state else (args.state or f"{args.manifest}.state.json")
+    runner = JobRunner(manifest, concurrency=args.concurrency, state_path=state_path, force=args.force)
+    print_blue(f"\n--- Running {len(runner.jobs)} job(s), up to {runner.concurrency} at a time ---")
+    results = runner.run()
+
+    counts = {status: sum(1 for result in results if result['status'] == status) for status in ['done', 'reused', 'failed', 'skipped']}
+    print_blue(f"\n{counts['done']} done, {counts['reused']} reused, {counts['failed']} failed, {counts['skipped']} skipped.")
+    if args.report:
+        write_json(args.report, {'results': results, **counts})
+        print_blue(f"Report written to {os.path.abspath(args.report)}")
+    return 1 if counts['failed'] or counts['skipped'] else 0
+
+def export_pem(args):
+    converter = PKCS12ToPEM(args.backend)
+    checkpoint = checkpoint_from_args(args, 'export')
+    results = converter.export_many(args.p12, read_secret(args.ks_pass, "Enter keystore password: "), args.out, args.all, args.workers, checkpoint)
+    failed = 0
+    for result in results:
+        if not result['success']:
+            failed += 1
+            print_red(f"Failed: {result['keystore']}: {result['error']}" + attempts_summary(result))
+            continue
+        print_blue(f"\n{result['keystore']}" + (" (already exported)" if result.get('resumed') else ''))
+        if args.all:
+            for entry in result['entries']:
+                print_green(f"{entry['alias']}: " + ", ".join(path for path in [entry['cert'], entry['chain'], entry['key']] if path))
+        else:
+            print_green(f"x509 certificate: {result['outputs'][0]}")
+            print_green(f"Private key (PKCS8 format): {result['outputs'][1]}")
+    print_blue(f"\n{len(results) - failed} exported{resumed_summary(checkpoint)}, {failed} failed.")
+    return 1 if failed else 0
+
+def import_pem(args):
+    options = {}
+    for name in ['key_encryption', 'cert_encryption', 'iterations', 'mac', 'mac_iterations']:
+        if getattr(args, name) is not None:
+            options[name] = getattr(args, name)
+    converter = PEMToPKCS12(args.backend, options)
+    store_pass = read_secret(args.ks_pass, "Enter keystore password: ")
+    aliases = converter.export(args.entry, args.out, store_pass, append=args.append)
+    print_green(f"PKCS12 keystore written to {os.path.abspath(args.out)} with {len(aliases)} entries: {', '.join(aliases)}")
+    return 0
+
+def build_keystore(args):
+    options = {}
+    for name in ['key_encryption', 'cert_encryption', 'iterations', 'mac', 'mac_iterations']:
+        if getattr(args, name) is not None:
+            options[name] = getattr(args, name)
+    builder = KeystoreBuilder(args.store_type, key_algorithm=args.key_alg, validity=args.validity, options=options, workers=args.workers)
+    entries = builder.load_entries(args.entries) if args.entries else []
+    entries.extend({'alias': alias, 'dname': dname} for alias, dname in args.entry or [])
+    if not entries:
+        raise ValueError("Give the entries with --entry ALIAS DNAME or --entries FILE.")
+    builder.store_pass = read_secret(args.ks_pass, "Enter keystore password: ")
+    key_passes = {alias: read_secret(value, f"Enter alias password of '{alias}': ") for alias, value in args.key_pass or []}
+    result = builder.build(args.keystore, entries, append=args.append, key_passes=key_passes)
+    for entry in result['entries']:
+        print_green(f"Generated: {entry['alias']} ({entry['key_algorithm']}) SHA-256 {entry['sha256']}")
+    kept = f", {len(result['kept'])} kept" if result['kept'] else ''
+    print_blue(f"\n{result['store_type']} keystore written to {result['path']} with {len(result['entries'])} new entries{kept}.")
+    if args.report:
+        write_json(args.report, result)
+        print_blue(f"Report written to {os.path.abspath(args.report)}")
+    return 0
+
+def load_service_keys(args):
+    # Named key specs of a JSON file ({"release": {"type": "jks", ...}}) and/or the key given on the command line
+    keys = {}
+    if args.keys:
+        with open(args.keys, 'r') as f:
+            specs = json.load(f)
+        for name, key_spec in specs.items():
+            key_spec = dict(key_spec)
+            for key in ['keystore', 'cert', 'key']:
+                if key_spec.get(key):
+                    key_spec[key] = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(args.keys)), key_spec[key]))
+            for key, prompt in [('store_pass', f"Enter keystore password of '{name}': "), ('key_pass', f"Enter alias password of '{name}': ")]:
+                if key in key_spec:
+                    key_spec[key] = read_secret(key_spec[key], prompt)
+            keys[name] = key_spec
+    if args.key_type:
+        keys[args.key_name] = key_spec_from_args(args)
+    if not keys:
+        raise ValueError("Give a key with --key-type or a key file with --keys.")
+    return keys
+
+def serve(args):
+    token = read_secret(args.token, "Enter service token: ") if args.token else None
+    service = SigningService(load_service_keys(args), args.workers, args.queue, args.max_apk_size, token, args.digest_workers or 1)
+    try:
+        server = create_server(service, args.listen, args.verbose)
+    except Exception:
+        service.close()
+        raise
+    kind, location = parse_address(args.listen)
+    print_green(f"Signing service listening on {args.listen} with {args.workers or os.cpu_count()} workers, keys: {', '.join(sorted(service.keys))}")
+    # Requests are not batches, their journal records are written together every second
+    enable_timed_flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print_blue("\nSigning service stopped.")
+    finally:
+        server.server_close()
+        service.close()
+        if kind == 'unix' and os.path.exists(location):
+            os.remove(location)
+    return 0
+
+def remote_sign(args):
+    apks = [os.path.abspath(apk) for apk in collect_apks(args.apks)]
+    if not apks:
+        print_red("No APK files found.")
+        return 1
+    output_path = ensure_directory(args.out, caller='signer')
+    signed_apks = [os.path.join(output_path, f"{os.path.splitext(os.path.basename(apk))[0]}_signed.apk") for apk in apks]
+    duplicates = {path for path in signed_apks if signed_apks.count(path) > 1}
+    if duplicates:
+        raise ValueError(f"Multiple APKs would be written to the same output: {', '.join(sorted(duplicates))}")
+
+    client = SigningClient(args.server, read_secret(args.token, "Enter service token: ") if args.token else None)
+    schemes = schemes_from_args(args)
+
+    def sign(apk, signed_apk):
+        try:
+            mode = client.sign(args.remote_key, apk, signed_apk, schemes, args.mode, args.digest_workers or 1)
+            return {'apk': apk, 'signed_apk': signed_apk, 'success': True, 'mode': mode, 'error': None}
+        except Exception as e:
+            return {'apk': apk, 'signed_apk': signed_apk, 'success': False, 'mode': args.mode, 'error': str(e)}
+
+    print_blue(f"\n--- Signing {len(apks)} APK(s) with {args.server} ---")
+    with ThreadPoolExecutor(max_workers=max(1, min(args.workers or 1, len(apks)))) as executor:
+        results = list(executor.map(sign, apks, signed_apks))
+
+    failed = 0
+    for result in results:
+        if result['success']:
+            print_green(f"Signed: {result['signed_apk']} ({result['mode']})")
+        else:
+            failed += 1
+            print_red(f"Failed: {result['apk']}: {result['error']}")
+    print_blue(f"\n{len(results) - failed} signed, {failed} failed.")
+    return 1 if failed else 0
+
+def watch(args):
+    signer = APKSigner()
+    if args.engine:
+        signer.engine = args.engine
+    if args.digest_workers:
+        signer.digest_workers = args.digest_workers
+    signer.auto_schemes = args.auto_schemes
+    signer.set_schemes(schemes_from_args(args))
+    # Unlocked once and kept while the daemon runs, a replaced keystore is unlocked again
+    ttl = args.key_cache_ttl if args.key_cache_ttl is not None else float('inf')
+    signer.key_cache = KeyCache(ttl) if ttl > 0 else None
+    if args.jvm_worker:
+        enable_jvm_worker(args.workers or 1, signer.apksigner_jar)
+    watcher = SpoolWatcher(
+        signer, key_spec_from_args(args), args.spool, args.out, args.failed, args.processed, args.workers,
+        args.batch_window, args.batch_size, args.retries, args.retry_backoff,
+        args.poll, args.poll_interval, args.settle, args.metrics, args.once
+    )
+    enable_timed_flush()
+    # The batch being signed is finished, queued APKs stay in the spool directory
+    signal.signal(signal.SIGTERM, lambda signum, frame: watcher.stop.set())
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+    counts = watcher.counts
+    print_blue(f"\nWatcher stopped: {counts['signed']} signed, {counts['failed']} failed in {counts['batches']} batch(es).")
+    return 1 if args.once and counts['failed'] else 0
+
+def query_journal(args):
+    paths = args.journals or default_journals()
+    if not journal_files(paths):
+        print_yellow(f"No journal found at {', '.join(args.journals or []) or 'KEYSIGNER_JOURNAL or ~/.cache/keysigner/journal'}.")
+        return 1
+    since = parse_time(args.since) if args.since else None
+    until = parse_time(args.until) if args.until else None
+    entries = list(read_journal(paths, args.keystore, args.alias, since, until, args.event))
+    if len(paths) > 1:
+        # Several journals: one timeline
+        entries.sort(key=lambda entry: entry['time'])
+    if args.limit:
+        entries = entries[-args.limit:]
+    for entry in entries:
+        print(json.dumps(entry) if args.json else format_entry(entry))
+    return 0
+
+def keystore_index(args):
+    index = KeystoreIndex(args.index)
+    if args.action == 'refresh':
+        if not args.paths:
+            raise ValueError("refresh needs the directories or keystores to scan.")
+        passwords = [read_secret(value, "Enter keystore password: ") for value in args.ks_pass or []]
+        stats = index.refresh(args.paths, passwords, args.workers, args.full)
+        print_green(
+            f"Indexed {stats['files']} file(s): {stats['parsed']} parsed, {stats['unchanged'] + stats['touched']} unchanged "
+            f"({stats['touched']} rehashed), {stats['removed']} removed."
+        )
+        if stats['locked'] or stats['errors']:
+            print_yellow(f"{stats['locked']} locked (no matching --ks-pass), {stats['errors']} unreadable, see 'keysigner index status'.")
+        return 0
+    if args.paths:
+        raise ValueError(f"{args.action} takes no paths, use --under to search below a directory.")
+
+    if args.action == 'status':
+        stats = index.stats()
+        problems = index.files(['locked', 'error'])
+        if args.json:
+            json.dump({'index': stats, 'problems': problems}, sys.stdout, indent=2)
+            print()
+            return 0
+        print_blue(f"Index: {stats['path']} ({stats['size'] / 1048576:.1f} MiB)")
+        print(f"{stats['files']} file(s), {stats['certificates']} certificate(s): " + ", ".join(f"{count} {status}" for status, count in sorted(stats['statuses'].items())))
+        for problem in problems:
+            print_yellow(f"{problem['status']}: {problem['path']}: {problem['error']}")
+        return 0
+
+    rows = index.find(
+        sha256=args.sha256, sha1=args.sha1, alias=args.alias, subject=args.subject,
+        expires_before=parse_time(args.expires_before, future=True) if args.expires_before else None,
+        expires_after=parse_time(args.expires_after, future=True) if args.expires_after else None,
+        roots=args.under, leaf_only=args.leaf,
+    )
+    if args.json:
+        json.dump(rows, sys.stdout, indent=2)
+        print()
+    else:
+        for row in rows:
+            print(format_certificate(row))
+        print_blue(f"{len(rows)} certificate(s) found.")
+    return 0 if rows else 1
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='keysigner', description="Keystore management and APK signing for Android developers.")
+    parser.add_argument('--trace', metavar='PATH', help="Record the time spent in each stage and write it in Chrome trace format (chrome://tracing, Perfetto)")
+    parser.add_argument('--profile', action='store_true', help="Print the functions taking the most time and the largest allocations when done")
+    parser.add_argument('--tool-timeout', type=float, metavar='SECONDS', help="Kill a keytool, apksigner or openssl call that runs longer than this, including in JVM workers (default: KEYSIGNER_TOOL_TIMEOUT, none)")
+    # Without a command, --trace, --profile and --tool-timeout apply to the interactive menu
+    subparsers = parser.add_subparsers(dest='command')
+
+    batch = subparsers.add_parser('sign-batch', help="Sign many APKs non-interactively")
+    batch.add_argument('apks', nargs='+', help="APK files or directories containing APK files")
+    add_signing_arguments(batch)
+    batch.add_argument('--out', help="Output directory (default: ./signed_apks)")
+    batch.add_argument('--workers', type=int, default=os.cpu_count(), help="Maximum number of concurrent apksigner processes")
+    batch.add_argument('--engine', choices=['apksigner', 'native'], help="Signing engine (default: apksigner). native signs v1/v2/v3 in-process and falls back to apksigner when v4 is requested")
+    batch.add_argument('--digest-workers', type=int, help="Threads hashing the chunks of each APK with the native engine (default: 1)")
+    batch.add_argument('--digest-cache', nargs='?', const='default', metavar='PATH', help="Reuse SHA-512 chunk digests of previous runs (native engine, RSA above 3072 bits and EC above P-256 only, other keys are signed without it), default path: ~/.cache/keysigner/digest_cache.sqlite")
+    batch.add_argument('--digest-cache-entries', type=int, default=DEFAULT_MAX_ENTRIES, help="Maximum number of cached chunk digests (LRU eviction)")
+    batch.add_argument('--digest-cache-verify', action='store_true', help="Also digest without the cache and check both signatures would be identical")
+    batch.add_argument('--auto-schemes', action='store_true', help="Pick the smallest scheme set for each APK's minSdkVersion (overrides --v1/--v2/--v3-signing-enabled)")
+    batch.add_argument('--output-cache', nargs='?', const='default', metavar='PATH', help="Reuse signed outputs of identical inputs, keys and schemes, default path: ~/.cache/keysigner/signed")
+    batch.add_argument('--output-cache-size', type=parse_size, default=DEFAULT_MAX_SIZE, metavar='SIZE', help="Size cap of the output cache, e.g. 5G (LRU eviction)")
+    batch.add_argument('--key-cache-ttl', type=int, metavar='SECONDS', help="Keep keys unlocked by the native engine for this long, 0 unlocks the keystore for every APK (default: 300)")
+    batch.add_argument('--jvm-worker', action='store_true', help="Run apksigner in resident JVM workers instead of one JVM per APK")
+    add_checkpoint_arguments(batch)
+    batch.set_defaults(func=sign_batch)
+
+    service = subparsers.add_parser('serve', help="Run a local signing service that keeps keys unlocked in memory")
+    add_key_arguments(service, required=False)
+    service.add_argument('--key-name', default='default', help="Name of the --key-type key in the service (default: default)")
+    service.add_argument('--keys', metavar='FILE', help="JSON file of named key specs: {\"release\": {\"type\": \"jks\", \"keystore\": ..., \"store_pass\": \"env:KS_PASS\", \"alias\": ...}}")
+    service.add_argument('--listen', default=DEFAULT_ADDRESS, help=f"host:port or unix:<socket path> (default: {DEFAULT_ADDRESS})")
+    service.add_argument('--workers', type=int, default=os.cpu_count(), help="Maximum number of requests signed at once")
+    service.add_argument('--queue', type=int, default=DEFAULT_QUEUE, help=f"Requests waiting for a worker before new ones are refused with 503 (default: {DEFAULT_QUEUE})")
+    service.add_argument('--max-apk-size', type=parse_size, default=DEFAULT_MAX_APK_SIZE, metavar='SIZE', help="Largest APK accepted for upload, e.g. 500M (default: 2G)")
+    service.add_argument('--digest-workers', type=int, help="Threads hashing the chunks of each uploaded APK (default: 1)")
+    service.add_argument('--token', help="Require this bearer token, mandatory for TCP addresses: pass:<token>, env:<name> or file:<path>")
+    service.add_argument('--verbose', action='store_true', help="Log every request")
+    service.set_defaults(func=serve)
+
+    remote = subparsers.add_parser('remote-sign', help="Sign APKs with a key of a keysigner signing service")
+    remote.add_argument('apks', nargs='+', help="APK files or directories containing APK files")
+    remote.add_argument('--server', default=os.environ.get('KEYSIGNER_SERVICE', DEFAULT_ADDRESS), help="Service address, host:port or unix:<socket path> (default: KEYSIGNER_SERVICE or 127.0.0.1:8470)")
+    remote.add_argument('--remote-key', default='default', help="Name of the key in the service (default: default)")
+    remote.add_argument('--mode', choices=['auto', 'digest', 'apk'], default='auto', help="digest: hash locally and send only digests (v2/v3), apk: upload the APK, auto: apk when v1 is enabled")
+    remote.add_argument('--token', help="Bearer token of the service: pass:<token>, env:<name> or file:<path>")
+    remote.add_argument('--out', help="Output directory (default: ./signed_apks)")
+    remote.add_argument('--workers', type=int, default=os.cpu_count(), help="Maximum number of APKs signed at once")
+    remote.add_argument('--digest-workers', type=int, help="Threads hashing the chunks of each APK in digest mode (default: 1)")
+    add_scheme_arguments(remote)
+    remote.set_defaults(func=remote_sign)
+
+    spool = subparsers.add_parser('watch', help="Sign the APKs dropped into a spool directory as they arrive")
+    spool.add_argument('spool', help="Spool directory, APKs are taken once written (closed or renamed into it)")
+    add_signing_arguments(spool)
+    spool.add_argument('--out', help="Output directory of signed APKs (default: ./signed_apks)")
+    spool.add_argument('--failed', help="Where APKs that could not be signed are moved, with <name>.error.json (default: ./failed_apks)")
+    spool.add_argument('--processed', help="Move signed inputs here instead of deleting them")
+    spool.add_argument('--workers', type=int, default=os.cpu_count(), help="Maximum number of APKs of a batch signed concurrently")
+    spool.add_argument('--engine', choices=['apksigner', 'native'], help="Signing engine (default: apksigner). native keeps the key unlocked in memory")
+    spool.add_argument('--digest-workers', type=int, help="Threads hashing the chunks of each APK with the native engine (default: 1)")
+    spool.add_argument('--auto-schemes', action='store_true', help="Pick the smallest scheme set for each APK's minSdkVersion")
+    spool.add_argument('--key-cache-ttl', type=int, metavar='SECONDS', help="native: unlock the key again after this long (default: keep it while running)")
+    spool.add_argument('--jvm-worker', action='store_true', help="Run apksigner in resident JVM workers instead of one JVM per APK")
+    spool.add_argument('--batch-window', type=float, default=DEFAULT_BATCH_WINDOW, metavar='SECONDS', help=f"Wait after the first arrival so that others join its batch (default: {DEFAULT_BATCH_WINDOW})")
+    spool.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help=f"Largest batch, a full batch is signed without waiting (default: {DEFAULT_BATCH_SIZE})")
+    spool.add_argument('--retries', type=int, default=0, help="Times a failed APK is retried before it is moved to --failed (default: 0)")
+    spool.add_argument('--retry-backoff', type=float, default=DEFAULT_BACKOFF, metavar='SECONDS', help=f"Wait before the first retry, doubled for each further retry (default: {DEFAULT_BACKOFF})")
+    spool.add_argument('--poll', action='store_true', help="Poll the directory instead of using inotify, e.g. on NFS or SMB shares")
+    spool.add_argument('--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL, metavar='SECONDS', help=f"Time between directory listings when polling (default: {DEFAULT_POLL_INTERVAL})")
+    spool.add_argument('--settle', type=float, default=DEFAULT_SETTLE, metavar='SECONDS', help=f"When polling, an APK is complete once unchanged for this long (default: {DEFAULT_SETTLE})")
+    spool.add_argument('--metrics', metavar='PATH', help=f"Queue depth and throughput file, JSON or Prometheus text for a .prom path (default: <out>/{METRICS_NAME})")
+    spool.add_argument('--once', action='store_true', help="Sign the APKs in the spool directory and exit")
+    spool.set_defaults(func=watch)
+
+    export = subparsers.add_parser('export-pem', help="Extract the x509 certificate and PKCS8 key from a PKCS12 keystore")
+    export.add_argument('p12', nargs='+', help="PKCS12 keystore paths")
+    export.add_argument('--ks-pass', help="Keystore password: pass:<password>, env:<name> or file:<path>")
+    export.add_argument('--out', help="Output directory (default: ./keystore)")
+    export.add_argument('--all', action='store_true', help="Export every entry: <alias>.x509.pem, <alias>.pk8 and <alias>.chain.pem (native backend)")
+    export.add_argument('--workers', type=int, help="Keystores, and with --all their entries, decrypted and written at once (default: CPU count)")
+    export.add_argument('--backend', choices=BACKENDS, help="native (in-process, needs cryptography) or openssl (default: native when available)")
+    add_checkpoint_arguments(export)
+    export.set_defaults(func=export_pem)
+
+    pem = subparsers.add_parser('import-pem', help="Build a PKCS12 keystore from x509 certificates and PKCS8 keys")
+    pem.add_argument('--entry', nargs=3, action='append', required=True, metavar=('ALIAS', 'CERT', 'KEY'), help="Alias, certificate (PEM chain or DER) and PKCS8 key of an entry, repeat for several entries")
+    pem.add_argument('--out', required=True, help="PKCS12 keystore path")
+    pem.add_argument('--ks-pass', help="Keystore password: pass:<password>, env:<name> or file:<path>")
+    pem.add_argument('--append', action='store_true', help="Keep the entries of an existing keystore at --out")
+    pem.add_argument('--key-encryption', choices=PKCS12_KEY_ENCRYPTIONS, type=str.upper, help="Private key encryption (default: AES-256)")
+    pem.add_argument('--cert-encryption', choices=PKCS12_CERT_ENCRYPTIONS, type=str.upper, help="Certificate encryption (default: AES-256)")
+    pem.add_argument('--iterations', type=int, help="PBE iteration count (default: 10000)")
+    pem.add_argument('--mac', choices=PKCS12_MACS, type=str.upper, help="Integrity MAC digest (default: SHA256)")
+    pem.add_argument('--mac-iterations', type=int, help="MAC iteration count (default: 10000)")
+    pem.add_argument('--backend', choices=BACKENDS, help="native (in-process, needs cryptography) or openssl (one entry, default: native when available)")
+    pem.set_defaults(func=import_pem)
+
+    generate = subparsers.add_parser('generate-batch', help="Generate many keystores from a CSV or JSON list")
+    generate.add_argument('specs', help="CSV (header row) or JSON list of keystores: name, alias, dname, store_type, store_pass, key_pass, key_algorithm, validity")
+    generate.add_argument('--store-type', choices=KEYSTORE_STORE_TYPES, type=str.upper, default='PKCS12', help="Keystore type when the list gives none (default: PKCS12)")
+    generate.add_argument('--key-alg', default='RSA-2048', help="Key algorithm when the list gives none: RSA-2048, RSA-3072, RSA-4096, EC-P256, EC-P384 or EC-P521")
+    generate.add_argument('--validity', type=int, default=DEFAULT_VALIDITY, help="Validity in days when the list gives none")
+    generate.add_argument('--ks-pass', help="Keystore password when the list gives none: pass:<password>, env:<name> or file:<path>")
+    generate.add_argument('--key-pass', help="Alias password (jks/bks, default: same as keystore password)")
+    generate.add_argument('--out', help="Output directory (default: ./keystore)")
+    generate.add_argument('--workers', type=int, default=os.cpu_count(), help="Number of key generation processes")
+    generate.add_argument('--backend', choices=KEYSTORE_BACKENDS, help="native (in-process, needs cryptography) or keytool (default: native, or KEYSIGNER_KEYSTORE_BACKEND)")
+    generate.add_argument('--report', metavar='PATH', help="Write per-keystore results as JSON")
+    generate.add_argument('--jvm-worker', action='store_true', help="keytool backend: run keytool in resident JVM workers")
+    add_checkpoint_arguments(generate)
+    generate.set_defaults(func=generate_keystores)
+
+    build = subparsers.add_parser('build-keystore', help="Generate one keystore holding several key entries, written once")
+    build.add_argument('keystore', help="Keystore path, the type follows the extension (.jks, .bks, .p12) unless --store-type is given")
+    build.add_argument('--entry', nargs=2, action='append', metavar=('ALIAS', 'DNAME'), help="Alias and distinguished name of an entry with the default key algorithm, repeat for several entries")
+    build.add_argument('--entries', metavar='FILE', help="CSV (header row) or JSON list of entries: alias, dname, key_algorithm, validity, key_pass (jks/bks)")
+    build.add_argument('--store-type', choices=KEYSTORE_STORE_TYPES, type=str.upper, help="Keystore type (default: from the extension, else PKCS12)")
+    build.add_argument('--ks-pass', help="Keystore password, and alias password of entries without one: pass:<password>, env:<name> or file:<path>")
+    build.add_argument('--key-alg', default='RSA-2048', help="Key algorithm of entries without one: RSA-2048, RSA-3072, RSA-4096, EC-P256, EC-P384 or EC-P521")
+    build.add_argument('--validity', type=int, default=DEFAULT_VALIDITY, help="Validity in days of entries without one")
+    build.add_argument('--append', action='store_true', help="Add the entries to an existing keystore, its entries are kept")
+    build.add_argument('--key-pass', nargs=2, action='append', metavar=('ALIAS', 'PASS'), help="--append: alias password of an existing jks/bks entry whose password differs from the keystore password, repeatable")
+    build.add_argument('--workers', type=int, default=os.cpu_count(), help="Number of key generation processes")
+    build.add_argument('--key-encryption', choices=PKCS12_KEY_ENCRYPTIONS, type=str.upper, help="PKCS12 private key encryption (default: AES-256)")
+    build.add_argument('--cert-encryption', choices=PKCS12_CERT_ENCRYPTIONS, type=str.upper, help="PKCS12 certificate encryption (default: AES-256)")
+    build.add_argument('--iterations', type=int, help="PKCS12 PBE iteration count (default: 10000)")
+    build.add_argument('--mac', choices=PKCS12_MACS, type=str.upper, help="PKCS12 integrity MAC digest (default: SHA256)")
+    build.add_argument('--mac-iterations', type=int, help="PKCS12 MAC iteration count (default: 10000)")
+    build.add_argument('--report', metavar='PATH', help="Write the aliases, key algorithms and certificate fingerprints as JSON")
+    build.set_defaults(func=build_keystore)
+
+    migrate = subparsers.add_parser('migrate', help="Migrate all or selected aliases of many keystores to another keystore type")
+    migrate.add_argument('keystores', nargs='+', help="Keystore files or directories containing keystores")
+    migrate.add_argument('--dest-type', choices=KEYSTORE_STORE_TYPES, type=str.upper, required=True, help="Destination keystore type")
+    migrate.add_argument('--out', help="Output directory (default: ./keystore)")
+    migrate.add_argument('--alias', action='append', help="Alias to migrate, can be repeated (default: all aliases)")
+    migrate.add_argument('--ks-pass', help="Source keystore password: pass:<password>, env:<name> or file:<path>")
+    migrate.add_argument('--key-pass', help="Source alias password (jks/bks, default: same as keystore password)")
+    migrate.add_argument('--dest-pass', help="Destination keystore password (default: same as source)")
+    migrate.add_argument('--dest-key-pass', help="Destination alias password (jks/bks, default: same as source alias password)")
+    migrate.add_argument('--workers', type=int, default=os.cpu_count(), help="Maximum number of keystores migrated concurrently")
+    migrate.add_argument('--report', metavar='PATH', help="Write per-keystore results as JSON")
+    migrate.add_argument('--jvm-worker', action='store_true', help="Run keytool in resident JVM workers instead of one JVM per run")
+    add_checkpoint_arguments(migrate)
+    migrate.set_defaults(func=migrate_keystores)
+
+    run = subparsers.add_parser('run', help="Run a manifest of keystore and signing jobs with dependencies")
+    run.add_argument('manifest', help="YAML (needs PyYAML) or JSON manifest")
+    run.add_argument('--concurrency', type=int, help="Maximum number of jobs running at once (default: manifest 'concurrency' or CPU count)")
+    run.add_argument('--state', metavar='PATH', help="Where finished jobs are recorded for reuse (default: <manifest>.state.json)")
+    run.add_argument('--no-state', action='store_true', help="Run every job, without reading or writing the state file")
+    run.add_argument('--force', action='store_true', help="Ignore previous outputs and run every job again, replacing keystores recorded in the state file")
+    run.add_argument('--report', metavar='PATH', help="Write per-job results as JSON")
+    run.set_defaults(func=run_jobs)
+
+    info = subparsers.add_parser('info', help="List the entries of JKS, BKS and PKCS12 keystores")
+    info.add_argument('keystores', nargs='+', help="Keystore paths")
+    info.add_argument('--ks-pass', help="Keystore password: pass:<password>, env:<name> or file:<path>")
+    info.add_argument('--store-type', choices=['JKS', 'BKS', 'PKCS12'], type=str.upper, help="Expected keystore type (default: detected from the file)")
+    info.add_argument('--json', action='store_true', help="Print the entries, certificate chains and fingerprints as JSON")
+    info.add_argument('--backend', choices=KEYSTORE_BACKENDS, help="native (in-process, needs cryptography) or keytool (default: native, or KEYSIGNER_KEYSTORE_BACKEND)")
+    info.add_argument('--no-fallback', action='store_true', help="Do not run keytool when the native reader cannot read a keystore")
+    info.set_defaults(func=keystore_info)
+
+    journal = subparsers.add_parser('journal', help="Show the audit journal of generated, migrated, converted and signed keystores and APKs")
+    journal.add_argument('journals', nargs='*', help="Journal files or output directories (default: KEYSIGNER_JOURNAL, or the journals of all output directories)")
+    journal.add_argument('--keystore', help="Keystore path or file name, wildcards allowed (e.g. '*.p12')")
+    journal.add_argument('--alias', help="Alias name")
+    journal.add_argument('--event', choices=['generate', 'migrate', 'export', 'import', 'sign', 'command'], help="Event type")
+    journal.add_argument('--since', help="Start time: ISO date/time (UTC unless an offset is given) or relative, e.g. 12h, 7d")
+    journal.add_argument('--until', help="End time, same formats as --since")
+    journal.add_argument('--limit', type=int, help="Show only the last N records")
+    journal.add_argument('--json', action='store_true', help="Print the records as JSON Lines")
+    journal.set_defaults(func=query_journal)
+
+    index = subparsers.add_parser('index', help="Index the aliases, fingerprints and expiry of every keystore under a directory")
+    index.add_argument('action', choices=['refresh', 'find', 'status'])
+    index.add_argument('paths', nargs='*', help="refresh: directories or keystores to scan")
+    index.add_argument('--index', metavar='PATH', help="Index database (default: ~/.cache/keysigner/keystore_index.sqlite)")
+    index.add_argument('--ks-pass', action='append', help="refresh: keystore password to try, repeatable: pass:<password>, env:<name> or file:<path>. JKS and BKS entries are listed without one, unverified")
+    index.add_argument('--workers', type=int, default=os.cpu_count(), help="refresh: processes parsing keystores")
+    index.add_argument('--full', action='store_true', help="refresh: parse every file again, even when unchanged")
+    index.add_argument('--sha256', help="find: certificate SHA-256 fingerprint or a prefix, with or without colons")
+    index.add_argument('--sha1', help="find: certificate SHA-1 fingerprint or a prefix")
+    index.add_argument('--alias', help="find: alias name (case insensitive)")
+    index.add_argument('--subject', help="find: text contained in the subject DN")
+    index.add_argument('--expires-before', metavar='TIME', help="find: certificates expiring before this ISO date/time or in this long, e.g. 90d")
+    index.add_argument('--expires-after', metavar='TIME', help="find: certificates expiring after this time, same formats (0s: not yet expired)")
+    index.add_argument('--under', action='append', metavar='PATH', help="find: only certificates of files below this directory, repeatable")
+    index.add_argument('--leaf', action='store_true', help="find: only the first certificate of each chain")
+    index.add_argument('--json', action='store_true', help="find, status: print JSON")
+    index.set_defaults(func=keystore_index)
+
+    cache = subparsers.add_parser('cache', help="Show or prune the signed output cache")
+    cache.add_argument('action', choices=['stats', 'prune'])
+    cache.add_argument('--path', help="Cache directory (default: ~/.cache/keysigner/signed)")
+    cache.add_argument('--max-size', type=parse_size, default=DEFAULT_MAX_SIZE, metavar='SIZE', help="prune: evict least recently used outputs above this size")
+    cache.add_argument('--all', action='store_true', help="prune: remove every cached output")
+    cache.set_defaults(func=cache_command)
+
+    return parser
+
+def run_cli(argv, interactive=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        if interactive is None or not (args.trace or args.profile):
+            parser.error("a command is required")
+        args.func = lambda args: interactive()
+
+    if args.tool_timeout is not None:
+        configure_tool_runner(timeout=args.tool_timeout)
+    tracer = enable_tracing() if args.trace else None
+    try:
+        with Profiler() if args.profile else contextlib.nullcontext():
+            with span(args.command or 'interactive', 'command'):
+                return args.func(args)
+    except Exception as e:
+        print_red(f"Error occurred: {e}")
+        return 1
+    finally:
+        # Also reached when an interactive flow calls exit()
+        if tracer is not None:
+            disable_tracing()
+            count = tracer.write(args.trace)
+            print_blue(f"Trace with {count} events written to {args.trace}")
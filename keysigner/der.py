@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+# Minimal ASN.1 DER encoding for the structures keysigner writes itself (PKCS#7 signature blocks).
+
+TAG_INTEGER = 0x02
+TAG_OCTET_STRING = 0x04
+TAG_NULL = 0x05
+TAG_OID = 0x06
+TAG_SEQUENCE = 0x30
+TAG_SET = 0x31
+
+def encode_length(length):
+    if length < 0x80:
+        return bytes([length])
+    data = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+    return bytes([0x80 | len(data)]) + data
+
+def encode(tag, content):
+    return bytes([tag]) + encode_length(len(content)) + content
+
+def sequence(*items):
+    return encode(TAG_SEQUENCE, b''.join(items))
+
+def set_of(*items):
+    # DER orders SET OF elements by their encoding
+    return encode(TAG_SET, b''.join(sorted(items)))
+
+def integer(value):
+    length = (value.bit_length() + 8) // 8 if value >= 0 else ((-value - 1).bit_length() + 8) // 8
+    return encode(TAG_INTEGER, value.to_bytes(max(1, length), 'big', signed=True))
+
+def octet_string(data):
+    return encode(TAG_OCTET_STRING, data)
+
+def null():
+    return encode(TAG_NULL, b'')
+
+def oid(dotted):
+    parts = [int(part) for part in dotted.split('.')]
+    body = bytearray([parts[0] * 40 + parts[1]])
+    for part in parts[2:]:
+        chunk = [part & 0x7F]
+        part >>= 7
+        while part:
+            chunk.append(0x80 | (part & 0x7F))
+            part >>= 7
+        body.extend(reversed(chunk))
+    return encode(TAG_OID, bytes(body))
+
+def context(number, content, constructed=True):
+    return encode((0xA0 if constructed else 0x80) | number, content)
+
+def algorithm(dotted, null_parameters=True):
+    # AlgorithmIdentifier, RSA and digest algorithms carry NULL parameters, ECDSA ones none
+    return sequence(oid(dotted), null()) if null_parameters else sequence(oid(dotted))
+
+# Decoding, enough for keystore containers (PKCS#12, PKCS#8 and the JKS key protector).
+# Indefinite lengths and constructed strings (BER, as written by some PKCS#12 tools) are accepted.
+
+TAG_BMP_STRING = 0x1E
+
+def decode(data, offset=0):
+    # Returns (tag, content, next_offset)
+    if offset + 2 > len(data):
+        raise ValueError("Truncated DER data.")
+    tag = data[offset]
+    if tag & 0x1F == 0x1F:
+        raise ValueError("High tag numbers are not supported.")
+    length = data[offset + 1]
+    start = offset + 2
+    if length == 0x80:
+        if not tag & 0x20:
+            raise ValueError("Indefinite length on a primitive value.")
+        position = start
+        while data[position:position + 2] != b'\x00\x00':
+            position = decode(data, position)[2]
+        return tag, data[start:position], position + 2
+    if length & 0x80:
+        count = length & 0x7F
+        length = int.from_bytes(data[start:start + count], 'big')
+        start += count
+    end = start + length
+    if end > len(data):
+        raise ValueError("Truncated DER data.")
+    return tag, data[start:end], end
+
+def decode_items(content):
+    # Elements of a SEQUENCE or SET, as (tag, content) pairs
+    items = []
+    offset = 0
+    while offset < len(content):
+        tag, value, offset = decode(content, offset)
+        items.append((tag, value))
+    return items
+
+def decode_single(data, expected_tag=None):
+    tag, value, end = decode(data)
+    if expected_tag is not None and tag != expected_tag:
+        raise ValueError(f"Unexpected ASN.1 tag 0x{tag:02x}, expected 0x{expected_tag:02x}.")
+    return value
+
+def decode_oid(content):
+    parts = []
+    value = 0
+    for byte in content:
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            parts.append(value)
+            value = 0
+    first = min(parts[0] // 40, 2)
+    return '.'.join(str(part) for part in [first, parts[0] - first * 40] + parts[1:])
+
+def decode_integer(content):
+    return int.from_bytes(content, 'big', signed=True)
+
+def decode_octet_string(tag, content):
+    # Constructed (BER) octet strings are split into segments
+    if tag & 0x20:
+        return b''.join(decode_octet_string(item_tag, item) for item_tag, item in decode_items(content))
+    return bytes(content)
+
+def decode_algorithm(content):
+    # AlgorithmIdentifier: (dotted OID, (tag, content) of the parameters or None)
+    items = decode_items(content)
+    return decode_oid(items[0][1]), (items[1] if len(items) > 1 else None)
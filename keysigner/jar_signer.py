@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import zlib
+import errno
+import base64
+import struct
+import hashlib
+from . import der
+from .trace import traced
+
+try:
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, padding
+except ImportError:
+    hashes = None
+
+LOCAL_HEADER_SIG = 0x04034b50
+CENTRAL_HEADER_SIG = 0x02014b50
+DATA_DESCRIPTOR_SIG = 0x08074b50
+LOCAL_HEADER_SIZE = 30
+CENTRAL_HEADER_SIZE = 46
+ALIGNMENT_EXTRA_ID = 0xd935
+COPY_CHUNK_SIZE = 1024 * 1024
+# 1981-01-01 00:00:00, keeps the generated signature entries deterministic
+DOS_TIME = 0
+DOS_DATE = (1 << 9) | (1 << 5) | 1
+CREATED_BY = '1.0 (Android)'
+
+OID_SIGNED_DATA = '1.2.840.113549.1.7.2'
+OID_DATA = '1.2.840.113549.1.7.1'
+OID_RSA = '1.2.840.113549.1.1.1'
+OID_ECDSA_SHA256 = '1.2.840.10045.4.3.2'
+DIGESTS = {
+    # name: (hashlib name, manifest attribute, digest algorithm OID)
+    'SHA-1': ('sha1', 'SHA1', '1.3.14.3.2.26'),
+    'SHA-256': ('sha256', 'SHA-256', '2.16.840.1.101.3.4.2.1'),
+}
+
+# Signature files of previous signers are replaced, other META-INF entries are kept and signed
+SIGNATURE_FILE = re.compile(r'^META-INF/([^/]+\.(SF|RSA|DSA|EC)|SIG-[^/]*|MANIFEST\.MF)$', re.IGNORECASE)
+
+class ZipEntry:
+    def __init__(self, record, name):
+        self.record = record
+        self.name = name
+        (self.flags, self.method, self.crc, self.compressed_size, self.uncompressed_size,
+         self.local_header_offset) = self.unpack(record)
+
+    @staticmethod
+    def unpack(record):
+        flags, method = struct.unpack('<HH', record[8:12])
+        crc, compressed_size, uncompressed_size = struct.unpack('<III', record[16:28])
+        (local_header_offset,) = struct.unpack('<I', record[42:46])
+        return flags, method, crc, compressed_size, uncompressed_size, local_header_offset
+
+    def record_with_offset(self, offset):
+        return self.record[:42] + struct.pack('<I', offset) + self.record[46:]
+
+def read_central_directory(data, cd_offset, cd_size):
+    entries = []
+    position = cd_offset
+    end = cd_offset + cd_size
+    while position < end:
+        if struct.unpack('<I', data[position:position + 4])[0] != CENTRAL_HEADER_SIG:
+            raise ValueError(f"Malformed ZIP Central Directory at offset {position}.")
+        name_length, extra_length, comment_length = struct.unpack('<HHH', data[position + 28:position + 34])
+        record_size = CENTRAL_HEADER_SIZE + name_length + extra_length + comment_length
+        record = bytes(data[position:position + record_size])
+        name = record[CENTRAL_HEADER_SIZE:CENTRAL_HEADER_SIZE + name_length].decode('utf-8', 'replace')
+        entries.append(ZipEntry(record, name))
+        position += record_size
+    return entries
+
+def manifest_line(name, value):
+    # Lines are at most 72 bytes including CRLF, continuation lines start with a space
+    data = f"{name}: {value}".encode('utf-8')
+    lines = []
+    limit = 70
+    while len(data) > limit:
+        cut = limit
+        while cut > 0 and (data[cut] & 0xC0) == 0x80:
+            cut -= 1
+        lines.append(data[:cut])
+        data = data[cut:]
+        limit = 69
+    lines.append(data)
+    return b'\r\n '.join(lines) + b'\r\n'
+
+def strip_alignment_extra(extra):
+    result = b''
+    position = 0
+    while position + 4 <= len(extra):
+        header_id, size = struct.unpack('<HH', extra[position:position + 4])
+        if position + 4 + size > len(extra):
+            # Not a well-formed extra field (e.g. zipalign zero padding), drop the trailing bytes
+            break
+        if header_id != ALIGNMENT_EXTRA_ID:
+            result += extra[position:position + 4 + size]
+        position += 4 + size
+    return result
+
+class JarSigner:
+    def __init__(self, private_key, certificates, min_sdk=None, signer_name='CERT', apk_signed_schemes=None):
+        self.private_key = private_key
+        self.certificates = certificates
+        self.signer_name = signer_name.upper()
+        self.apk_signed_schemes = apk_signed_schemes or []
+        self.is_ec = isinstance(private_key, ec.EllipticCurvePrivateKey)
+        # apksigner uses SHA-1 below API 18, which cannot verify SHA-256 JAR signatures. Unknown minSdk: stay compatible.
+        self.digest = 'SHA-256' if self.is_ec or (min_sdk is not None and min_sdk >= 18) else 'SHA-1'
+        self.hash_name, self.attribute, self.digest_oid = DIGESTS[self.digest]
+
+    @traced('v1 sign', 'digest')
+    def sign(self, apk_file, data, apk, output_path):
+        # data: memoryview of the input mmap, apk: its ApkSections, output: v1 signed ZIP without APK Signing Block
+        entries = [entry for entry in read_central_directory(data, apk.cd_offset, apk.cd_size) if not SIGNATURE_FILE.match(entry.name)]
+        names = [entry.name for entry in entries]
+        if len(set(names)) != len(names):
+            raise ValueError("Duplicate ZIP entry names are not allowed in APKs.")
+
+        fd = os.open(output_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        with open(fd, 'wb', buffering=0) as out, open(apk_file, 'rb', buffering=0) as source:
+            central_directory = []
+            manifest_entries = []
+            position = 0
+            for entry in entries:
+                local_header, data_offset, data_end = self.local_entry(data, entry, position)
+                out.write(local_header)
+                copy_range(source.fileno(), out.fileno(), data_offset, data_end - data_offset, data)
+                central_directory.append(entry.record_with_offset(position))
+                position += len(local_header) + data_end - data_offset
+                if not entry.name.endswith('/'):
+                    manifest_entries.append((entry.name, self.entry_digest(data, entry, data_offset)))
+
+            manifest = self.manifest(manifest_entries)
+            signature_file = self.signature_file(manifest)
+            block_name = 'EC' if self.is_ec else 'RSA'
+            for name, content in [
+                ('META-INF/MANIFEST.MF', manifest),
+                (f'META-INF/{self.signer_name}.SF', signature_file),
+                (f'META-INF/{self.signer_name}.{block_name}', self.signature_block(signature_file)),
+            ]:
+                local_header, compressed, record = self.new_entry(name, content, position)
+                out.write(local_header)
+                out.write(compressed)
+                central_directory.append(record)
+                position += len(local_header) + len(compressed)
+
+            cd = b''.join(central_directory)
+            out.write(cd)
+            eocd = apk.eocd
+            out.write(eocd[:8] + struct.pack('<HHII', len(central_directory), len(central_directory), len(cd), position) + eocd[20:])
+        return output_path
+
+    def local_entry(self, data, entry, output_offset):
+        offset = entry.local_header_offset
+        if struct.unpack('<I', data[offset:offset + 4])[0] != LOCAL_HEADER_SIG:
+            raise ValueError(f"Malformed local file header for '{entry.name}'.")
+        name_length, extra_length = struct.unpack('<HH', data[offset + 26:offset + 30])
+        header = bytes(data[offset:offset + LOCAL_HEADER_SIZE + name_length])
+        extra = bytes(data[offset + LOCAL_HEADER_SIZE + name_length:offset + LOCAL_HEADER_SIZE + name_length + extra_length])
+        data_offset = offset + LOCAL_HEADER_SIZE + name_length + extra_length
+
+        data_end = data_offset + entry.compressed_size
+        if entry.flags & 0x08:
+            has_signature = struct.unpack('<I', data[data_end:data_end + 4])[0] == DATA_DESCRIPTOR_SIG
+            data_end += 16 if has_signature else 12
+
+        if entry.method == 0:
+            # Keep uncompressed entries aligned like apksigner: 4096 bytes for native libraries, 4 otherwise
+            alignment = 4096 if entry.name.endswith('.so') else 4
+            if (output_offset + len(header) + len(extra)) % alignment:
+                extra = strip_alignment_extra(extra)
+                minimum_start = output_offset + len(header) + len(extra) + 6
+                padding_size = (alignment - minimum_start % alignment) % alignment
+                extra += struct.pack('<HHH', ALIGNMENT_EXTRA_ID, 2 + padding_size, alignment) + b'\x00' * padding_size
+                header = header[:28] + struct.pack('<H', len(extra)) + header[30:]
+        return header + extra, data_offset, data_end
+
+    def entry_digest(self, data, entry, data_offset):
+        digest = hashlib.new(self.hash_name)
+        end = data_offset + entry.compressed_size
+        if entry.method == 0:
+            for position in range(data_offset, end, COPY_CHUNK_SIZE):
+                digest.update(data[position:min(position + COPY_CHUNK_SIZE, end)])
+        elif entry.method == 8:
+            inflater = zlib.decompressobj(-15)
+            for position in range(data_offset, end, COPY_CHUNK_SIZE):
+                digest.update(inflater.decompress(data[position:min(position + COPY_CHUNK_SIZE, end)]))
+            digest.update(inflater.flush())
+            if not inflater.eof:
+                raise ValueError(f"Truncated deflate stream in '{entry.name}'.")
+        else:
+            raise ValueError(f"Unsupported compression method {entry.method} in '{entry.name}'.")
+        return base64.b64encode(digest.digest()).decode('ascii')
+
+    def manifest(self, manifest_entries):
+        self.manifest_sections = []
+        main = manifest_line('Manifest-Version', '1.0') + manifest_line('Created-By', CREATED_BY) + b'\r\n'
+        for name, digest in manifest_entries:
+            section = manifest_line('Name', name) + manifest_line(f'{self.attribute}-Digest', digest) + b'\r\n'
+            self.manifest_sections.append((name, section))
+        return main + b''.join(section for _, section in self.manifest_sections)
+
+    def signature_file(self, manifest):
+        main = manifest_line('Signature-Version', '1.0') + manifest_line('Created-By', CREATED_BY)
+        main += manifest_line(f'{self.attribute}-Digest-Manifest', self.b64_digest(manifest))
+        if self.apk_signed_schemes:
+            # Stripping protection: tells v1-only verifiers on newer platforms to require the v2/v3 signature
+            main += manifest_line('X-Android-APK-Signed', ', '.join(str(scheme) for scheme in self.apk_signed_schemes))
+        sections = [manifest_line('Name', name) + manifest_line(f'{self.attribute}-Digest', self.b64_digest(section)) + b'\r\n' for name, section in self.manifest_sections]
+        return main + b'\r\n' + b''.join(sections)
+
+    def b64_digest(self, content):
+        return base64.b64encode(hashlib.new(self.hash_name, content).digest()).decode('ascii')
+
+    def signature_block(self, signature_file):
+        # PKCS#7 SignedData, detached, without signed attributes: the signature covers the .SF file itself
+        hash_algorithm = hashes.SHA256() if self.hash_name == 'sha256' else hashes.SHA1()
+        if self.is_ec:
+            signature = self.private_key.sign(signature_file, ec.ECDSA(hash_algorithm))
+            signature_algorithm = der.algorithm(OID_ECDSA_SHA256, null_parameters=False)
+        else:
+            signature = self.private_key.sign(signature_file, padding.PKCS1v15(), hash_algorithm)
+            signature_algorithm = der.algorithm(OID_RSA)
+
+        signer = self.certificates[0]
+        signer_info = der.sequence(
+            der.integer(1),
+            der.sequence(signer.issuer.public_bytes(), der.integer(signer.serial_number)),
+            der.algorithm(self.digest_oid),
+            signature_algorithm,
+            der.octet_string(signature),
+        )
+        certificates = b''.join(cert.public_bytes(serialization.Encoding.DER) for cert in self.certificates)
+        signed_data = der.sequence(
+            der.integer(1),
+            der.set_of(der.algorithm(self.digest_oid)),
+            der.sequence(der.oid(OID_DATA)),
+            der.context(0, certificates),
+            der.set_of(signer_info),
+        )
+        return der.sequence(der.oid(OID_SIGNED_DATA), der.context(0, signed_data))
+
+    def new_entry(self, name, content, offset):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+        compressed = compressor.compress(content) + compressor.flush()
+        name_bytes = name.encode('utf-8')
+        crc = zlib.crc32(content)
+        fields = struct.pack('<HHHHIII', 0x0800, 8, DOS_TIME, DOS_DATE, crc, len(compressed), len(content))
+        local_header = struct.pack('<IH', LOCAL_HEADER_SIG, 20) + fields + struct.pack('<HH', len(name_bytes), 0) + name_bytes
+        record = (
+            struct.pack('<IHH', CENTRAL_HEADER_SIG, 20, 20) + fields
+            + struct.pack('<HHHHHII', len(name_bytes), 0, 0, 0, 0, 0, offset) + name_bytes
+        )
+        return local_header, compressed, record
+
+def copy_range(source_fd, target_fd, offset, count, data):
+    # Untouched entries are copied in the kernel (copy_file_range, then sendfile), without recompressing
+    while count > 0:
+        try:
+            if hasattr(os, 'copy_file_range'):
+                copied = os.copy_file_range(source_fd, target_fd, count, offset)
+            else:
+                copied = os.sendfile(target_fd, source_fd, offset, count)
+        except OSError as e:
+            if e.errno not in [errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF]:
+                raise
+            copied = 0
+        if copied <= 0:
+            for position in range(offset, offset + count, COPY_CHUNK_SIZE):
+                os.write(target_fd, data[position:min(position + COPY_CHUNK_SIZE, offset + count)])
+            return
+        offset += copied
+        count -= copied
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import glob
+import json
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from .apk_signer import APKSigner
+from .pkcs12_to_pem import PKCS12ToPEM
+from .keystore_generator import BulkKeystoreGenerator
+from .keystore_migrator import BulkKeystoreMigrator
+from .keystore_reader import read_keystore
+from .keystore_writer import DEFAULT_VALIDITY
+from .utils import *
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+REFERENCE = re.compile(r'\$\{([A-Za-z0-9_.-]+)\}')
+# Bump when an action's outputs or the state format change, so that older state files are not reused
+STATE_VERSION = 2
+
+def load_manifest(path):
+    with open(path, 'r') as f:
+        if path.lower().endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise ImportError("YAML manifests require the 'PyYAML' package (pip install keysigner[yaml]), or use JSON.")
+            manifest = yaml.safe_load(f)
+        else:
+            manifest = json.load(f)
+    if not isinstance(manifest, dict) or not isinstance(manifest.get('jobs'), dict) or not manifest['jobs']:
+        raise ValueError("The manifest needs a 'jobs' mapping of job names to jobs.")
+    return manifest
+
+def references(value):
+    if isinstance(value, str):
+        return {match.split('.', 1)[0] for match in REFERENCE.findall(value)}
+    if isinstance(value, dict):
+        return set().union(*[references(item) for item in value.values()]) if value else set()
+    if isinstance(value, list):
+        return set().union(*[references(item) for item in value]) if value else set()
+    return set()
+
+def lookup(outputs, reference):
+    name, *path = reference.split('.')
+    value = outputs[name]
+    for key in path:
+        if not isinstance(value, dict) or key not in value:
+            raise ValueError(f"'${{{reference}}}': job '{name}' has no output '{key}'.")
+        value = value[key]
+    return value
+
+def resolve(value, outputs):
+    # ${job.output} is replaced by an output of a finished job, a value that is only a reference keeps its type
+    if isinstance(value, str):
+        match = REFERENCE.fullmatch(value)
+        if match:
+            return lookup(outputs, match.group(1))
+        return REFERENCE.sub(lambda match: str(lookup(outputs, match.group(1))), value)
+    if isinstance(value, dict):
+        return {key: resolve(item, outputs) for key, item in value.items()}
+    if isinstance(value, list):
+        return [resolve(item, outputs) for item in value]
+    return value
+
+def secret(params, key, prompt):
+    value = params.get(key)
+    return read_secret(value, prompt) if value is not None else None
+
+def file_state(path):
+    if isinstance(path, str) and os.path.isfile(path):
+        stat = os.stat(path)
+        return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+    return None
+
+def public_params(value):
+    # Passwords stay out of the state file
+    if isinstance(value, dict):
+        return {key: public_params(item) for key, item in value.items() if 'pass' not in key}
+    if isinstance(value, list):
+        return [public_params(item) for item in value]
+    return value
+
+def input_files(value):
+    if isinstance(value, dict):
+        # 'out' is written by the job itself
+        return [state for key, item in value.items() if key != 'out' for state in input_files(item)]
+    if isinstance(value, list):
+        return [state for item in value for state in input_files(item)]
+    state = file_state(value)
+    return [state] if state else []
+
+def expand_apks(patterns):
+    apks = []
+    for pattern in [patterns] if isinstance(patterns, str) else patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise ValueError(f"No APK files match '{pattern}'.")
+        for path in matches:
+            if os.path.isdir(path):
+                apks.extend(sorted(os.path.join(path, name) for name in os.listdir(path) if name.lower().endswith('.apk')))
+            else:
+                apks.append(path)
+    return apks
+
+class JobRunner:
+    def __init__(self, manifest, concurrency=None, state_path=None, force=False):
+        self.jobs = manifest['jobs']
+        self.concurrency = max(1, concurrency or manifest.get('concurrency') or os.cpu_count() or 1)
+        self.state_path = state_path
+        self.force = force
+        self.state = {}
+        self.outputs = {}
+        self.results = {}
+        self.lock = threading.Lock()
+        self.actions = {
+            'generate': self.run_generate,
+            'migrate': self.run_migrate,
+            'export-pem': self.run_export_pem,
+            'info': self.run_info,
+            'sign': self.run_sign,
+        }
+        self.dependencies = self.build_graph()
+
+    def build_graph(self):
+        dependencies = {}
+        for name, job in self.jobs.items():
+            if not isinstance(job, dict) or job.get('action') not in self.actions:
+                raise ValueError(f"Job '{name}': action must be one of {', '.join(self.actions)}.")
+            needs = job.get('needs') or []
+            needs = set([needs] if isinstance(needs, str) else needs) | references({key: value for key, value in job.items() if key != 'needs'})
+            unknown = needs - set(self.jobs)
+            if unknown:
+                raise ValueError(f"Job '{name}' depends on unknown job(s): {', '.join(sorted(unknown))}.")
+            dependencies[name] = needs
+
+        # Kahn's algorithm, whatever is left over is part of a cycle
+        remaining = {name: set(needs) for name, needs in dependencies.items()}
+        while True:
+            ready = [name for name, needs in remaining.items() if not needs]
+            if not ready:
+                break
+            for name in ready:
+                del remaining[name]
+            for needs in remaining.values():
+                needs.difference_update(ready)
+        if remaining:
+            raise ValueError(f"Dependency cycle between jobs: {', '.join(sorted(remaining))}.")
+        return dependencies
+
+    def load_state(self):
+        # Also read with force: it is the record of which files the runner wrote and may replace
+        if self.state_path and os.path.exists(self.state_path):
+            with open(self.state_path, 'r') as f:
+                state = json.load(f)
+            if state.get('version') == STATE_VERSION:
+                self.state = state.get('jobs', {})
+
+    def save_state(self):
+        if self.state_path:
+            with self.lock:
+                write_json(self.state_path, {'version': STATE_VERSION, 'jobs': self.state})
+
+    def fingerprint(self, name, params):
+        # Parameters, input files and the fingerprints of the jobs this one depends on
+        material = {
+            'params': public_params(params),
+            'inputs': input_files(params),
+            'needs': {dependency: self.state.get(dependency, {}).get('fingerprint') for dependency in sorted(self.dependencies[name])},
+        }
+        return hashlib.sha256(json.dumps(material, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def reusable(self, name, fingerprint):
+        previous = self.state.get(name)
+        if self.force or not previous or previous.get('fingerprint') != fingerprint:
+            return None
+        # Output files changed outside the runner (size or mtime) are not reused
+        if not all(state and file_state(state[0]) == state for state in previous.get('files', [])):
+            return None
+        return previous.get('outputs')
+
+    def owns(self, path):
+        # Written by a job of this manifest and unchanged since, according to the state file
+        state = file_state(path)
+        with self.lock:
+            recorded = [files for job in self.state.values() for files in job.get('files', [])]
+        return state is not None and state in recorded
+
+    def run_job(self, name):
+        start = time.perf_counter()
+        job = self.jobs[name]
+        with self.lock:
+            outputs = dict(self.outputs)
+        params = resolve({key: value for key, value in job.items() if key not in ['action', 'needs']}, outputs)
+        if job['action'] == 'sign':
+            # Expanded first, so that the fingerprint covers every APK
+            params['apks'] = expand_apks(params['apks'])
+        fingerprint = self.fingerprint(name, params)
+        reused = self.reusable(name, fingerprint)
+        if reused is not None:
+            return {'job': name, 'action': job['action'], 'status': 'reused', 'outputs': reused, 'error': None, 'seconds': round(time.perf_counter() - start, 3)}, fingerprint, None
+
+        outputs, files = self.actions[job['action']](params)
+        return {'job': name, 'action': job['action'], 'status': 'done', 'outputs': outputs, 'error': None, 'seconds': round(time.perf_counter() - start, 3)}, fingerprint, files
+
+    def run(self):
+        self.load_state()
+        pending = dict(self.dependencies)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while pending or running:
+                for name in [name for name, needs in pending.items() if all(self.results.get(need, {}).get('status') in ['done', 'reused'] for need in needs)]:
+                    del pending[name]
+                    print_blue(f"[{name}] {self.jobs[name]['action']}")
+                    running[executor.submit(self.run_job, name)] = name
+                for name in [name for name, needs in pending.items() if any(self.results.get(need, {}).get('status') in ['failed', 'skipped'] for need in needs)]:
+                    del pending[name]
+                    failed = sorted(need for need in self.dependencies[name] if self.results.get(need, {}).get('status') in ['failed', 'skipped'])
+                    self.results[name] = {'job': name, 'action': self.jobs[name]['action'], 'status': 'skipped', 'outputs': None, 'error': f"Dependency failed: {', '.join(failed)}", 'seconds': 0.0}
+                    print_yellow(f"[{name}] skipped, {self.results[name]['error']}")
+                if not running:
+                    if pending:
+                        # Only reachable through skipped dependencies, handled above on the next pass
+                        continue
+                    break
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        result, fingerprint, files = future.result()
+                    except Exception as e:
+                        self.results[name] = {'job': name, 'action': self.jobs[name]['action'], 'status': 'failed', 'outputs': None, 'error': str(e), 'seconds': None}
+                        print_red(f"[{name}] failed: {e}")
+                        continue
+                    with self.lock:
+                        self.outputs[name] = result['outputs']
+                        if files is not None:
+                            self.state[name] = {'fingerprint': fingerprint, 'outputs': result['outputs'], 'files': [file_state(path) for path in files]}
+                    self.results[name] = result
+                    if files is not None:
+                        self.save_state()
+                    print_green(f"[{name}] {'reused previous outputs' if result['status'] == 'reused' else 'done'} ({result['seconds']:.2f}s)")
+        return [self.results[name] for name in self.jobs]
+
+    def run_generate(self, params):
+        store_type = (params.get('store_type') or 'PKCS12').upper()
+        store_pass = secret(params, 'store_pass', "Enter keystore password: ")
+        generator = BulkKeystoreGenerator(store_type, store_pass, secret(params, 'key_pass', "Enter alias password: "), params.get('key_algorithm') or 'RSA-2048', params.get('validity') or DEFAULT_VALIDITY, params.get('out'), params.get('backend'), params.get('timeout'))
+        generator.output_path = ensure_directory(generator.output_path)
+        spec = {key: params[key] for key in ['name', 'alias', 'dname'] if params.get(key)}
+        path = generator.normalize(spec)['path']
+        replace = False
+        if os.path.exists(path) and self.force:
+            # A mistyped manifest must not destroy a signing key the runner did not create
+            if not self.owns(path):
+                raise FileExistsError(f"{path} already exists and is not an unchanged output of this manifest's state file, --force does not replace it.")
+            replace = True
+        result = generator.generate_one(spec, replace=replace)
+        if not result['success']:
+            raise RuntimeError(result['error'])
+        key_spec = {'type': 'p12' if store_type == 'PKCS12' else store_type.lower(), 'keystore': result['path'], 'alias': result['alias']}
+        return {'path': result['path'], 'alias': result['alias'], 'store_type': store_type, 'key_algorithm': result['key_algorithm'], 'sha256': result['sha256'], 'key_spec': key_spec}, [result['path']]
+
+    def run_migrate(self, params):
+        migrator = BulkKeystoreMigrator(
+            params['dest_type'],
+            secret(params, 'store_pass', "Enter source keystore password: "),
+            dest_store_pass=secret(params, 'dest_pass', "Enter destination keystore password: "),
+            src_key_pass=secret(params, 'key_pass', "Enter source alias password: "),
+            dest_key_pass=secret(params, 'dest_key_pass', "Enter destination alias password: "),
+            aliases=params.get('aliases'),
+            output_path=ensure_directory(params.get('out')),
+            timeout=params.get('timeout')
+        )
+        result = migrator.migrate_one(os.path.abspath(params['keystore']))
+        if not result['success']:
+            raise RuntimeError(result['error'])
+        return {'path': result['destination'], 'aliases': result['aliases'], 'store_type': result['dest_type']}, [result['destination']]
+
+    def run_export_pem(self, params):
+        converter = PKCS12ToPEM(params.get('backend'), params.get('timeout'))
+        if params.get('all'):
+            results = converter.export_all(params['keystore'], read_secret(params.get('store_pass'), "Enter keystore password: "), params.get('out'), params.get('workers'))
+            key_specs = {result['alias']: {'type': 'pem', 'cert': result['cert'], 'key': result['key']} for result in results if result['key']}
+            return {'entries': results, 'key_specs': key_specs}, [path for result in results for path in [result['cert'], result['chain'], result['key']] if path]
+        x509_path, key_path = converter.export(params['keystore'], read_secret(params.get('store_pass'), "Enter keystore password: "), params.get('out'))
+        return {'cert': x509_path, 'key': key_path, 'key_spec': {'type': 'pem', 'cert': x509_path, 'key': key_path}}, [x509_path, key_path]
+
+    def run_info(self, params):
+        keystore = read_keystore(params['keystore'], read_secret(params.get('store_pass'), "Enter keystore password: "), params.get('store_type'))
+        outputs = keystore.to_dict()
+        if params.get('out'):
+            write_json(params['out'], outputs)
+            return outputs, [os.path.abspath(params['out'])]
+        return outputs, []
+
+    def run_sign(self, params):
+        key_spec = dict(params['key'])
+        # Passwords are never part of job outputs, the signing job supplies them
+        for key, prompt in [('store_pass', "Enter keystore password: "), ('key_pass', "Enter alias password: ")]:
+            if key_spec.get(key) is not None or params.get(key) is not None:
+                key_spec[key] = read_secret(key_spec.get(key) or params.get(key), prompt)
+        apks = params['apks']
+        signer = APKSigner(params.get('timeout'))
+        if params.get('engine'):
+            signer.engine = params['engine']
+        signer.auto_schemes = bool(params.get('auto_schemes'))
+        try:
+            results = signer.sign_many(apks, key_spec, params.get('schemes'), workers=params.get('workers'), output_path=params.get('out'))
+        finally:
+            if signer.key_cache is not None:
+                signer.key_cache.clear()
+        failed = [f"{result['apk']}: {result['error']}" for result in results if not result['success']]
+        if failed:
+            raise RuntimeError(f"{len(failed)} of {len(results)} APK(s) failed to sign: {'; '.join(failed)}")
+        signed = [result['signed_apk'] for result in results]
+        return {'signed_apks': signed}, signed
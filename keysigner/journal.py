@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import json
+import glob
+import atexit
+import contextlib
+import fnmatch
+import hashlib
+import datetime
+import threading
+from .trace import traced
+from .utils import *
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+JOURNAL_NAME = 'keysigner_journal.jsonl'
+DEFAULT_MAX_SIZE = 10 * 1024 * 1024
+DEFAULT_BACKUPS = 5
+FLUSH_INTERVAL = 1.0
+FLUSH_RECORDS = 256
+# Options whose value is a password (keytool, openssl, apksigner); env:, file: and fd: references are kept
+SECRET_OPTIONS = {
+    '-storepass', '-keypass', '-srcstorepass', '-deststorepass', '-srckeypass', '-destkeypass', '-new',
+    '-password', '-passin', '-passout', '-pass', '--ks-pass', '--key-pass',
+}
+SECRET_REFERENCES = ('env:', 'file:', 'fd:', 'stdin')
+RELATIVE_TIME = re.compile(r'^(\d+(?:\.\d+)?)([smhdw])$')
+TIME_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+def redact_secret(value):
+    if value.startswith(SECRET_REFERENCES):
+        return value
+    return 'pass:***' if value.startswith('pass:') else '***'
+
+def redact_command(cmd):
+    redacted = []
+    for index, arg in enumerate(cmd):
+        arg = str(arg)
+        if index and str(cmd[index - 1]) in SECRET_OPTIONS:
+            redacted.append(redact_secret(arg))
+        elif arg.startswith('pass:'):
+            redacted.append('pass:***')
+        else:
+            redacted.append(arg)
+    return redacted
+
+def format_command(cmd):
+    return " ".join(f'"{arg}"' if ' ' in arg else arg for arg in cmd)
+
+def cache_file_name(prefix, output_path):
+    # Files kept in ~/.cache/keysigner for an output directory: <prefix>-<directory name>-<hash of its path>.jsonl
+    output_path = os.path.abspath(output_path)
+    key = hashlib.sha256(output_path.encode('utf-8')).hexdigest()[:16]
+    return f"{prefix}-{os.path.basename(output_path) or 'root'}-{key}.jsonl"
+
+def journal_dir():
+    return os.path.join(os.path.expanduser('~'), '.cache', 'keysigner', 'journal')
+
+def output_journal_path(output_path):
+    return os.path.join(journal_dir(), cache_file_name('journal', output_path))
+
+def journal_path(output_path=None):
+    # KEYSIGNER_JOURNAL sends every record to one journal (off disables it). By default each output directory has
+    # its own journal in ~/.cache/keysigner, never next to the outputs where it would be shipped with them.
+    value = os.environ.get('KEYSIGNER_JOURNAL', '')
+    if value.lower() in ['0', 'off', 'none']:
+        return None
+    if value:
+        return os.path.abspath(os.path.expanduser(value))
+    return output_journal_path(output_path or os.path.join(os.getcwd(), 'keystore'))
+
+def default_journals():
+    # What keysigner journal reads without arguments: KEYSIGNER_JOURNAL, or the journals of every output directory
+    path = journal_path()
+    if path is None or os.environ.get('KEYSIGNER_JOURNAL'):
+        return [path] if path else []
+    return sorted(glob.glob(os.path.join(journal_dir(), '*.jsonl')))
+
+def lock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+
+def unlock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+_batches = 0
+_flush_interval = None
+_state_lock = threading.Lock()
+
+@contextlib.contextmanager
+def journal_batch():
+    # Records of a batch operation are buffered and written when it ends, before the operation returns
+    global _batches
+    with _state_lock:
+        _batches += 1
+    try:
+        yield
+    finally:
+        with _state_lock:
+            _batches -= 1
+        flush_journals()
+
+def enable_timed_flush(interval=FLUSH_INTERVAL):
+    # For long-running services (watch, serve): records outside a batch are written at most this long after
+    global _flush_interval
+    _flush_interval = interval
+
+class Journal:
+    # Records are buffered and appended in batches: one lock, write and fsync per batch instead of per record.
+    # The lock file serializes writers of all processes, so batches never interleave and rotation is safe.
+    # Outside journal_batch() and without a flush interval, every record is written before append returns.
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE, backups=DEFAULT_BACKUPS, flush_interval=None, flush_records=FLUSH_RECORDS, fsync=True):
+        self.path = path
+        self.max_size = max_size
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.flush_records = flush_records
+        self.fsync = fsync
+        self.buffer = []
+        self.timer = None
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+
+    def append(self, record):
+        line = json.dumps(record, default=str, separators=(',', ':')) + '\n'
+        interval = self.flush_interval if self.flush_interval is not None else _flush_interval
+        with self.lock:
+            self.buffer.append(line)
+            flush_now = len(self.buffer) >= self.flush_records or (not _batches and interval is None)
+            if not flush_now and interval is not None and self.timer is None:
+                self.timer = threading.Timer(interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        if flush_now:
+            self.flush()
+
+    @traced('write journal', 'io')
+    def flush(self):
+        with self.write_lock:
+            with self.lock:
+                lines, self.buffer = self.buffer, []
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+            if not lines:
+                return
+            data = ''.join(lines).encode('utf-8')
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(f"{self.path}.lock", 'a+b') as lock:
+                lock_file(lock)
+                try:
+                    self.rotate(len(data))
+                    fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+                    try:
+                        view = memoryview(data)
+                        while view:
+                            view = view[os.write(fd, view):]
+                        if self.fsync:
+                            os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                finally:
+                    unlock_file(lock)
+
+    def rotate(self, incoming):
+        # journal.jsonl -> journal.jsonl.1 -> ... -> journal.jsonl.<backups>, the oldest is dropped
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            return
+        if not size or size + incoming <= self.max_size:
+            return
+        if self.backups < 1:
+            os.remove(self.path)
+            return
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+    def close(self):
+        self.flush()
+
+_journals = {}
+_journals_lock = threading.Lock()
+
+def journal(path):
+    with _journals_lock:
+        if path not in _journals:
+            if not _journals:
+                atexit.register(flush_journals)
+            _journals[path] = Journal(path, int(os.environ.get('KEYSIGNER_JOURNAL_MAX_SIZE', DEFAULT_MAX_SIZE)))
+        return _journals[path]
+
+def flush_journals():
+    with _journals_lock:
+        journals = list(_journals.values())
+    for item in journals:
+        item.flush()
+
+def record(output_path, event, **fields):
+    path = journal_path(output_path)
+    if path is None:
+        return None
+    entry = {'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='milliseconds'), 'event': event, 'pid': os.getpid()}
+    for key, value in fields.items():
+        if value is not None:
+            entry[key] = redact_command(value) if key == 'command' else value
+    journal(path).append(entry)
+    return path
+
+def log_command(output_path, description, cmd, event='command', **fields):
+    # Passwords are redacted on screen as in the journal, keep them in env: or file: references to rerun the command
+    print_blue(f"\n--- {description} ---")
+    print(format_command(redact_command(cmd)))
+    path = record(output_path, event, description=description, command=cmd, **fields)
+    if path is not None:
+        print_green(f"{description} recorded in {path}")
+    return path
+
+def parse_time(value, future=False):
+    # ISO date or date and time (UTC unless an offset is given), or relative: 30m, 12h, 7d, 2w ago (from now with future)
+    match = RELATIVE_TIME.match(value.strip().lower())
+    if match:
+        delta = datetime.timedelta(seconds=float(match.group(1)) * TIME_UNITS[match.group(2)])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return now + delta if future else now - delta
+    try:
+        parsed = datetime.datetime.fromisoformat(value.strip())
+    except ValueError:
+        raise ValueError(f"Invalid time '{value}'. Expected an ISO date or time such as 2024-05-01T12:00, or 30m, 12h, 7d.")
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=datetime.timezone.utc)
+
+def journal_files(paths):
+    # Oldest first: rotated backups, then the current journal
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            # An output directory: its journal, and the one earlier versions kept in the directory itself
+            files.extend(journal_files([os.path.join(path, JOURNAL_NAME)]))
+            path = output_journal_path(path)
+        backups = []
+        index = 1
+        while os.path.exists(f"{path}.{index}"):
+            backups.append(f"{path}.{index}")
+            index += 1
+        files.extend(reversed(backups))
+        if os.path.exists(path):
+            files.append(path)
+    return files
+
+def matches_keystore(entry, pattern):
+    keystore = entry.get('keystore')
+    if not keystore:
+        return False
+    return fnmatch.fnmatch(keystore, pattern) or fnmatch.fnmatch(os.path.basename(keystore), pattern)
+
+def read_journal(paths, keystore=None, alias=None, since=None, until=None, event=None):
+    for path in journal_files(paths):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A batch cut short by a crash
+                    continue
+                if keystore and not matches_keystore(entry, keystore):
+                    continue
+                if alias and alias.lower() not in [str(name).lower() for name in [entry.get('alias')] + entry.get('aliases', [])]:
+                    continue
+                if event and entry.get('event') != event:
+                    continue
+                if since or until:
+                    time = datetime.datetime.fromisoformat(entry['time'])
+                    if (since and time < since) or (until and time > until):
+                        continue
+                yield entry
+
+def format_entry(entry):
+    status = '' if 'success' not in entry else ('ok' if entry['success'] else 'FAILED')
+    aliases = entry.get('aliases') or ([entry['alias']] if entry.get('alias') else [])
+    target = entry.get('signed_apk') or entry.get('keystore') or ''
+    details = entry.get('error') or entry.get('description') or ''
+    if entry.get('command') and not entry.get('error'):
+        details = format_command(entry['command'])
+    parts = [entry['time'], f"{entry['event']:<8}", status, target, f"[{', '.join(aliases)}]" if aliases else '', details]
+    return " ".join(part for part in parts if part)
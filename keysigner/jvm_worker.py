@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import sys
+import queue
+import shutil
+import struct
+import time
+import hashlib
+import asyncio
+import functools
+import threading
+import subprocess
+from .tool_runner import ToolResult, run_process, run_process_async, tool_runner
+from .trace import span
+
+READY = 0x4B53574B
+ACCEPTED = 0x4B535741
+WORKER_CLASS = 'KeySignerWorker'
+JVM_TOOLS = ['keytool', 'apksigner']
+
+def find_apksigner_jar(preferred=None):
+    candidates = [preferred, os.environ.get('KEYSIGNER_APKSIGNER_JAR')]
+    apksigner = shutil.which('apksigner')
+    if apksigner:
+        # build-tools/<version>/apksigner and Termux both keep the jar next to the launcher script
+        bin_dir = os.path.dirname(os.path.realpath(apksigner))
+        candidates.extend([
+            os.path.join(bin_dir, 'lib', 'apksigner.jar'),
+            os.path.join(bin_dir, 'apksigner.jar'),
+            os.path.join(bin_dir, '..', 'share', 'java', 'apksigner.jar'),
+        ])
+    for candidate in candidates:
+        if candidate and os.path.isfile(candidate):
+            return os.path.abspath(candidate)
+    return None
+
+def supports_tool(cmd, apksigner_jar):
+    if not cmd or cmd[0] not in JVM_TOOLS:
+        return False
+    return cmd[0] != 'apksigner' or apksigner_jar is not None
+
+def provider_arguments():
+    # keytool options loading BouncyCastle, needed for BKS keystores
+    provider_path = os.path.join(os.path.dirname(__file__), 'lib', 'bcprov-jdk18on-1.78.jar')
+    return ['-providerclass', 'org.bouncycastle.jce.provider.BouncyCastleProvider', '-providerpath', provider_path]
+
+@functools.lru_cache(maxsize=None)
+def java_feature_version(java):
+    # JAVA_VERSION in the runtime's release file, or the version line of java -version
+    match = None
+    try:
+        with open(os.path.join(os.path.dirname(os.path.dirname(java)), 'release'), 'r') as f:
+            match = re.search(r'^JAVA_VERSION="([^"]+)"', f.read(), re.MULTILINE)
+    except OSError:
+        pass
+    if match is None:
+        try:
+            result = run_process([java, '-version'], capture_output=True)
+        except (OSError, subprocess.SubprocessError):
+            return None
+        match = re.search(r'version "([^"]+)"', (result.stderr or '') + (result.stdout or ''))
+    if match is None:
+        return None
+    # 1.8.0_402 is Java 8, 17.0.10 is Java 17
+    parts = re.findall(r'\d+', match.group(1))
+    if not parts:
+        return None
+    return int(parts[1]) if parts[0] == '1' and len(parts) > 1 else int(parts[0])
+
+class JVMWorker:
+    def __init__(self, apksigner_jar=None, cache_dir=None):
+        self.root_dir = os.path.dirname(__file__)
+        self.lib_path = os.path.join(self.root_dir, 'lib')
+        self.source_path = os.path.join(self.lib_path, f'{WORKER_CLASS}.java')
+        self.provider_path = os.path.join(self.lib_path, 'bcprov-jdk18on-1.78.jar')
+        self.apksigner_jar = find_apksigner_jar(apksigner_jar)
+        self.cache_dir = cache_dir or os.path.join(os.path.expanduser('~'), '.cache', 'keysigner', 'worker')
+        self.process = None
+
+    def classpath(self, class_dir=None):
+        entries = [class_dir] if class_dir else []
+        for jar in [self.apksigner_jar, self.provider_path]:
+            if jar and os.path.isfile(jar):
+                entries.append(jar)
+        return os.pathsep.join(entries)
+
+    def compile_worker(self):
+        with open(self.source_path, 'rb') as f:
+            source_hash = hashlib.sha256(f.read()).hexdigest()[:16]
+        class_dir = os.path.join(self.cache_dir, source_hash)
+        if os.path.exists(os.path.join(class_dir, f'{WORKER_CLASS}.class')):
+            return class_dir
+        if not shutil.which('javac'):
+            return None
+        os.makedirs(class_dir, exist_ok=True)
+        result = run_process(['javac', '-nowarn', '-d', class_dir, self.source_path], capture_output=True)
+        return class_dir if result.returncode == 0 else None
+
+    def launch_command(self):
+        java_opts = ['java', '--add-opens', 'java.base/sun.security.tools.keytool=ALL-UNNAMED']
+        version = java_feature_version(os.path.realpath(shutil.which('java')))
+        if version is not None and 18 <= version <= 23:
+            # JDK 18 to 23 only allow System.setSecurityManager, which traps System.exit, with this flag.
+            # JDK 24 removed the Security Manager and refuses to start with it.
+            java_opts.append('-Djava.security.manager=allow')
+        class_dir = self.compile_worker()
+        if class_dir:
+            return java_opts + ['-cp', self.classpath(class_dir), WORKER_CLASS]
+        # Source-file mode (JDK 11+) compiles in memory once per worker start
+        return java_opts + ['-cp', self.classpath(), self.source_path]
+
+    def start(self):
+        if not shutil.which('java'):
+            return False
+        self.process = subprocess.Popen(self.launch_command(), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            (ready,) = struct.unpack('>i', self.read_exact(4))
+            if ready != READY:
+                raise EOFError("Unexpected worker handshake.")
+        except (EOFError, OSError, struct.error):
+            self.close()
+            return False
+        return True
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def supports(self, cmd):
+        return supports_tool(cmd, self.apksigner_jar)
+
+    def worker_args(self, cmd):
+        args = list(cmd[1:])
+        # BouncyCastle is already on the worker classpath, loading it again from -providerpath would defeat the preload
+        if '-providerpath' in args and os.path.isfile(self.provider_path):
+            index = args.index('-providerpath')
+            if os.path.abspath(args[index + 1]) == os.path.abspath(self.provider_path):
+                del args[index:index + 2]
+        return args
+
+    def run(self, cmd, timeout=None):
+        args = self.worker_args(cmd)
+        request = [self.pack_string(cmd[0]), struct.pack('>i', len(args))]
+        request.extend(self.pack_string(arg) for arg in args)
+        start = time.perf_counter()
+        # A request running longer than the timeout kills the worker, the pool starts a new one for the next request
+        timer = threading.Timer(timeout, self.process.kill) if timeout else None
+        if timer is not None:
+            timer.daemon = True
+            timer.start()
+        try:
+            try:
+                self.process.stdin.write(b''.join(request))
+                self.process.stdin.flush()
+                (accepted,) = struct.unpack('>i', self.read_exact(4))
+                if accepted != ACCEPTED:
+                    raise EOFError("Unexpected worker response.")
+            except (EOFError, OSError, struct.error):
+                if timer is not None and timer.finished.is_set():
+                    return self.timed_out(cmd, timeout, start)
+                # The JVM died before it read the request, the caller runs it in a fresh process instead
+                self.close()
+                return None
+            try:
+                (returncode,) = struct.unpack('>i', self.read_exact(4))
+                stdout = self.read_bytes()
+                stderr = self.read_bytes()
+            except (EOFError, OSError, struct.error):
+                if timer is not None and timer.finished.is_set():
+                    return self.timed_out(cmd, timeout, start)
+                # The tool called System.exit() or the JVM died while running it. Running it again could apply
+                # commands like -genkeypair or -importkeystore twice, so this is reported as the tool's failure.
+                self.close()
+                message = f"The JVM worker exited while running {cmd[0]}, the command may have been partially applied.\n"
+                return ToolResult(list(cmd), 1, b'', message.encode('utf-8'), time.perf_counter() - start)
+        finally:
+            if timer is not None:
+                timer.cancel()
+        return ToolResult(list(cmd), returncode, stdout, stderr, time.perf_counter() - start)
+
+    def timed_out(self, cmd, timeout, start):
+        self.close()
+        message = f"{cmd[0]} was killed after {timeout:g} seconds.\n"
+        return ToolResult(list(cmd), -9, b'', message.encode('utf-8'), time.perf_counter() - start, timed_out=True)
+
+    def pack_string(self, value):
+        data = value.encode('utf-8')
+        return struct.pack('>i', len(data)) + data
+
+    def read_exact(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.process.stdout.read(size - len(data))
+            if not chunk:
+                raise EOFError("JVM worker closed the connection.")
+            data += chunk
+        return data
+
+    def read_bytes(self):
+        (size,) = struct.unpack('>i', self.read_exact(4))
+        return self.read_exact(size)
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except Exception:
+            self.process.kill()
+        self.process = None
+
+class JVMWorkerPool:
+    def __init__(self, size=1, apksigner_jar=None):
+        self.size = max(1, size)
+        self.apksigner_jar = find_apksigner_jar(apksigner_jar)
+        self.idle = queue.Queue()
+        self.started = 0
+        self.lock = threading.Lock()
+        self.unavailable = False
+
+    def acquire(self):
+        while True:
+            start = False
+            with self.lock:
+                if self.idle.empty() and self.started < self.size and not self.unavailable:
+                    # Take the slot now and start the JVM outside the lock, other callers keep using the idle workers
+                    self.started += 1
+                    start = True
+                elif self.started == 0 and self.unavailable:
+                    # Pass the wake-up on to the next caller waiting for the worker that failed to start
+                    self.idle.put(None)
+                    return None
+            if start:
+                worker = JVMWorker(self.apksigner_jar)
+                if worker.start():
+                    return worker
+                with self.lock:
+                    self.started -= 1
+                    self.unavailable = True
+                continue
+            worker = self.idle.get()
+            if worker is not None:
+                return worker
+
+    def release(self, worker):
+        if worker.alive():
+            self.idle.put(worker)
+            return
+        with self.lock:
+            self.started -= 1
+        # Wake up a waiting caller so it can start a replacement worker
+        self.idle.put(None)
+
+    def run(self, cmd, timeout=None):
+        # Checked before acquire(), which may start a JVM
+        if not supports_tool(cmd, self.apksigner_jar):
+            return None
+        worker = self.acquire()
+        if worker is None:
+            return None
+        try:
+            return worker.run(cmd, timeout)
+        finally:
+            self.release(worker)
+
+    def close(self):
+        while not self.idle.empty():
+            worker = self.idle.get()
+            if worker is not None:
+                worker.close()
+        self.started = 0
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def enable_jvm_worker(size=1, apksigner_jar=None):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = JVMWorkerPool(size, apksigner_jar)
+        return _pool
+
+def disable_jvm_worker():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+        _pool = None
+
+def jvm_worker_pool(apksigner_jar=None):
+    if _pool is None and os.environ.get('KEYSIGNER_JVM_WORKER', '').lower() in ['1', 'true', 'yes']:
+        size = int(os.environ.get('KEYSIGNER_JVM_WORKERS', '1'))
+        enable_jvm_worker(size, apksigner_jar)
+    return _pool
+
+def worker_result(result, capture_output):
+    if capture_output:
+        result.stdout = result.stdout.decode('utf-8', 'replace')
+        result.stderr = result.stderr.decode('utf-8', 'replace')
+    else:
+        sys.stdout.write(result.stdout.decode('utf-8', 'replace'))
+        sys.stderr.write(result.stderr.decode('utf-8', 'replace'))
+        sys.stdout.flush()
+        result.stdout = result.stderr = None
+    return result
+
+def run_tool(cmd, capture_output=False, apksigner_jar=None, stdin=None, timeout=None):
+    pool = jvm_worker_pool(apksigner_jar)
+    if pool is not None and cmd and cmd[0] in JVM_TOOLS:
+        with span(f"jvm worker {cmd[0]}", 'process'):
+            result = pool.run(cmd, timeout if timeout is not None else tool_runner().timeout)
+        if result is not None:
+            return worker_result(result, capture_output)
+    # The worker always gives the tool an empty stdin, stdin=subprocess.DEVNULL does the same for a new JVM
+    return run_process(cmd, capture_output=capture_output, stdin=stdin, timeout=timeout)
+
+async def run_tool_async(cmd, capture_output=True, apksigner_jar=None, stdin=None, timeout=None):
+    pool = jvm_worker_pool(apksigner_jar)
+    if pool is not None and cmd and cmd[0] in JVM_TOOLS:
+        # The worker protocol is a blocking pipe, requests wait for a worker in a thread
+        result = await asyncio.to_thread(pool.run, cmd, timeout if timeout is not None else tool_runner().timeout)
+        if result is not None:
+            return worker_result(result, capture_output)
+    return await run_process_async(cmd, capture_output=capture_output, stdin=stdin, timeout=timeout)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import hmac
+import hashlib
+import threading
+from collections import OrderedDict
+from .native_signer import load_signing_key
+
+DEFAULT_TTL = 300
+DEFAULT_MAX_ENTRIES = 8
+
+class KeyCacheEntry:
+    def __init__(self, private_key, certificates, ttl):
+        self.private_key = private_key
+        self.certificates = certificates
+        self.expires = time.monotonic() + ttl
+
+    def clear(self):
+        # Python cannot overwrite the key in place: dropping the last reference frees the OpenSSL key object,
+        # which clears its private components. Callers still holding the key keep it alive until they finish.
+        self.private_key = None
+        self.certificates = None
+
+class KeyCache:
+    # Unlocked signing keys, so that a batch decrypts each keystore (PBKDF iterations included) once
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.loading = {}
+        self.lock = threading.Lock()
+        # Passwords are part of the lookup key, keyed with a per-process secret instead of being kept
+        self.secret = os.urandom(32)
+        self.hits = 0
+        self.misses = 0
+
+    def cache_key(self, key_spec, lib_path):
+        store_type = key_spec.get('type', '').lower()
+        if store_type in ['pem', 'test']:
+            paths = [key_spec.get('cert') or os.path.join(lib_path, 'testkey.x509.pem'), key_spec.get('key') or os.path.join(lib_path, 'testkey.pk8')]
+            password = ''
+        else:
+            paths = [key_spec['keystore']]
+            password = f"{key_spec.get('store_pass', '')}\0{key_spec.get('key_pass') or ''}"
+        # Replacing a key file on disk must not return the old key
+        files = tuple((os.path.abspath(path), os.stat(path).st_mtime_ns, os.stat(path).st_size) for path in paths)
+        password_tag = hmac.new(self.secret, password.encode('utf-8'), hashlib.sha256).digest()
+        return (store_type, files, (key_spec.get('alias') or '').lower(), password_tag)
+
+    def get(self, key_spec, lib_path, loader=load_signing_key):
+        key = self.cache_key(key_spec, lib_path)
+        while True:
+            with self.lock:
+                self.expire()
+                entry = self.entries.get(key)
+                if entry is not None:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry.private_key, entry.certificates
+                event = self.loading.get(key)
+                if event is None:
+                    # This thread unlocks the key, concurrent workers wait for it instead of decrypting too
+                    event = self.loading[key] = threading.Event()
+                    self.misses += 1
+                    break
+            event.wait()
+
+        try:
+            private_key, certificates = loader(key_spec, lib_path)
+            with self.lock:
+                self.entries[key] = KeyCacheEntry(private_key, certificates, self.ttl)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)[1].clear()
+            return private_key, certificates
+        finally:
+            with self.lock:
+                del self.loading[key]
+            event.set()
+
+    def expire(self):
+        now = time.monotonic()
+        for key in [key for key, entry in self.entries.items() if entry.expires <= now]:
+            self.entries.pop(key).clear()
+
+    def clear(self):
+        with self.lock:
+            while self.entries:
+                self.entries.popitem()[1].clear()
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'ttl': self.ttl, 'max_entries': self.max_entries}
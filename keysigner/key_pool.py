@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from .keystore_writer import generate_private_key, pkcs8
+
+try:
+    from cryptography.hazmat.primitives import serialization
+except ImportError:
+    serialization = None
+
+def generate_key_der(algorithm, key_size):
+    # Runs in a pool process: keys cross the process boundary as unencrypted PKCS8 over the pool's pipe
+    return pkcs8(generate_private_key(algorithm, key_size))
+
+class KeyPairPool:
+    # Generates keypairs in worker processes ahead of demand, so that taking one only costs the wait for a
+    # generation that is already running (or nothing, when the pool is ahead) instead of a full prime search.
+    def __init__(self, workers=None, depth=0):
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.depth = depth
+        self.executor = None
+        self.pending = defaultdict(deque)
+        self.lock = threading.Lock()
+
+    def start(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self
+
+    def prefill(self, algorithm, key_size, count=None):
+        # Queue generations so that `count` keys of this kind are ready or running
+        self.start()
+        with self.lock:
+            queue = self.pending[(algorithm, key_size)]
+            for _ in range(max(0, (self.depth if count is None else count) - len(queue))):
+                queue.append(self.executor.submit(generate_key_der, algorithm, key_size))
+
+    def take(self, algorithm, key_size):
+        self.start()
+        with self.lock:
+            queue = self.pending[(algorithm, key_size)]
+            future = queue.popleft() if queue else self.executor.submit(generate_key_der, algorithm, key_size)
+            # Keep `depth` generations ahead of demand
+            while len(queue) < self.depth:
+                queue.append(self.executor.submit(generate_key_der, algorithm, key_size))
+        return serialization.load_der_private_key(future.result(), password=None)
+
+    def close(self):
+        with self.lock:
+            for queue in self.pending.values():
+                for future in queue:
+                    future.cancel()
+            self.pending.clear()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def key_pair_pool():
+    # Shared background pool of the interactive generator, enabled with KEYSIGNER_KEY_POOL=<depth>
+    global _pool
+    depth = int(os.environ.get('KEYSIGNER_KEY_POOL', '0') or 0)
+    if depth <= 0 or serialization is None:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = KeyPairPool(depth=depth)
+        return _pool
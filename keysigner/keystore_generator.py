@@ -1,23 +1,77 @@
 # -*- coding: utf-8 -*-
 
 import os
+import csv
+import json
+import time
+import shutil
+import hashlib
+import tempfile
 import subprocess
+import functools
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from .jvm_worker import run_tool, provider_arguments
+from .key_pool import KeyPairPool, key_pair_pool
+from .keystore_info import default_backend
+from .keystore_writer import (
+    STORE_TYPES, EC_CURVES, DEFAULT_VALIDITY, KeystoreWriterEntry, writer_available, parse_key_algorithm,
+    key_algorithm_name, generate_private_key, self_signed_certificate, certificate_der, write_keystore, writer_entries, check_aliases
+)
+from .keystore_reader import KeystorePasswordError, read_keystore
+from .journal import log_command, record, journal_batch
+from .checkpoint import Checkpoint
+from .trace import traced
 from .utils import *
 
+STORE_EXTENSIONS = {'JKS': 'jks', 'BKS': 'bks', 'PKCS12': 'p12'}
+EXTENSION_STORE_TYPES = {'.jks': 'JKS', '.keystore': 'JKS', '.bks': 'BKS', '.p12': 'PKCS12', '.pfx': 'PKCS12'}
+# Passwords of new keystores and aliases, for the interactive prompt and bulk generation alike
+MIN_PASSWORD_LENGTH = 8
+
+def keytool_genkeypair_command(store_type, store_path, store_pass, alias, key_pass, dname, validity, key_algorithm, key_size):
+    cmd = [
+        'keytool', '-genkeypair',
+        '-keyalg', key_algorithm,
+    ]
+    if key_algorithm == 'EC':
+        cmd.extend(['-groupname', EC_CURVES[key_size]])
+    else:
+        cmd.extend(['-keysize', str(key_size)])
+    cmd.extend([
+        '-storetype', store_type,
+        '-keystore', store_path,
+        '-storepass', store_pass,
+        '-validity', str(validity),
+        '-dname', dname,
+        '-alias', alias,
+        '-keypass', store_pass if store_type == 'PKCS12' else key_pass,
+    ])
+    if store_type == 'BKS':
+        cmd.extend(provider_arguments())
+    return cmd
+
 class KeystoreGenerator:
-    def __init__(self):
+    def __init__(self, timeout=None):
         self.store_type = None
         self.store_name = None
         self.store_pass = None
         self.alias = None
         self.key_pass = None
         self.validity = '36500'
+        self.key_algorithm = 'RSA'
+        self.key_size = 2048
         self.dname = None
         self.output_path = None
         self.store_path = None
         self.provider_class = None
         self.provider_path = None
+        self.timeout = timeout
+        self.backend = default_backend()
+        self.key_pool = None
+        self.existing_entries = []
 
+    @traced('input', 'prompt')
     def set_keystore_details(self):
         print_blue("\n--- Setting Keystore Details ---")
         while True:
@@ -27,13 +81,24 @@ class KeystoreGenerator:
                 break
             else:
                 print_red("Invalid keystore type. Please try again.")
+        while True:
+            key_algorithm = validate_input(cyan_text("Enter key algorithm (RSA-2048/RSA-3072/RSA-4096/EC-P256, default: RSA-2048): "), required=False) or 'RSA-2048'
+            try:
+                self.key_algorithm, self.key_size = parse_key_algorithm(key_algorithm)
+                break
+            except ValueError as e:
+                print_red(str(e))
+        self.key_pool = key_pair_pool() if self.native() else None
+        if self.key_pool is not None:
+            # The keypair is generated while the remaining details are entered
+            self.key_pool.prefill(self.key_algorithm, self.key_size, max(1, self.key_pool.depth))
         self.store_name = validate_input(cyan_text("Enter keystore name: "))
-        self.store_pass = validate_input(cyan_text("Enter keystore password: "), password=True, min_length=8)
+        self.store_pass = validate_input(cyan_text("Enter keystore password: "), password=True, min_length=MIN_PASSWORD_LENGTH)
         self.alias = validate_input(cyan_text("Enter alias name: "))
         if self.store_type == 'PKCS12':
             self.key_pass = self.store_pass
         else:
-            self.key_pass = validate_input(cyan_text("Enter alias password (default: same as keystore password): "), pass_opt=self.store_pass, min_length=8)
+            self.key_pass = validate_input(cyan_text("Enter alias password (default: same as keystore password): "), pass_opt=self.store_pass, min_length=MIN_PASSWORD_LENGTH)
         self.validity = validate_input(cyan_text("Enter validity (days, default 36500): "), required=False) or '36500'
         self.dname = self.generate_dname()
         if self.store_type == 'BKS':
@@ -53,6 +118,7 @@ class KeystoreGenerator:
         else:
             self.store_path = os.path.join(self.output_path, f"{self.store_name}.{self.store_type.lower()}")
 
+    @traced('input dname', 'prompt')
     def generate_dname(self):
         print_blue("\n--- Generating Distinguished Name (Press enter to skip) ---")
         cn = validate_input(cyan_text("Enter CN (Common Name): "), required=False)
@@ -75,41 +141,63 @@ class KeystoreGenerator:
         
         return ", ".join(dname_parts)
 
+    @traced('build command', 'command')
     def generate_keytool_command(self):
-        cmd = [
-            'keytool', '-genkeypair',
-            '-keyalg', 'RSA',
-            '-keysize', '2048',
-            '-storetype', self.store_type,
-            '-keystore', self.store_path,
-            '-storepass', self.store_pass,
-            '-validity', self.validity,
-            '-dname', self.dname,
-            '-alias', self.alias,
-        ]
-        if self.store_type == 'PKCS12':
-            cmd.extend(['-keypass', self.store_pass,])
+        return keytool_genkeypair_command(
+            self.store_type, self.store_path, self.store_pass, self.alias, self.key_pass,
+            self.dname, self.validity, self.key_algorithm, self.key_size
+        )
+
+    def native(self):
+        return self.backend == 'native' and writer_available()
+
+    def generate_native(self):
+        if self.key_pool is not None:
+            private_key = self.key_pool.take(self.key_algorithm, self.key_size)
         else:
-            cmd.extend(['-keypass', self.key_pass,])
-        
-        if self.provider_class and self.provider_path:
-            cmd.extend(['-providerclass', self.provider_class, '-providerpath', self.provider_path])
-        return cmd
+            private_key = generate_private_key(self.key_algorithm, self.key_size)
+        certificate = self_signed_certificate(private_key, self.dname, self.validity)
+        entries = self.existing_entries + [KeystoreWriterEntry(self.alias, private_key, [certificate], self.key_pass)]
+        write_keystore(self.store_path, self.store_type, entries, self.store_pass)
 
     def generate_keystore(self):
         try:
             self.set_keystore_details()
             self.cmd = self.generate_keytool_command()
-            print_blue("\n--- Executing KeyTool Command ---")
-            result = subprocess.run(self.cmd)
-            
-            if result.returncode != 0:
-                print_red("Keystore generation failed.")
-                return
-            
-            print_green("KeyTool command executed successfully!")
+            native = self.native()
+            if native and os.path.exists(self.store_path):
+                # The entries already in the keystore are kept and the keystore is written once with the new one
+                try:
+                    self.existing_entries = writer_entries(read_keystore(self.store_path, self.store_pass, self.store_type), self.store_pass)
+                except (KeystorePasswordError, NotImplementedError) as e:
+                    # Aliases with their own passwords, or entries the writer cannot copy, are left to keytool
+                    print_yellow(f"{e} Adding the entry with keytool.")
+                    native = False
+            if native:
+                print_blue("\n--- Generating Keystore ---")
+                self.generate_native()
+                print_green("Keystore generated successfully!")
+            else:
+                print_blue("\n--- Executing KeyTool Command ---")
+                result = run_tool(self.cmd, timeout=self.timeout)
+                
+                if result.returncode != 0:
+                    print_red("Keystore generation failed.")
+                    return
+                
+                print_green("KeyTool command executed successfully!")
             print_green(f"Keystore {self.store_type} generated at: {self.store_path}")
-            self.handle_and_generate_command(self.cmd, f"Keystore command to generate new {self.store_type}")
+            if native:
+                # No keytool command was run, only the event is recorded
+                record(
+                    self.output_path, 'generate', keystore=self.store_path, alias=self.alias, store_type=self.store_type,
+                    key_algorithm=key_algorithm_name(self.key_algorithm, self.key_size), backend='native'
+                )
+            else:
+                log_command(
+                    self.output_path, f"Keystore command to generate new {self.store_type}", self.cmd, event='generate',
+                    keystore=self.store_path, alias=self.alias, store_type=self.store_type, backend='keytool'
+                )
             
             if self.store_type != 'BKS':
                 self.generate_apksigner_command(self.store_path, self.store_pass, self.alias, self.key_pass)
@@ -117,23 +205,6 @@ class KeystoreGenerator:
             print_red(f"Error occurred: {e}")
             exit()
 
-    def handle_and_generate_command(self, cmd_list, description):
-        print_blue(f"\n--- {description} ---")
-        full_command = []
-        for cmd in cmd_list:
-            if ' ' in cmd:
-                full_command.append(f'"{cmd}"')
-            else:
-                full_command.append(cmd)
-        full_command = " ".join(full_command)
-        
-        cmd_file = os.path.abspath(os.path.join(self.output_path, f"{self.store_name}_{self.store_type}_commands.txt"))
-        with open(cmd_file, 'a') as f:
-            f.write(f"{description}:\n")
-            f.write(full_command)
-            f.write("\n\n")
-        print_green(f"{description} exported to {cmd_file}")
-
     def generate_apksigner_command(self, keystore_path, store_pass, alias, key_pass):
         cmd = [
             "apksigner", "sign",
@@ -148,4 +219,245 @@ class KeystoreGenerator:
             "--out", "signed.apk", "unsigned.apk"
         ]
     
-        self.handle_and_generate_command(cmd, "APK Signer Command")
\ No newline at end of file
+        log_command(self.output_path, "APK Signer Command", cmd, keystore=keystore_path, alias=alias)
+
+class BulkKeystoreGenerator:
+    # Mints one keystore per spec: {name, alias, dname, store_type, store_pass, key_pass, key_algorithm, validity}
+    def __init__(self, store_type='PKCS12', store_pass=None, key_pass=None, key_algorithm='RSA-2048', validity=DEFAULT_VALIDITY, output_path=None, backend=None, timeout=None):
+        self.store_type = store_type.upper()
+        self.store_pass = store_pass
+        self.key_pass = key_pass
+        self.key_algorithm = key_algorithm
+        self.validity = validity
+        self.output_path = output_path
+        self.backend = backend or default_backend()
+        self.timeout = timeout
+
+    def load_specs(self, path):
+        with open(path, 'r', newline='') as f:
+            if path.lower().endswith('.csv'):
+                return [{key.strip(): value.strip() for key, value in row.items() if key and value and value.strip()} for row in csv.DictReader(f)]
+            specs = json.load(f)
+        return specs.get('keystores', []) if isinstance(specs, dict) else specs
+
+    def normalize(self, spec):
+        if not spec.get('name'):
+            raise ValueError("Every keystore needs a name.")
+        store_type = str(spec.get('store_type') or self.store_type).upper()
+        if store_type not in STORE_TYPES:
+            raise ValueError(f"Invalid keystore type '{store_type}'. Expected one of: {', '.join(STORE_TYPES)}.")
+        store_pass = spec.get('store_pass') or self.store_pass
+        key_pass = store_pass if store_type == 'PKCS12' else (spec.get('key_pass') or self.key_pass or store_pass)
+        for label, password in [('keystore', store_pass), ('alias', key_pass)]:
+            if not password or len(password) < MIN_PASSWORD_LENGTH:
+                raise ValueError(f"The {label} password must be at least {MIN_PASSWORD_LENGTH} characters long.")
+        key_algorithm, key_size = parse_key_algorithm(spec.get('key_algorithm') or self.key_algorithm, spec.get('key_size'))
+        return {
+            'name': spec['name'],
+            'alias': spec.get('alias') or spec['name'],
+            'dname': spec.get('dname') or 'CN=Unknown',
+            'store_type': store_type,
+            'store_pass': store_pass,
+            'key_pass': key_pass,
+            'key_algorithm': key_algorithm,
+            'key_size': key_size,
+            'validity': int(spec.get('validity') or self.validity),
+            'path': os.path.join(self.output_path, f"{spec['name']}.{STORE_EXTENSIONS[store_type]}"),
+        }
+
+    @traced('generate keystore', 'keystore')
+    def generate_one(self, spec, key_pool=None, replace=False):
+        # replace: an existing keystore at the path is replaced in one rename once the new one is complete
+        start = time.perf_counter()
+        result = {
+            'name': spec.get('name'),
+            'alias': None,
+            'path': None,
+            'store_type': None,
+            'key_algorithm': None,
+            'sha256': None,
+            'success': False,
+            'error': None,
+        }
+        cmd = None
+        temp_dir = None
+        try:
+            spec = self.normalize(spec)
+            result.update({key: spec[key] for key in ['alias', 'path', 'store_type']})
+            result['key_algorithm'] = key_algorithm_name(spec['key_algorithm'], spec['key_size'])
+            if os.path.exists(spec['path']) and not replace:
+                raise FileExistsError(f"{spec['path']} already exists.")
+            if self.backend == 'native' and writer_available():
+                if key_pool is not None:
+                    private_key = key_pool.take(spec['key_algorithm'], spec['key_size'])
+                else:
+                    private_key = generate_private_key(spec['key_algorithm'], spec['key_size'])
+                certificate = self_signed_certificate(private_key, spec['dname'], spec['validity'])
+                write_keystore(spec['path'], spec['store_type'], [KeystoreWriterEntry(spec['alias'], private_key, [certificate], spec['key_pass'])], spec['store_pass'])
+                result['sha256'] = hashlib.sha256(certificate_der(certificate)).hexdigest()
+            else:
+                target = spec['path']
+                if replace:
+                    # keytool would add the entry to the existing keystore, it creates a new one in an empty directory
+                    temp_dir = tempfile.mkdtemp(prefix='.keysigner-', dir=os.path.dirname(spec['path']))
+                    target = os.path.join(temp_dir, os.path.basename(spec['path']))
+                cmd = keytool_genkeypair_command(
+                    spec['store_type'], target, spec['store_pass'], spec['alias'], spec['key_pass'],
+                    spec['dname'], spec['validity'], spec['key_algorithm'], spec['key_size']
+                )
+                completed = run_tool(cmd, capture_output=True, stdin=subprocess.DEVNULL, timeout=self.timeout)
+                if completed.returncode != 0:
+                    raise RuntimeError((completed.stdout or completed.stderr or '').strip() or f"keytool exited with status {completed.returncode}")
+                if target != spec['path']:
+                    os.replace(target, spec['path'])
+            result['success'] = True
+        except Exception as e:
+            result['error'] = str(e)
+        finally:
+            if temp_dir:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+        result['seconds'] = round(time.perf_counter() - start, 3)
+        record(
+            self.output_path, 'generate', name=result['name'], keystore=result['path'], alias=result['alias'], store_type=result['store_type'],
+            key_algorithm=result['key_algorithm'], sha256=result['sha256'], backend='keytool' if cmd else ('native' if result['success'] else None),
+            command=cmd, success=result['success'], error=result['error']
+        )
+        return result
+
+    def checkpoint_inputs(self, spec):
+        # Passwords are not recorded, changing one alone does not generate the keystore again
+        return {
+            'spec': {key: value for key, value in spec.items() if key not in ['store_pass', 'key_pass']},
+            'defaults': [self.store_type, self.key_algorithm, self.validity],
+        }
+
+    @journal_batch()
+    def generate_many(self, specs, workers=None, checkpoint=None):
+        self.output_path = ensure_directory(self.output_path)
+        workers = max(1, workers or os.cpu_count() or 1)
+        names = [spec.get('name') for spec in specs]
+        duplicates = {name for name in names if name and names.count(name) > 1}
+        if duplicates:
+            raise ValueError(f"Duplicate keystore names: {', '.join(sorted(duplicates))}")
+
+        checkpoint = (checkpoint or Checkpoint('generate', retries=0, enabled=False)).start(self.output_path)
+        key_pool = None
+        if self.backend == 'native' and writer_available():
+            # Prime searches run in worker processes, all of them queued up front; threads only
+            # wait for their keypair and serialize the keystore
+            key_pool = KeyPairPool(workers).start()
+            kinds = Counter()
+            for spec in specs:
+                if checkpoint.completed(spec.get('name'), self.checkpoint_inputs(spec)):
+                    # Resumed, no keypair needed
+                    continue
+                try:
+                    kinds[parse_key_algorithm(spec.get('key_algorithm') or self.key_algorithm, spec.get('key_size'))] += 1
+                except ValueError:
+                    # Reported by generate_one
+                    pass
+            for (key_algorithm, key_size), count in kinds.items():
+                key_pool.prefill(key_algorithm, key_size, count)
+        try:
+            with ThreadPoolExecutor(max_workers=min(workers, len(specs) or 1)) as executor:
+                return list(executor.map(
+                    lambda spec: checkpoint.run(spec.get('name'), functools.partial(self.generate_one, spec, key_pool), functools.partial(self.checkpoint_inputs, spec), lambda result: [result['path']]),
+                    specs
+                ))
+        finally:
+            if key_pool is not None:
+                key_pool.close()
+
+class KeystoreBuilder:
+    # Several key entries in one keystore: {alias, dname, key_algorithm, validity, key_pass} each. The keypairs are
+    # generated in worker processes, then the keystore is serialized and written once, where keytool would start a
+    # JVM and reload, re-encrypt and rewrite the whole keystore for every entry.
+    def __init__(self, store_type=None, store_pass=None, key_algorithm='RSA-2048', validity=DEFAULT_VALIDITY, options=None, workers=None):
+        self.store_type = store_type.upper() if store_type else None
+        self.store_pass = store_pass
+        self.key_algorithm = key_algorithm
+        self.validity = validity
+        # PKCS12Writer parameters: key_encryption, cert_encryption, iterations, mac, mac_iterations
+        self.options = options or {}
+        self.workers = max(1, workers or os.cpu_count() or 1)
+
+    def load_entries(self, path):
+        with open(path, 'r', newline='') as f:
+            if path.lower().endswith('.csv'):
+                return [{key.strip(): value.strip() for key, value in row.items() if key and value and value.strip()} for row in csv.DictReader(f)]
+            entries = json.load(f)
+        return entries.get('entries', []) if isinstance(entries, dict) else entries
+
+    def normalize(self, entry, store_type):
+        if not entry.get('alias'):
+            raise ValueError("Every entry needs an alias.")
+        key_pass = self.store_pass if store_type == 'PKCS12' else (entry.get('key_pass') or self.store_pass)
+        if not key_pass or len(key_pass) < MIN_PASSWORD_LENGTH:
+            raise ValueError(f"The alias password of '{entry['alias']}' must be at least {MIN_PASSWORD_LENGTH} characters long.")
+        key_algorithm, key_size = parse_key_algorithm(entry.get('key_algorithm') or self.key_algorithm, entry.get('key_size'))
+        return {
+            'alias': entry['alias'],
+            'dname': entry.get('dname') or 'CN=Unknown',
+            'key_pass': key_pass,
+            'key_algorithm': key_algorithm,
+            'key_size': key_size,
+            'validity': int(entry.get('validity') or self.validity),
+        }
+
+    @traced('build keystore', 'keystore')
+    def build(self, path, entries, append=False, key_passes=None):
+        # key_passes: alias -> key password of the entries already in the keystore (default: the keystore password)
+        if not writer_available():
+            raise ImportError("Building keystores in-process requires the 'cryptography' package (pip install keysigner[native]).")
+        path = os.path.abspath(path)
+        store_type = self.store_type or EXTENSION_STORE_TYPES.get(os.path.splitext(path)[1].lower(), 'PKCS12')
+        if store_type not in STORE_TYPES:
+            raise ValueError(f"Invalid keystore type '{store_type}'. Expected one of: {', '.join(STORE_TYPES)}.")
+        if self.options and store_type != 'PKCS12':
+            raise ValueError(f"Encryption options are only supported for PKCS12 keystores, not {store_type}.")
+        if not self.store_pass or len(self.store_pass) < MIN_PASSWORD_LENGTH:
+            raise ValueError(f"The keystore password must be at least {MIN_PASSWORD_LENGTH} characters long.")
+        entries = [self.normalize(entry, store_type) for entry in entries]
+        if not entries:
+            raise ValueError("No entries listed.")
+
+        existing = []
+        if os.path.exists(path):
+            if not append:
+                raise FileExistsError(f"{path} already exists, use append to add the entries to it.")
+            existing = writer_entries(read_keystore(path, self.store_pass, store_type), self.store_pass, key_passes)
+        # Checked before any key is generated
+        check_aliases([entry.alias for entry in existing] + [entry['alias'] for entry in entries])
+
+        key_pool = None
+        if len(entries) > 1 and self.workers > 1:
+            key_pool = KeyPairPool(min(self.workers, len(entries))).start()
+            kinds = Counter((entry['key_algorithm'], entry['key_size']) for entry in entries)
+            for (key_algorithm, key_size), count in kinds.items():
+                key_pool.prefill(key_algorithm, key_size, count)
+        results = []
+        new_entries = []
+        try:
+            for entry in entries:
+                if key_pool is not None:
+                    private_key = key_pool.take(entry['key_algorithm'], entry['key_size'])
+                else:
+                    private_key = generate_private_key(entry['key_algorithm'], entry['key_size'])
+                certificate = self_signed_certificate(private_key, entry['dname'], entry['validity'])
+                new_entries.append(KeystoreWriterEntry(entry['alias'], private_key, [certificate], entry['key_pass']))
+                results.append({
+                    'alias': entry['alias'],
+                    'key_algorithm': key_algorithm_name(entry['key_algorithm'], entry['key_size']),
+                    'sha256': hashlib.sha256(certificate_der(certificate)).hexdigest(),
+                })
+        finally:
+            if key_pool is not None:
+                key_pool.close()
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_keystore(path, store_type, existing + new_entries, self.store_pass, self.options or None)
+        record(
+            os.path.dirname(path), 'generate', keystore=path, aliases=[result['alias'] for result in results], store_type=store_type,
+            key_algorithm=sorted({result['key_algorithm'] for result in results}), backend='native', append=bool(existing), success=True
+        )
+        return {'path': path, 'store_type': store_type, 'kept': [entry.alias for entry in existing], 'entries': results}
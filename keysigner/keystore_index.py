@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import sqlite3
+from datetime import timezone
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from .trace import traced
+from .output_cache import file_sha256
+from .keystore_reader import CertificateInfo, KeystorePasswordError, PRIVATE_KEY_ENTRY, TRUSTED_CERT_ENTRY, read_keystore, detect_store_type
+
+try:
+    from cryptography import x509
+    from cryptography.hazmat.primitives import serialization
+except ImportError:
+    x509 = None
+
+KEYSTORE_EXTENSIONS = ('.jks', '.keystore', '.bks', '.p12', '.pfx')
+CERTIFICATE_EXTENSIONS = ('.pem', '.crt', '.cer', '.der')
+# Private keys of PEM pairs: testkey.x509.pem + testkey.pk8, or server.pem + server.key
+KEY_EXTENSIONS = ('.pk8', '.key')
+WRITE_BATCH = 256
+CERTIFICATE_COLUMNS = [
+    'path', 'alias', 'entry_type', 'position', 'sha256', 'sha1', 'subject', 'issuer', 'serial_number',
+    'not_before', 'not_after', 'key_algorithm', 'key_size',
+]
+
+def default_index_path():
+    return os.path.join(os.path.expanduser('~'), '.cache', 'keysigner', 'keystore_index.sqlite')
+
+def normalize_fingerprint(value):
+    # keytool and apksigner print AB:CD:..., openssl AB:CD or abcd, all are stored as lowercase hex
+    fingerprint = ''.join(value.split()).replace(':', '').lower()
+    if not fingerprint or any(char not in '0123456789abcdef' for char in fingerprint):
+        raise ValueError(f"Invalid fingerprint '{value}', expected hex digits optionally separated by colons.")
+    return fingerprint
+
+def is_keystore_file(name):
+    return name.lower().endswith(KEYSTORE_EXTENSIONS)
+
+def is_certificate_file(name):
+    return name.lower().endswith(CERTIFICATE_EXTENSIONS)
+
+def scan_paths(roots):
+    for root in roots:
+        if os.path.isfile(root):
+            yield root
+            continue
+        for directory, dirs, files in os.walk(root):
+            dirs[:] = [name for name in dirs if not name.startswith('.')]
+            for name in files:
+                if is_keystore_file(name) or is_certificate_file(name):
+                    yield os.path.join(directory, name)
+
+def pem_pair_names(path):
+    # The alias of a PEM pair is the file name without its extensions: platform.x509.pem -> platform
+    base = path[:-len('.x509.pem')] if path.lower().endswith('.x509.pem') else os.path.splitext(path)[0]
+    key_paths = [base + extension for extension in KEY_EXTENSIONS]
+    return os.path.basename(base), next((key for key in key_paths if os.path.exists(key)), None)
+
+def certificate_rows(alias, entry_type, certificates):
+    rows = []
+    for position, certificate in enumerate(certificates):
+        info = certificate.to_dict()
+        rows.append({
+            'alias': alias,
+            'entry_type': entry_type,
+            'position': position,
+            'sha256': normalize_fingerprint(info['sha256']),
+            'sha1': normalize_fingerprint(info['sha1']),
+            'subject': info['subject'],
+            'issuer': info['issuer'],
+            'serial_number': info['serial_number'],
+            'not_before': info['not_before'],
+            'not_after': info['not_after'],
+            'key_algorithm': info['key_algorithm'],
+            'key_size': info['key_size'],
+        })
+    return rows
+
+def parse_certificate_file(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if b'-----BEGIN' in data:
+        if b'-----BEGIN CERTIFICATE-----' not in data:
+            # A PEM private key or request, the certificate of the pair is indexed instead
+            return {'store_type': 'PEM', 'status': 'ignored', 'entries': []}
+        certificates = [CertificateInfo(cert.public_bytes(serialization.Encoding.DER)) for cert in x509.load_pem_x509_certificates(data)]
+    else:
+        certificates = [CertificateInfo(data)]
+    alias, key_path = pem_pair_names(path)
+    entry_type = PRIVATE_KEY_ENTRY if key_path else TRUSTED_CERT_ENTRY
+    return {'store_type': 'PEM', 'status': 'ok', 'verified': True, 'entries': certificate_rows(alias, entry_type, certificates)}
+
+def parse_keystore_file(path, passwords):
+    with open(path, 'rb') as f:
+        store_type = detect_store_type(f.read(4))
+    error = None
+    # Without a matching password JKS and BKS entries are still listed, only the integrity check is skipped
+    for password in list(passwords) + [None]:
+        try:
+            keystore = read_keystore(path, password)
+        except KeystorePasswordError as e:
+            error = error or e
+            continue
+        entries = []
+        for entry in keystore.entries:
+            entries.extend(certificate_rows(entry.alias, entry.entry_type, entry.certificates))
+        return {'store_type': keystore.store_type, 'status': 'ok', 'verified': keystore.verified, 'entries': entries}
+    return {'store_type': store_type, 'status': 'locked', 'error': str(error), 'entries': []}
+
+def index_file(path, passwords, known_sha256=None):
+    # Runs in a pool process: a file whose content hash is unchanged is not parsed again
+    stat = os.stat(path)
+    result = {'path': path, 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'sha256': file_sha256(path)}
+    result['changed'] = result['sha256'] != known_sha256
+    if not result['changed']:
+        return result
+    try:
+        if is_certificate_file(path):
+            result.update(parse_certificate_file(path))
+        else:
+            result.update(parse_keystore_file(path, passwords))
+    except Exception as e:
+        result.update({'status': 'error', 'error': str(e) or type(e).__name__, 'entries': []})
+    return result
+
+def under(roots):
+    # Files below the roots, as range conditions on the path primary key
+    conditions = []
+    values = []
+    for root in roots:
+        prefix = root.rstrip(os.sep) + os.sep
+        conditions.append('(path = ? OR (path >= ? AND path < ?))')
+        values.extend([root, prefix, prefix[:-1] + chr(ord(os.sep) + 1)])
+    return ' OR '.join(conditions), values
+
+def utc_isoformat(value):
+    return value.astimezone(timezone.utc).isoformat(timespec='seconds')
+
+class KeystoreIndex:
+    # Aliases, fingerprints and expiry of every keystore and certificate under the scanned directories.
+    # A refresh stats each file and only hashes the ones whose mtime or size changed, and only parses the
+    # ones whose content changed. Lookups by fingerprint, alias or expiry are indexed queries.
+    def __init__(self, path=None):
+        self.path = os.path.abspath(path or default_index_path())
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self.connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS files ('
+                'path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL, sha256 TEXT NOT NULL, '
+                'store_type TEXT, status TEXT NOT NULL, verified INTEGER, error TEXT, indexed_at REAL NOT NULL) WITHOUT ROWID'
+            )
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS certificates ('
+                'path TEXT NOT NULL, alias TEXT NOT NULL, entry_type TEXT, position INTEGER NOT NULL, '
+                'sha256 TEXT NOT NULL, sha1 TEXT NOT NULL, subject TEXT, issuer TEXT, serial_number TEXT, '
+                'not_before TEXT, not_after TEXT, key_algorithm TEXT, key_size INTEGER)'
+            )
+            db.execute('CREATE INDEX IF NOT EXISTS certificates_path ON certificates (path)')
+            db.execute('CREATE INDEX IF NOT EXISTS certificates_sha256 ON certificates (sha256)')
+            db.execute('CREATE INDEX IF NOT EXISTS certificates_sha1 ON certificates (sha1)')
+            db.execute('CREATE INDEX IF NOT EXISTS certificates_alias ON certificates (alias COLLATE NOCASE)')
+            db.execute('CREATE INDEX IF NOT EXISTS certificates_not_after ON certificates (not_after)')
+
+    @contextmanager
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.row_factory = sqlite3.Row
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def known_files(self, roots):
+        condition, values = under(roots)
+        with self.connect() as db:
+            rows = db.execute(f'SELECT path, mtime_ns, size, sha256, status FROM files WHERE {condition}', values)
+            return {row['path']: (row['mtime_ns'], row['size'], row['sha256'], row['status']) for row in rows}
+
+    @traced('refresh index', 'keystore')
+    def refresh(self, roots, passwords=(), workers=None, full=False):
+        roots = [os.path.abspath(root) for root in roots]
+        known = self.known_files(roots)
+        passwords = list(passwords)
+        stats = {'files': 0, 'unchanged': 0, 'touched': 0, 'parsed': 0, 'removed': 0, 'locked': 0, 'errors': 0}
+
+        tasks = []
+        found = set()
+        for path in scan_paths(roots):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            found.add(path)
+            row = known.get(path)
+            if row is None or full:
+                tasks.append((path, None))
+            elif row[3] == 'locked' and passwords:
+                # Parsed again even when unchanged, one of the new passwords may open it
+                tasks.append((path, None))
+            elif (stat.st_mtime_ns, stat.st_size) != row[:2]:
+                tasks.append((path, row[2]))
+            else:
+                stats['unchanged'] += 1
+        stats['files'] = len(found)
+
+        removed = [path for path in known if path not in found]
+        if removed:
+            with self.connect() as db:
+                db.executemany('DELETE FROM certificates WHERE path = ?', [(path,) for path in removed])
+                db.executemany('DELETE FROM files WHERE path = ?', [(path,) for path in removed])
+            stats['removed'] = len(removed)
+
+        workers = max(1, workers or os.cpu_count() or 1)
+        if len(tasks) < 2 or workers == 1:
+            results = (index_file(path, passwords, sha256) for path, sha256 in tasks)
+            self.store(results, stats)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(index_file, path, passwords, sha256) for path, sha256 in tasks]
+                self.store((future.result() for future in futures), stats)
+        return stats
+
+    def store(self, results, stats):
+        # Results are written in batches, an interrupted refresh keeps what it has parsed
+        batch = []
+        for result in results:
+            batch.append(result)
+            if len(batch) >= WRITE_BATCH:
+                self.write(batch, stats)
+                batch = []
+        if batch:
+            self.write(batch, stats)
+
+    def write(self, results, stats):
+        now = time.time()
+        with self.connect() as db:
+            for result in results:
+                if not result['changed']:
+                    stats['touched'] += 1
+                    db.execute('UPDATE files SET mtime_ns = ?, size = ?, indexed_at = ? WHERE path = ?', (result['mtime_ns'], result['size'], now, result['path']))
+                    continue
+                stats['parsed'] += 1
+                stats['locked'] += result['status'] == 'locked'
+                stats['errors'] += result['status'] == 'error'
+                db.execute('DELETE FROM certificates WHERE path = ?', (result['path'],))
+                db.executemany(
+                    f"INSERT INTO certificates ({', '.join(CERTIFICATE_COLUMNS)}) VALUES ({', '.join('?' * len(CERTIFICATE_COLUMNS))})",
+                    [[result['path']] + [row[column] for column in CERTIFICATE_COLUMNS[1:]] for row in result['entries']]
+                )
+                verified = result.get('verified')
+                db.execute(
+                    'INSERT OR REPLACE INTO files (path, mtime_ns, size, sha256, store_type, status, verified, error, indexed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (result['path'], result['mtime_ns'], result['size'], result['sha256'], result.get('store_type'), result['status'], None if verified is None else int(verified), result.get('error'), now)
+                )
+
+    def find(self, sha256=None, sha1=None, alias=None, subject=None, expires_before=None, expires_after=None, roots=None, leaf_only=False):
+        conditions = []
+        values = []
+        for column, value in [('sha256', sha256), ('sha1', sha1)]:
+            if value:
+                # A prefix of the fingerprint is enough, hex digits sort below 'g'
+                fingerprint = normalize_fingerprint(value)
+                conditions.append(f'c.{column} >= ? AND c.{column} < ?')
+                values.extend([fingerprint, fingerprint + 'g'])
+        if alias:
+            conditions.append('c.alias = ? COLLATE NOCASE')
+            values.append(alias)
+        if subject:
+            conditions.append('c.subject LIKE ?')
+            values.append(f'%{subject}%')
+        if expires_before:
+            conditions.append('c.not_after < ?')
+            values.append(utc_isoformat(expires_before))
+        if expires_after:
+            conditions.append('c.not_after >= ?')
+            values.append(utc_isoformat(expires_after))
+        if roots:
+            condition, root_values = under([os.path.abspath(root) for root in roots])
+            conditions.append(f"({condition.replace('path', 'c.path')})")
+            values.extend(root_values)
+        if leaf_only:
+            conditions.append('c.position = 0')
+        query = (
+            f"SELECT c.{', c.'.join(CERTIFICATE_COLUMNS)}, f.store_type, f.verified FROM certificates c JOIN files f ON f.path = c.path"
+            + (f" WHERE {' AND '.join(conditions)}" if conditions else '')
+            + ' ORDER BY c.not_after, c.path, c.alias, c.position'
+        )
+        with self.connect() as db:
+            return [dict(row) for row in db.execute(query, values)]
+
+    def files(self, statuses=None):
+        query = 'SELECT path, store_type, status, verified, error, size, indexed_at FROM files'
+        values = list(statuses or [])
+        if values:
+            query += f" WHERE status IN ({', '.join('?' * len(values))})"
+        with self.connect() as db:
+            return [dict(row) for row in db.execute(query + ' ORDER BY path', values)]
+
+    def stats(self):
+        with self.connect() as db:
+            statuses = {row['status']: row['count'] for row in db.execute('SELECT status, COUNT(*) AS count FROM files GROUP BY status')}
+            (certificates,) = db.execute('SELECT COUNT(*) FROM certificates').fetchone()
+        return {'path': self.path, 'files': sum(statuses.values()), 'statuses': statuses, 'certificates': certificates, 'size': os.path.getsize(self.path)}
+
+def format_certificate(row):
+    kind = 'key' if row['entry_type'] == PRIVATE_KEY_ENTRY else 'cert'
+    position = f"#{row['position']} " if row['position'] else ''
+    unverified = ' (unverified)' if row['verified'] == 0 else ''
+    return f"{row['path']} [{row['alias']}] {position}{kind} {row['store_type']}{unverified}\n    sha256 {row['sha256']}  expires {row['not_after']}  {row['subject']}"
@@ -1,15 +1,60 @@
 # -*- coding: utf-8 -*-
 
 import os
-import subprocess
+from .jvm_worker import run_tool
+from .keystore_reader import read_keystore, KeystorePasswordError, PRIVATE_KEY_ENTRY
+from .trace import traced
 from .utils import *
 
+BACKENDS = ['native', 'keytool']
+
+def default_backend():
+    backend = os.environ.get('KEYSIGNER_KEYSTORE_BACKEND', '').lower()
+    return backend if backend in BACKENDS else 'native'
+
+def format_keystore(keystore):
+    # Same layout as `keytool -list -v`
+    lines = [f"Keystore type: {keystore.store_type}", '']
+    count = len(keystore.entries)
+    lines.append(f"Your keystore contains {count} {'entry' if count == 1 else 'entries'}")
+    for entry in keystore.entries:
+        details = entry.to_dict()
+        lines += ['', f"Alias name: {entry.alias}"]
+        if details['created']:
+            lines.append(f"Creation date: {details['created']}")
+        lines.append(f"Entry type: {entry.entry_type}")
+        if entry.entry_type == PRIVATE_KEY_ENTRY:
+            lines.append(f"Certificate chain length: {len(details['certificates'])}")
+        for index, cert in enumerate(details['certificates']):
+            if entry.entry_type == PRIVATE_KEY_ENTRY:
+                lines.append(f"Certificate[{index + 1}]:")
+            key = f"{cert['key_size']}-bit {cert['key_algorithm']} key" + (f" ({cert['curve']})" if cert['curve'] else '')
+            lines += [
+                f"Owner: {cert['subject']}",
+                f"Issuer: {cert['issuer']}",
+                f"Serial number: {cert['serial_number']}",
+                f"Valid from: {cert['not_before']} until: {cert['not_after']}",
+                "Certificate fingerprints:",
+                f"\t SHA1: {cert['sha1']}",
+                f"\t SHA256: {cert['sha256']}",
+                f"Signature algorithm name: {cert['signature_algorithm']}",
+                f"Subject Public Key Algorithm: {key}",
+                f"Version: {cert['version']}",
+            ]
+        lines += ['', '*' * 43, '*' * 43]
+    return '\n'.join(lines)
+
 class KeystoreInfo:
-    def __init__(self):
+    def __init__(self, backend=None, timeout=None):
         self.keystore_path = None
         self.store_pass = None
         self.keystore_type = None
+        self.timeout = timeout
+        self.backend = backend or default_backend()
+        if self.backend not in BACKENDS:
+            raise ValueError(f"Invalid backend '{self.backend}'. Expected one of: {', '.join(BACKENDS)}.")
 
+    @traced('input', 'prompt')
     def get_keystore_info(self):
         print_blue("\n--- Gathering Keystore Information ---")
         self.keystore_path = validate_input(cyan_text("Enter keystore path: "), path=True)
@@ -33,31 +78,56 @@ class KeystoreInfo:
                 else:
                     print_red("Invalid keystore type. Please try again.")
 
+    def read(self, keystore_path, store_pass, keystore_type=None):
+        # Parsed in-process, without a JVM
+        return read_keystore(keystore_path, store_pass, keystore_type)
+
+    @traced('build command', 'command')
+    def keytool_command(self):
+        cmd = [
+            'keytool', '-list', '-v',
+            '-keystore', self.keystore_path,
+            '-storetype', self.keystore_type,
+            '-storepass', self.store_pass
+        ]
+        if self.keystore_type == 'BKS':
+            root_dir = os.path.dirname(__file__)
+            provider_path = os.path.join(root_dir, 'lib', 'bcprov-jdk18on-1.78.jar')
+            cmd.extend(['-providerclass', 'org.bouncycastle.jce.provider.BouncyCastleProvider', '-providerpath', provider_path])
+        return cmd
+
+    def show_native(self):
+        print_blue("\n--- Reading Keystore ---")
+        try:
+            keystore = self.read(self.keystore_path, self.store_pass, self.keystore_type)
+        except KeystorePasswordError as e:
+            print_red(f"Failed to show keystore information: {e}")
+            return True
+        except (ImportError, NotImplementedError, ValueError) as e:
+            # Formats or algorithms the reader does not handle are left to keytool
+            print_yellow(f"Could not read the keystore in-process ({e}), falling back to keytool.")
+            return False
+        print(format_keystore(keystore))
+        print_green("Keystore read successfully!")
+        return True
+
     def show_keystore_info(self):
         try:
             self.get_keystore_info()
             if not self.keystore_path or not self.store_pass or not self.keystore_type:
                 print_red("Keystore information is incomplete.")
                 return
-            cmd = [
-                'keytool', '-list', '-v',
-                '-keystore', self.keystore_path,
-                '-storetype', self.keystore_type,
-                '-storepass', self.store_pass
-            ]
-            if self.keystore_type == 'BKS':
-                root_dir = os.path.dirname(__file__)
-                provider_path = os.path.join(root_dir, 'lib', 'bcprov-jdk18on-1.78.jar')
-                cmd.extend(['-providerclass', 'org.bouncycastle.jce.provider.BouncyCastleProvider', '-providerpath', provider_path])
-            
+            if self.backend == 'native' and self.show_native():
+                return
+
             print_blue("\n--- Executing KeyTool Command ---")
-            result = subprocess.run(cmd)
-            
+            result = run_tool(self.keytool_command(), timeout=self.timeout)
+
             if result.returncode != 0:
                 print_red("Failed to show keystore information.")
                 return
-            
+
             print_green("KeyTool command executed successfully!")
         except Exception as e:
             print_red(f"Error occurred: {e}")
-            exit()
\ No newline at end of file
+            exit()
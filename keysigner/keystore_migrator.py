@@ -1,11 +1,52 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
+import time
+import shutil
+import tempfile
 import subprocess
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from .jvm_worker import run_tool, provider_arguments
+from .keystore_reader import read_keystore, detect_store_type
+from .keystore_writer import write_keystore, writer_entries, writer_available
+from .journal import log_command, record, journal_batch
+from .checkpoint import Checkpoint, file_state
+from .trace import traced
 from .utils import *
 
+STORE_TYPES = ['JKS', 'BKS', 'PKCS12']
+KEYSTORE_EXTENSIONS = {'.jks': 'JKS', '.bks': 'BKS', '.p12': 'PKCS12', '.pfx': 'PKCS12', '.keystore': None}
+IMPORT_SUMMARY = re.compile(r'(\d+) entries successfully imported, (\d+) entries failed or cancelled')
+ALIAS_LINE = re.compile(r'^Alias name: (.*)$', re.MULTILINE)
+
+def keystore_type(path):
+    store_type = KEYSTORE_EXTENSIONS.get(os.path.splitext(path)[1].lower())
+    if store_type:
+        return store_type
+    with open(path, 'rb') as f:
+        detected = detect_store_type(f.read(4))
+    if detected not in STORE_TYPES:
+        raise ValueError(f"{detected} keystores are not supported.")
+    return detected
+
+def collect_keystores(paths):
+    keystores = []
+    for path in paths:
+        if os.path.isdir(path):
+            keystores.extend(sorted(os.path.join(path, name) for name in os.listdir(path) if os.path.splitext(name)[1].lower() in KEYSTORE_EXTENSIONS))
+        else:
+            keystores.append(path)
+    return keystores
+
+def tool_output(result):
+    lines = [line for line in f"{result.stdout or ''}\n{result.stderr or ''}".splitlines() if line.strip()]
+    errors = [line for line in lines if 'error' in line.lower()]
+    return (errors or lines or [f"keytool exited with status {result.returncode}"])[-1].strip()
+
 class KeystoreMigrator:
-    def __init__(self):
+    def __init__(self, timeout=None):
         self.src_path = None
         self.src_store_type = None
         self.src_store_pass = None
@@ -20,7 +61,9 @@ class KeystoreMigrator:
         self.dest_path = None
         self.provider_class = None
         self.provider_path = None
+        self.timeout = timeout
 
+    @traced('input', 'prompt')
     def get_migration_input(self):
         print_blue("\n--- JKS/BKS/PKCS12 Keystore Migration ---")
         self.src_path = validate_input(cyan_text("Enter source keystore path: "), path=True)
@@ -42,9 +85,12 @@ class KeystoreMigrator:
                     print_red("Invalid source keystore type. Please try again.")
                     
         self.src_store_pass = validate_input(cyan_text("Enter source keystore password: "), password=True, min_length=6)
-        self.src_alias = validate_input(cyan_text("Enter source alias name: "))
+        self.src_alias = validate_input(cyan_text("Enter source alias name (leave empty to migrate all aliases): "), required=False) or None
         
-        if self.src_store_type != 'PKCS12':
+        if self.src_alias is None:
+            # keytool copies every entry in one run, keeping each key password
+            self.src_key_pass = self.src_store_pass
+        elif self.src_store_type != 'PKCS12':
             self.src_key_pass = validate_input(cyan_text("Enter source alias password (default: same as source keystore password): "), pass_opt=self.src_store_pass, min_length=6)
         else:
             self.src_key_pass = self.src_store_pass
@@ -61,9 +107,12 @@ class KeystoreMigrator:
                 print_red("Invalid destination keystore type. Please try again.")
         
         self.dest_store_pass = validate_input(cyan_text("Enter destination keystore password (default: same as source keystore password): "), pass_opt=self.src_store_pass, min_length=6)
-        self.dest_alias = validate_input(cyan_text("Enter destination alias name (default: same as source alias name): "), required=False) or self.src_alias
+        if self.src_alias is None:
+            self.dest_alias = None
+        else:
+            self.dest_alias = validate_input(cyan_text("Enter destination alias name (default: same as source alias name): "), required=False) or self.src_alias
         
-        if self.dest_store_type != 'PKCS12':
+        if self.dest_store_type != 'PKCS12' and self.src_alias is not None:
             self.dest_key_pass = validate_input(cyan_text("Enter destination alias password (default: same as source alias password): "), pass_opt=self.src_key_pass, min_length=6)
         else:
             self.dest_key_pass = self.dest_store_pass
@@ -84,20 +133,19 @@ class KeystoreMigrator:
 
         print_green("Migration input successfully gathered!")
 
+    @traced('build command', 'command')
     def generate_migration_command(self):
         cmd = [
             'keytool', '-importkeystore',
             '-srckeystore', self.src_path,
             '-srcstoretype', self.src_store_type,
             '-srcstorepass', self.src_store_pass,
-            '-srcalias', self.src_alias,
-            '-srckeypass', self.src_key_pass,
             '-destkeystore', self.dest_path,
             '-deststoretype', self.dest_store_type,
-            '-deststorepass', self.dest_store_pass,
-            '-destalias', self.dest_alias,
-            '-destkeypass', self.dest_key_pass
+            '-deststorepass', self.dest_store_pass
         ]
+        if self.src_alias is not None:
+            cmd.extend(['-srcalias', self.src_alias, '-srckeypass', self.src_key_pass, '-destalias', self.dest_alias, '-destkeypass', self.dest_key_pass])
 
         if self.src_store_type == 'BKS' or self.dest_store_type == 'BKS':
             cmd.extend(['-providerclass', self.provider_class, '-providerpath', self.provider_path])
@@ -119,14 +167,14 @@ class KeystoreMigrator:
             "--out", "signed.apk", "unsigned.apk"
         ]
 
-        self.handle_and_generate_command(cmd, "APK Signer Command")
+        log_command(self.output_path, "APK Signer Command", cmd, keystore=self.dest_path, alias=self.dest_alias)
 
     def migrate_keystore(self):
         try:
             self.get_migration_input()
             self.cmd = self.generate_migration_command()
             print_blue("\n--- Executing Keystore Migration Command ---")
-            result = subprocess.run(self.cmd)
+            result = run_tool(self.cmd, timeout=self.timeout)
 
             if result.returncode != 0:
                 print_red("Keystore migration failed.")
@@ -134,26 +182,187 @@ class KeystoreMigrator:
 
             print_green("Keystore migration executed successfully!")
             print_green(f"{self.src_store_type} migrated to {self.dest_store_type} at: {self.dest_path}")
-            self.handle_and_generate_command(self.cmd, f"{self.src_store_type} to {self.dest_store_type} Keystore Migration Command")
-            if self.dest_store_type != 'BKS':
+            log_command(
+                self.output_path, f"{self.src_store_type} to {self.dest_store_type} Keystore Migration Command", self.cmd, event='migrate',
+                keystore=self.dest_path, alias=self.dest_alias, store_type=self.dest_store_type, source=self.src_path, source_type=self.src_store_type
+            )
+            if self.dest_store_type != 'BKS' and self.dest_alias is not None:
                 self.generate_apksigner_command()
         except Exception as e:
             print_red(f"Error occurred: {e}")
             exit()
 
-    def handle_and_generate_command(self, cmd_list, description):
-        print_blue(f"\n--- {description} ---")
-        full_command = []
-        for cmd in cmd_list:
-            if ' ' in cmd:
-                full_command.append(f'"{cmd}"')
+class BulkKeystoreMigrator:
+    # Migrates every alias (or a selection) of many keystores, one destination keystore per source
+    def __init__(self, dest_store_type, src_store_pass, dest_store_pass=None, src_key_pass=None, dest_key_pass=None, aliases=None, output_path=None, timeout=None):
+        self.dest_store_type = dest_store_type.upper()
+        if self.dest_store_type not in STORE_TYPES:
+            raise ValueError(f"Invalid destination keystore type '{dest_store_type}'. Expected one of: {', '.join(STORE_TYPES)}.")
+        self.src_store_pass = src_store_pass
+        self.dest_store_pass = dest_store_pass or src_store_pass
+        self.src_key_pass = src_key_pass or src_store_pass
+        self.dest_key_pass = dest_key_pass
+        self.aliases = aliases or None
+        self.output_path = output_path
+        self.timeout = timeout
+
+    def dest_path(self, src_path):
+        extension = 'p12' if self.dest_store_type == 'PKCS12' else self.dest_store_type.lower()
+        return os.path.join(self.output_path, f"{os.path.splitext(os.path.basename(src_path))[0]}.{extension}")
+
+    def migrate_native(self, src_path, src_type, dest_path):
+        # One read of the source and one write of the destination, whichever aliases and key passwords.
+        # None when the keystore holds entries the writer cannot copy, keytool migrates those.
+        try:
+            keystore = read_keystore(src_path, self.src_store_pass, src_type)
+        except NotImplementedError:
+            return None
+        if self.aliases:
+            available = [alias.lower() for alias in keystore.aliases()]
+            missing = [alias for alias in self.aliases if alias.lower() not in available]
+            if missing:
+                raise ValueError(f"Alias(es) not found: {', '.join(missing)}.")
+            selected = [alias.lower() for alias in self.aliases]
+            keystore.entries = [entry for entry in keystore.entries if entry.alias.lower() in selected]
+        try:
+            entries = writer_entries(keystore, self.src_store_pass, {alias: self.src_key_pass for alias in keystore.aliases()})
+        except NotImplementedError:
+            return None
+        for entry in entries:
+            entry.key_pass = self.dest_key_pass or self.src_key_pass
+        write_keystore(dest_path, self.dest_store_type, entries, self.dest_store_pass)
+        return keystore.aliases()
+
+    def per_alias(self):
+        # Without -srcalias keytool copies every entry in one run, but then it can neither select aliases
+        # nor take key passwords other than the keystore password: those need one run per alias.
+        if self.aliases or self.src_key_pass != self.src_store_pass:
+            return True
+        return self.dest_store_type != 'PKCS12' and self.dest_key_pass not in [None, self.src_key_pass]
+
+    def list_aliases(self, src_path, src_type):
+        try:
+            return read_keystore(src_path, self.src_store_pass, src_type).aliases()
+        except (ImportError, NotImplementedError):
+            pass
+        cmd = ['keytool', '-list', '-v', '-keystore', src_path, '-storetype', src_type, '-storepass', self.src_store_pass]
+        if src_type == 'BKS':
+            cmd.extend(provider_arguments())
+        result = run_tool(cmd, capture_output=True, stdin=subprocess.DEVNULL, timeout=self.timeout)
+        if result.returncode != 0:
+            raise RuntimeError(tool_output(result))
+        return ALIAS_LINE.findall(result.stdout)
+
+    def import_command(self, src_path, src_type, dest_path, alias=None):
+        cmd = [
+            'keytool', '-importkeystore', '-noprompt',
+            '-srckeystore', src_path,
+            '-srcstoretype', src_type,
+            '-srcstorepass', self.src_store_pass,
+            '-destkeystore', dest_path,
+            '-deststoretype', self.dest_store_type,
+            '-deststorepass', self.dest_store_pass
+        ]
+        if alias is not None:
+            cmd.extend(['-srcalias', alias, '-destalias', alias])
+            if src_type != 'PKCS12':
+                cmd.extend(['-srckeypass', self.src_key_pass])
+            if self.dest_store_type != 'PKCS12':
+                cmd.extend(['-destkeypass', self.dest_key_pass or self.src_key_pass])
+        if 'BKS' in [src_type, self.dest_store_type]:
+            cmd.extend(provider_arguments())
+        return cmd
+
+    @traced('migrate keystore', 'keystore')
+    def migrate_one(self, src_path):
+        start = time.perf_counter()
+        result = {
+            'source': src_path,
+            'source_type': None,
+            'destination': self.dest_path(src_path),
+            'dest_type': self.dest_store_type,
+            'aliases': [],
+            'keytool_runs': 0,
+            'success': False,
+            'error': None,
+        }
+        temp_dir = None
+        try:
+            src_type = result['source_type'] = keystore_type(src_path)
+            if src_type == self.dest_store_type:
+                raise ValueError(f"Source is already a {src_type} keystore.")
+            # keytool writes into an empty directory next to the destination, which then replaces it in one rename:
+            # an interrupted or failed migration never leaves a partial keystore behind.
+            temp_dir = tempfile.mkdtemp(prefix='.keysigner-', dir=self.output_path)
+            temp_path = os.path.join(temp_dir, os.path.basename(result['destination']))
+
+            aliases = self.migrate_native(src_path, src_type, temp_path) if writer_available() else None
+            if aliases is not None:
+                result['aliases'] = aliases
+            elif self.per_alias():
+                available = self.list_aliases(src_path, src_type)
+                aliases = self.aliases or available
+                missing = [alias for alias in aliases if alias.lower() not in [name.lower() for name in available]]
+                if missing:
+                    raise ValueError(f"Alias(es) not found: {', '.join(missing)}.")
+                for alias in aliases:
+                    completed = run_tool(self.import_command(src_path, src_type, temp_path, alias), capture_output=True, stdin=subprocess.DEVNULL, timeout=self.timeout)
+                    result['keytool_runs'] += 1
+                    if completed.returncode != 0:
+                        raise RuntimeError(f"{alias}: {tool_output(completed)}")
+                    result['aliases'].append(alias)
             else:
-                full_command.append(cmd)
-        full_command = " ".join(full_command)
-
-        cmd_file = os.path.abspath(os.path.join(self.output_path, f"{self.dest_store_name}_{self.dest_store_type}_commands.txt"))
-        with open(cmd_file, 'a') as f:
-            f.write(f"{description}:\n")
-            f.write(full_command)
-            f.write("\n\n")
-        print_green(f"{description} exported to {cmd_file}")
\ No newline at end of file
+                completed = run_tool(self.import_command(src_path, src_type, temp_path), capture_output=True, stdin=subprocess.DEVNULL, timeout=self.timeout)
+                result['keytool_runs'] += 1
+                # keytool prints its progress on stderr
+                output = f"{completed.stdout or ''}\n{completed.stderr or ''}"
+                summary = IMPORT_SUMMARY.search(output)
+                if 'Enter key password' in output:
+                    # keytool asked for the password of an entry whose key password differs from the keystore password
+                    raise RuntimeError("A key password differs from the keystore password, migrate those aliases with --alias and --key-pass.")
+                if completed.returncode != 0 or summary is None:
+                    raise RuntimeError(tool_output(completed))
+                if int(summary.group(2)):
+                    raise RuntimeError(f"{summary.group(2)} of {int(summary.group(1)) + int(summary.group(2))} entries could not be imported.")
+                result['aliases'] = re.findall(r'Entry for alias (.*) successfully imported', output)
+
+            os.replace(temp_path, result['destination'])
+            result['success'] = True
+        except Exception as e:
+            result['error'] = str(e)
+        finally:
+            if temp_dir:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+            result['seconds'] = round(time.perf_counter() - start, 3)
+        record(
+            self.output_path, 'migrate', keystore=result['destination'], aliases=result['aliases'], store_type=self.dest_store_type,
+            source=src_path, source_type=result['source_type'], keytool_runs=result['keytool_runs'], success=result['success'], error=result['error']
+        )
+        return result
+
+    def checkpoint_inputs(self, src_path):
+        return {'source': file_state(src_path), 'dest_type': self.dest_store_type, 'aliases': self.aliases or []}
+
+    @journal_batch()
+    def migrate_many(self, sources, workers=None, checkpoint=None):
+        self.output_path = ensure_directory(self.output_path)
+        sources = [os.path.abspath(path) for path in sources]
+        destinations = [self.dest_path(path) for path in sources]
+        duplicates = {path for path in destinations if destinations.count(path) > 1}
+        if duplicates:
+            raise ValueError(f"Multiple keystores would be written to the same destination: {', '.join(sorted(duplicates))}")
+
+        checkpoint = (checkpoint or Checkpoint('migrate', retries=0, enabled=False)).start(self.output_path)
+        workers = max(1, workers or os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=min(workers, len(sources) or 1)) as executor:
+            return list(executor.map(
+                lambda source: checkpoint.run(source, functools.partial(self.migrate_one, source), functools.partial(self.checkpoint_inputs, source), lambda result: [result['destination']]),
+                sources
+            ))
+
+def write_migration_report(results, report_path):
+    write_json(report_path, {
+        'migrated': sum(1 for result in results if result['success']),
+        'failed': sum(1 for result in results if not result['success']),
+        'results': results,
+    })
@@ -0,0 +1,608 @@
+# -*- coding: utf-8 -*-
+
+import os
+import hmac
+import json
+import struct
+import hashlib
+from datetime import datetime, timezone
+from . import der
+from .trace import traced
+
+try:
+    from cryptography import x509
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import dsa, ec, ed25519, ed448, rsa
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    try:
+        from cryptography.hazmat.decrepit.ciphers.algorithms import TripleDES
+    except ImportError:
+        TripleDES = algorithms.TripleDES
+except ImportError:
+    x509 = None
+
+JKS_MAGIC = 0xFEEDFEED
+JCEKS_MAGIC = 0xCECECECE
+JKS_INTEGRITY_SALT = b'Mighty Aphrodite'
+JKS_KEY_PROTECTOR = '1.3.6.1.4.1.42.2.17.1.1'
+
+# PKCS#12 (RFC 7292) and PKCS#5 (RFC 8018) object identifiers
+OID_DATA = '1.2.840.113549.1.7.1'
+OID_ENCRYPTED_DATA = '1.2.840.113549.1.7.6'
+OID_KEY_BAG = '1.2.840.113549.1.12.10.1.1'
+OID_SHROUDED_KEY_BAG = '1.2.840.113549.1.12.10.1.2'
+OID_CERT_BAG = '1.2.840.113549.1.12.10.1.3'
+OID_SECRET_BAG = '1.2.840.113549.1.12.10.1.5'
+OID_X509_CERTIFICATE = '1.2.840.113549.1.9.22.1'
+OID_FRIENDLY_NAME = '1.2.840.113549.1.9.20'
+OID_LOCAL_KEY_ID = '1.2.840.113549.1.9.21'
+OID_JAVA_TRUSTED_USAGE = '2.16.840.1.113894.746875.1.1'
+OID_PBES2 = '1.2.840.113549.1.5.13'
+OID_PBKDF2 = '1.2.840.113549.1.5.12'
+OID_PBMAC1 = '1.2.840.113549.1.5.14'
+
+# PKCS#12 PBE: (cipher, key length in bytes)
+PKCS12_PBE = {
+    '1.2.840.113549.1.12.1.3': ('3des', 24),
+    '1.2.840.113549.1.12.1.4': ('3des', 16),
+    '1.2.840.113549.1.12.1.5': ('rc2', 16),
+    '1.2.840.113549.1.12.1.6': ('rc2', 5),
+}
+PBES2_CIPHERS = {
+    '2.16.840.1.101.3.4.1.2': ('aes', 16),
+    '2.16.840.1.101.3.4.1.22': ('aes', 24),
+    '2.16.840.1.101.3.4.1.42': ('aes', 32),
+    '1.2.840.113549.3.7': ('3des', 24),
+}
+HASHES = {
+    '1.3.14.3.2.26': 'sha1',
+    '2.16.840.1.101.3.4.2.4': 'sha224',
+    '2.16.840.1.101.3.4.2.1': 'sha256',
+    '2.16.840.1.101.3.4.2.2': 'sha384',
+    '2.16.840.1.101.3.4.2.3': 'sha512',
+}
+HMAC_PRFS = {
+    '1.2.840.113549.2.7': 'sha1',
+    '1.2.840.113549.2.8': 'sha224',
+    '1.2.840.113549.2.9': 'sha256',
+    '1.2.840.113549.2.10': 'sha384',
+    '1.2.840.113549.2.11': 'sha512',
+}
+
+PURPOSE_KEY = 1
+PURPOSE_IV = 2
+PURPOSE_MAC = 3
+
+PRIVATE_KEY_ENTRY = 'PrivateKeyEntry'
+TRUSTED_CERT_ENTRY = 'trustedCertEntry'
+SECRET_KEY_ENTRY = 'SecretKeyEntry'
+
+# RC2 (RFC 2268) is not in cryptography with 40-bit keys, which old keytool versions use for PKCS12 certificates
+RC2_PITABLE = bytes.fromhex(
+    'd978f9c419ddb5ed28e9fd794aa0d89dc67e37832b76538e624c6488448bfba2'
+    '179a59f587b34f1361456d8d09817d32bd8f40eb86b77b0bf09521225c6b4e82'
+    '54d66593ce60b21c7356c014a78cf1dc1275ca1f3bbee4d1423dd430a33cb626'
+    '6fbf0eda4669075727f21d9bbc944303f811c7f690ef3ee706c3d52fc8661ed7'
+    '08e8eade8052eef784aa72ac354d6a2a961ad2715a1549744b9fd05e0418a4ec'
+    'c2e0416e0f51cbcc2491af50a1f47039997c3a8523b8b47afc02365b25559731'
+    '2d5dfa98e38a92ae05df2910676cbac9d300e6cfe19ea82c6316013f58e289a9'
+    '0d38341bab33ffb0bb480c5fb9b1cd2ec5f3db47e5a59c770aa62068fe7fc1ad'
+)
+
+class KeystorePasswordError(ValueError):
+    pass
+
+def reader_available():
+    return x509 is not None
+
+def colon_hex(data):
+    return ':'.join(f'{byte:02X}' for byte in data)
+
+def utc_datetime(value):
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+def public_key_details(public_key):
+    if isinstance(public_key, rsa.RSAPublicKey):
+        return 'RSA', public_key.key_size, None
+    if isinstance(public_key, ec.EllipticCurvePublicKey):
+        return 'EC', public_key.key_size, public_key.curve.name
+    if isinstance(public_key, dsa.DSAPublicKey):
+        return 'DSA', public_key.key_size, None
+    if isinstance(public_key, ed25519.Ed25519PublicKey):
+        return 'Ed25519', 255, None
+    if isinstance(public_key, ed448.Ed448PublicKey):
+        return 'Ed448', 448, None
+    return type(public_key).__name__, None, None
+
+class CertificateInfo:
+    def __init__(self, der_data):
+        self.der = bytes(der_data)
+        self.certificate = x509.load_der_x509_certificate(self.der)
+
+    def fingerprint(self, hash_name):
+        return colon_hex(hashlib.new(hash_name, self.der).digest())
+
+    def to_dict(self):
+        cert = self.certificate
+        key_algorithm, key_size, curve = public_key_details(cert.public_key())
+        signature_hash = cert.signature_hash_algorithm
+        signature_algorithm = getattr(cert.signature_algorithm_oid, '_name', cert.signature_algorithm_oid.dotted_string)
+        return {
+            'subject': cert.subject.rfc4514_string(),
+            'issuer': cert.issuer.rfc4514_string(),
+            'serial_number': f'{cert.serial_number:x}',
+            'version': cert.version.value + 1,
+            'not_before': utc_datetime(cert.not_valid_before_utc).isoformat(),
+            'not_after': utc_datetime(cert.not_valid_after_utc).isoformat(),
+            'signature_algorithm': signature_algorithm,
+            'signature_hash': signature_hash.name if signature_hash else None,
+            'key_algorithm': key_algorithm,
+            'key_size': key_size,
+            'curve': curve,
+            'sha1': self.fingerprint('sha1'),
+            'sha256': self.fingerprint('sha256'),
+        }
+
+class KeystoreEntry:
+    def __init__(self, alias, entry_type, certificates, created=None, protected_key=None, key_algorithm=None):
+        self.alias = alias
+        self.entry_type = entry_type
+        self.certificates = certificates
+        self.created = created
+        # Format specific, decrypted on demand by private_key()
+        self.protected_key = protected_key
+        self.key_algorithm = key_algorithm
+        self.decrypt_key = None
+
+    def private_key(self, password):
+        if self.entry_type != PRIVATE_KEY_ENTRY or self.decrypt_key is None:
+            raise ValueError(f"Entry '{self.alias}' does not contain a private key.")
+        return serialization.load_der_private_key(self.decrypt_key(self.protected_key, password), password=None)
+
+    def to_dict(self):
+        result = {
+            'alias': self.alias,
+            'type': self.entry_type,
+            'created': self.created.isoformat() if self.created else None,
+            'key_algorithm': self.key_algorithm,
+            'key_size': None,
+            'certificates': [cert.to_dict() for cert in self.certificates],
+        }
+        if self.certificates:
+            result['key_algorithm'], result['key_size'], _ = public_key_details(self.certificates[0].certificate.public_key())
+        return result
+
+class Keystore:
+    def __init__(self, store_type, entries, path=None):
+        self.store_type = store_type
+        self.entries = entries
+        self.path = path
+        # False when read without a password, the integrity check was skipped
+        self.verified = True
+
+    def aliases(self):
+        return [entry.alias for entry in self.entries]
+
+    def entry(self, alias):
+        for entry in self.entries:
+            if entry.alias.lower() == alias.lower():
+                return entry
+        raise ValueError(f"Alias '{alias}' not found, the keystore contains: {', '.join(self.aliases()) or 'no entries'}.")
+
+    def to_dict(self):
+        return {
+            'path': self.path,
+            'type': self.store_type,
+            'entries': [entry.to_dict() for entry in self.entries],
+        }
+
+    def to_json(self, indent=2):
+        return json.dumps(self.to_dict(), indent=indent)
+
+def detect_store_type(data):
+    if len(data) < 4:
+        raise ValueError("Not a keystore: file too small.")
+    (magic,) = struct.unpack('>I', data[:4])
+    if magic == JKS_MAGIC:
+        return 'JKS'
+    if magic == JCEKS_MAGIC:
+        return 'JCEKS'
+    if magic in [1, 2]:
+        return 'BKS'
+    if data[0] == 0x30:
+        return 'PKCS12'
+    raise ValueError("Unknown keystore format.")
+
+@traced('read keystore', 'keystore')
+def read_keystore(path, store_pass, store_type=None):
+    # store_pass None lists the entries without checking the keystore's integrity, PKCS12 keystores with
+    # encrypted certificates still need the password
+    if x509 is None:
+        raise ImportError("Reading keystores in-process requires the 'cryptography' package (pip install keysigner[native]).")
+    with open(path, 'rb') as f:
+        data = f.read()
+    detected = detect_store_type(data)
+    if store_type and {'P12': 'PKCS12'}.get(store_type.upper(), store_type.upper()) != detected:
+        raise ValueError(f"{os.path.basename(path)} is a {detected} keystore, not {store_type.upper()}.")
+    readers = {'JKS': JKSReader, 'JCEKS': JKSReader, 'BKS': BKSReader, 'PKCS12': PKCS12Reader}
+    keystore = readers[detected]().read(data, store_pass)
+    keystore.path = os.path.abspath(path)
+    keystore.verified = store_pass is not None
+    return keystore
+
+class JavaDataReader:
+    # Big-endian DataInputStream fields, as written by the JKS and BKS providers
+    def __init__(self, data, position=0):
+        self.data = data
+        self.position = position
+
+    def unpack(self, fmt):
+        values = struct.unpack_from(fmt, self.data, self.position)
+        self.position += struct.calcsize(fmt)
+        return values[0] if len(values) == 1 else values
+
+    def read_bytes(self, count):
+        if self.position + count > len(self.data):
+            raise ValueError("Truncated keystore.")
+        value = self.data[self.position:self.position + count]
+        self.position += count
+        return value
+
+    def read_utf(self):
+        return self.read_bytes(self.unpack('>H')).decode('utf-8', 'replace')
+
+    def read_data(self):
+        return self.read_bytes(self.unpack('>I'))
+
+def java_timestamp(milliseconds):
+    return datetime.fromtimestamp(milliseconds / 1000, timezone.utc)
+
+class JKSReader:
+    def read(self, data, password):
+        reader = JavaDataReader(data)
+        magic, version, count = reader.unpack('>III')
+        if version not in [1, 2]:
+            raise ValueError(f"Unsupported JKS version {version}.")
+        store_type = 'JCEKS' if magic == JCEKS_MAGIC else 'JKS'
+
+        if password is not None:
+            expected = hashlib.sha1(password.encode('utf-16-be') + JKS_INTEGRITY_SALT + data[:-20]).digest()
+            if not hmac.compare_digest(expected, data[-20:]):
+                raise KeystorePasswordError("Keystore was tampered with, or password was incorrect.")
+
+        entries = []
+        for _ in range(count):
+            tag = reader.unpack('>I')
+            alias = reader.read_utf()
+            created = java_timestamp(reader.unpack('>Q'))
+            if tag == 1:
+                protected_key = reader.read_data()
+                chain = [self.read_certificate(reader, version) for _ in range(reader.unpack('>I'))]
+                entry = KeystoreEntry(alias, PRIVATE_KEY_ENTRY, chain, created, protected_key)
+                if store_type == 'JKS':
+                    entry.decrypt_key = self.decrypt_key
+                entries.append(entry)
+            elif tag == 2:
+                entries.append(KeystoreEntry(alias, TRUSTED_CERT_ENTRY, [self.read_certificate(reader, version)], created))
+            else:
+                # JCEKS secret keys are serialized Java objects
+                raise NotImplementedError(f"{store_type} entry type {tag} ('{alias}') is not supported.")
+        return Keystore(store_type, entries)
+
+    def read_certificate(self, reader, version):
+        if version == 2:
+            cert_type = reader.read_utf()
+            if cert_type != 'X.509':
+                raise NotImplementedError(f"Unsupported certificate type '{cert_type}'.")
+        return CertificateInfo(reader.read_data())
+
+    def decrypt_key(self, protected_key, password):
+        # Sun's proprietary key protector: SHA-1 keystream, salt || ciphertext || SHA-1 check
+        algorithm, (_, encrypted) = der.decode_items(der.decode_single(protected_key, der.TAG_SEQUENCE))
+        if der.decode_oid(der.decode_items(algorithm[1])[0][1]) != JKS_KEY_PROTECTOR:
+            raise NotImplementedError("Unsupported JKS key protection algorithm.")
+        encrypted = bytes(encrypted)
+        salt, ciphertext, check = encrypted[:20], encrypted[20:-20], encrypted[-20:]
+        password_bytes = password.encode('utf-16-be')
+        stream = bytearray()
+        digest = salt
+        while len(stream) < len(ciphertext):
+            digest = hashlib.sha1(password_bytes + digest).digest()
+            stream += digest
+        plain = bytes(a ^ b for a, b in zip(ciphertext, stream))
+        if not hmac.compare_digest(hashlib.sha1(password_bytes + plain).digest(), check):
+            raise KeystorePasswordError("Cannot recover key, the key password is incorrect.")
+        return plain
+
+def pkcs12_password(password):
+    # BMPString with a terminating NUL, RFC 7292 appendix B.1
+    return password.encode('utf-16-be') + b'\x00\x00' if password else b''
+
+def pkcs12_kdf(hash_name, password_bytes, salt, purpose, iterations, size):
+    # RFC 7292 appendix B.2
+    hash_function = getattr(hashlib, hash_name)
+    v = hash_function().block_size
+    repeat = lambda data, length: (data * (length // len(data) + 1))[:length] if data else b''
+    salt_part = repeat(salt, v * -(-len(salt) // v))
+    password_part = repeat(password_bytes, v * -(-len(password_bytes) // v))
+    block = bytearray(salt_part + password_part)
+    diversifier = bytes([purpose]) * v
+    result = b''
+    while len(result) < size:
+        digest = hash_function(diversifier + bytes(block)).digest()
+        for _ in range(iterations - 1):
+            digest = hash_function(digest).digest()
+        result += digest
+        b_value = int.from_bytes(repeat(digest, v), 'big') + 1
+        for start in range(0, len(block), v):
+            value = (int.from_bytes(block[start:start + v], 'big') + b_value) & ((1 << (8 * v)) - 1)
+            block[start:start + v] = value.to_bytes(v, 'big')
+    return result[:size]
+
+def rc2_decrypt_cbc(key, effective_bits, iv, data):
+    # RFC 2268 key expansion and decryption
+    expanded = bytearray(128)
+    expanded[:len(key)] = key
+    for i in range(len(key), 128):
+        expanded[i] = RC2_PITABLE[(expanded[i - 1] + expanded[i - len(key)]) & 0xFF]
+    t8 = (effective_bits + 7) // 8
+    tm = 0xFF % (1 << (8 + effective_bits - 8 * t8))
+    expanded[128 - t8] = RC2_PITABLE[expanded[128 - t8] & tm]
+    for i in range(127 - t8, -1, -1):
+        expanded[i] = RC2_PITABLE[expanded[i + 1] ^ expanded[i + t8]]
+    k = [expanded[2 * i] | (expanded[2 * i + 1] << 8) for i in range(64)]
+
+    shifts = [1, 2, 3, 5]
+    result = bytearray()
+    previous = iv
+    for offset in range(0, len(data), 8):
+        block = data[offset:offset + 8]
+        r = list(struct.unpack('<4H', block))
+        j = 63
+        for rounds, mash in [(5, True), (6, True), (5, False)]:
+            for _ in range(rounds):
+                for i in [3, 2, 1, 0]:
+                    value = ((r[i] >> shifts[i]) | (r[i] << (16 - shifts[i]))) & 0xFFFF
+                    r[i] = (value - k[j] - (r[i - 1] & r[i - 2]) - (~r[i - 1] & r[i - 3])) & 0xFFFF
+                    j -= 1
+            if mash:
+                for i in [3, 2, 1, 0]:
+                    r[i] = (r[i] - k[r[i - 1] & 63]) & 0xFFFF
+        plain = struct.pack('<4H', *r)
+        result += bytes(a ^ b for a, b in zip(plain, previous))
+        previous = block
+    return bytes(result)
+
+def unpad(data, block_size):
+    padding = data[-1] if data else 0
+    if not 1 <= padding <= block_size or data[-padding:] != bytes([padding]) * padding:
+        raise KeystorePasswordError("Decryption failed, the password is probably incorrect.")
+    return data[:-padding]
+
+def block_decrypt(cipher_name, key, iv, data):
+    if cipher_name == 'rc2':
+        return unpad(rc2_decrypt_cbc(key, len(key) * 8, iv, data), 8)
+    algorithm = algorithms.AES(key) if cipher_name == 'aes' else TripleDES(key)
+    decryptor = Cipher(algorithm, modes.CBC(iv)).decryptor()
+    return unpad(decryptor.update(data) + decryptor.finalize(), len(iv))
+
+def pbe_decrypt(algorithm, data, password):
+    oid, parameters = der.decode_algorithm(algorithm)
+    if oid in PKCS12_PBE:
+        cipher_name, key_size = PKCS12_PBE[oid]
+        salt, iterations = der.decode_items(parameters[1])
+        password_bytes = pkcs12_password(password)
+        iterations = der.decode_integer(iterations[1])
+        key = pkcs12_kdf('sha1', password_bytes, bytes(salt[1]), PURPOSE_KEY, iterations, key_size)
+        iv = pkcs12_kdf('sha1', password_bytes, bytes(salt[1]), PURPOSE_IV, iterations, 8)
+        return block_decrypt(cipher_name, key, iv, data)
+    if oid == OID_PBES2:
+        kdf, scheme = der.decode_items(parameters[1])
+        kdf_oid, kdf_parameters = der.decode_algorithm(kdf[1])
+        if kdf_oid != OID_PBKDF2:
+            raise NotImplementedError(f"Unsupported key derivation function {kdf_oid}.")
+        cipher_oid, cipher_parameters = der.decode_algorithm(scheme[1])
+        if cipher_oid not in PBES2_CIPHERS:
+            raise NotImplementedError(f"Unsupported PBES2 cipher {cipher_oid}.")
+        cipher_name, key_size = PBES2_CIPHERS[cipher_oid]
+        items = der.decode_items(kdf_parameters[1])
+        salt, iterations = bytes(items[0][1]), der.decode_integer(items[1][1])
+        prf = 'sha1'
+        for tag, value in items[2:]:
+            if tag == der.TAG_INTEGER:
+                key_size = der.decode_integer(value)
+            elif tag == der.TAG_SEQUENCE:
+                prf_oid = der.decode_algorithm(value)[0]
+                if prf_oid not in HMAC_PRFS:
+                    raise NotImplementedError(f"Unsupported PBKDF2 PRF {prf_oid}.")
+                prf = HMAC_PRFS[prf_oid]
+        key = hashlib.pbkdf2_hmac(prf, password.encode('utf-8'), salt, iterations, key_size)
+        return block_decrypt(cipher_name, key, bytes(cipher_parameters[1]), data)
+    raise NotImplementedError(f"Unsupported encryption algorithm {oid}.")
+
+def decrypt_private_key_info(encrypted_private_key_info, password):
+    algorithm, (_, encrypted) = der.decode_items(der.decode_single(encrypted_private_key_info, der.TAG_SEQUENCE))
+    return pbe_decrypt(algorithm[1], bytes(encrypted), password)
+
+class PKCS12Reader:
+    def read(self, data, password):
+        pfx = der.decode_items(der.decode_single(data, der.TAG_SEQUENCE))
+        if der.decode_integer(pfx[0][1]) != 3:
+            raise ValueError("Unsupported PKCS12 version.")
+        content_type, content = der.decode_items(pfx[1][1])
+        if der.decode_oid(content_type[1]) != OID_DATA:
+            raise NotImplementedError("Public-key protected PKCS12 files are not supported.")
+        auth_safe = der.decode_octet_string(*der.decode(content[1])[:2])
+        if len(pfx) > 2 and password is not None:
+            self.verify_mac(pfx[2][1], auth_safe, password)
+
+        bags = []
+        for _, content_info in der.decode_items(der.decode_single(auth_safe, der.TAG_SEQUENCE)):
+            content_type, content = der.decode_items(content_info)
+            content_type = der.decode_oid(content_type[1])
+            if content_type == OID_DATA:
+                safe_contents = der.decode_octet_string(*der.decode(content[1])[:2])
+            elif content_type == OID_ENCRYPTED_DATA:
+                if password is None:
+                    raise KeystorePasswordError("The certificates of this PKCS12 keystore are encrypted, a password is required.")
+                safe_contents = self.decrypt_safe_contents(content[1], password)
+            else:
+                raise NotImplementedError(f"Unsupported PKCS12 content type {content_type}.")
+            bags.extend(self.read_bags(safe_contents))
+        return Keystore('PKCS12', self.entries(bags))
+
+    def verify_mac(self, mac_data, auth_safe, password):
+        items = der.decode_items(mac_data)
+        digest_algorithm, digest = der.decode_items(items[0][1])
+        hash_oid = der.decode_algorithm(digest_algorithm[1])[0]
+        if hash_oid == OID_PBMAC1 or hash_oid not in HASHES:
+            raise NotImplementedError(f"Unsupported PKCS12 MAC algorithm {hash_oid}.")
+        hash_name = HASHES[hash_oid]
+        salt = bytes(items[1][1])
+        iterations = der.decode_integer(items[2][1]) if len(items) > 2 else 1
+        key = pkcs12_kdf(hash_name, pkcs12_password(password), salt, PURPOSE_MAC, iterations, hashlib.new(hash_name).digest_size)
+        if not hmac.compare_digest(hmac.new(key, auth_safe, hash_name).digest(), bytes(digest[1])):
+            raise KeystorePasswordError("Keystore password was incorrect (PKCS12 MAC verification failed).")
+
+    def decrypt_safe_contents(self, content, password):
+        encrypted_data = der.decode_items(der.decode_single(content, der.TAG_SEQUENCE))
+        encrypted_content_info = der.decode_items(encrypted_data[1][1])
+        tag, encrypted = encrypted_content_info[2]
+        # [0] IMPLICIT OCTET STRING, primitive or constructed
+        encrypted = der.decode_octet_string(0x24 if tag & 0x20 else der.TAG_OCTET_STRING, encrypted)
+        return pbe_decrypt(encrypted_content_info[1][1], encrypted, password)
+
+    def read_bags(self, safe_contents):
+        bags = []
+        for _, bag in der.decode_items(der.decode_single(safe_contents, der.TAG_SEQUENCE)):
+            items = der.decode_items(bag)
+            bag_type = der.decode_oid(items[0][1])
+            # [0] EXPLICIT: the complete PrivateKeyInfo / EncryptedPrivateKeyInfo / CertBag
+            value = bytes(items[1][1])
+            attributes = {}
+            if len(items) > 2:
+                for _, attribute in der.decode_items(items[2][1]):
+                    attribute_type, values = der.decode_items(attribute)
+                    values = der.decode_items(values[1])
+                    attributes[der.decode_oid(attribute_type[1])] = values[0] if values else None
+            if bag_type == OID_CERT_BAG:
+                cert_type, cert_value = der.decode_items(der.decode_single(value))
+                if der.decode_oid(cert_type[1]) != OID_X509_CERTIFICATE:
+                    continue
+                value = der.decode_octet_string(*der.decode(cert_value[1])[:2])
+            bags.append((bag_type, value, attributes))
+        return bags
+
+    def entries(self, bags):
+        certificates = []
+        entries = []
+        for bag_type, value, attributes in bags:
+            if bag_type == OID_CERT_BAG:
+                certificates.append((CertificateInfo(value), attributes))
+
+        for index, (bag_type, value, attributes) in enumerate(bags):
+            if bag_type not in [OID_KEY_BAG, OID_SHROUDED_KEY_BAG, OID_SECRET_BAG]:
+                continue
+            alias = self.friendly_name(attributes) or str(index)
+            if bag_type == OID_SECRET_BAG:
+                entries.append(KeystoreEntry(alias, SECRET_KEY_ENTRY, []))
+                continue
+            local_key_id = attributes.get(OID_LOCAL_KEY_ID)
+            leaf = next((cert for cert, cert_attributes in certificates if local_key_id and cert_attributes.get(OID_LOCAL_KEY_ID) == local_key_id), None)
+            chain = self.build_chain(leaf, [cert for cert, _ in certificates]) if leaf else []
+            entry = KeystoreEntry(alias, PRIVATE_KEY_ENTRY, chain, protected_key=value)
+            entry.decrypt_key = decrypt_private_key_info if bag_type == OID_SHROUDED_KEY_BAG else (lambda key, password: key)
+            entries.append(entry)
+
+        chains = {id(cert) for entry in entries for cert in entry.certificates}
+        for index, (cert, attributes) in enumerate(certificates):
+            # Certificates of key entries carry a localKeyId, trusted ones only a friendly name. keytool also names the
+            # CA certificates of a chain, those are only trusted entries with Java's trusted key usage.
+            if OID_LOCAL_KEY_ID in attributes or (id(cert) in chains and OID_JAVA_TRUSTED_USAGE not in attributes):
+                continue
+            if OID_FRIENDLY_NAME in attributes or OID_JAVA_TRUSTED_USAGE in attributes:
+                entries.append(KeystoreEntry(self.friendly_name(attributes) or f'cert-{index}', TRUSTED_CERT_ENTRY, [cert]))
+        return entries
+
+    def friendly_name(self, attributes):
+        value = attributes.get(OID_FRIENDLY_NAME)
+        return bytes(value[1]).decode('utf-16-be') if value else None
+
+    def build_chain(self, leaf, certificates):
+        chain = [leaf]
+        while len(chain) <= len(certificates):
+            current = chain[-1].certificate
+            if current.issuer == current.subject:
+                break
+            issuer = next((cert for cert in certificates if cert.certificate.subject == current.issuer and cert not in chain), None)
+            if issuer is None:
+                break
+            chain.append(issuer)
+        return chain
+
+class BKSReader:
+    def read(self, data, password):
+        reader = JavaDataReader(data)
+        version = reader.unpack('>I')
+        salt = reader.read_data()
+        iterations = reader.unpack('>I')
+        start = reader.position
+
+        entries = []
+        while True:
+            entry_type = reader.unpack('>B')
+            if entry_type == 0:
+                break
+            alias = reader.read_utf()
+            created = java_timestamp(reader.unpack('>Q'))
+            chain = [self.read_certificate(reader) for _ in range(reader.unpack('>I'))]
+            if entry_type == 1:
+                entries.append(KeystoreEntry(alias, TRUSTED_CERT_ENTRY, [self.read_certificate(reader)], created))
+            elif entry_type == 2:
+                key_type, key_format, key_algorithm, encoded = self.read_key(reader)
+                entry = KeystoreEntry(alias, PRIVATE_KEY_ENTRY if key_type == 0 else SECRET_KEY_ENTRY, chain, created, encoded, key_algorithm)
+                entry.decrypt_key = lambda key, password: key
+                entries.append(entry)
+            elif entry_type == 3:
+                reader.read_data()
+                entries.append(KeystoreEntry(alias, SECRET_KEY_ENTRY, chain, created))
+            elif entry_type == 4:
+                entry = KeystoreEntry(alias, PRIVATE_KEY_ENTRY if chain else SECRET_KEY_ENTRY, chain, created, reader.read_data())
+                entry.decrypt_key = self.decrypt_sealed_key
+                entries.append(entry)
+            else:
+                raise ValueError(f"Unknown BKS entry type {entry_type}.")
+
+        if password is None:
+            return Keystore('BKS', entries)
+        # BouncyCastle's v1 stores derive a 2-byte MAC key (bits taken as bytes), v2 fixed it to 20
+        mac_key = pkcs12_kdf('sha1', pkcs12_password(password), salt, PURPOSE_MAC, iterations, 20 if version == 2 else 2)
+        expected = hmac.new(mac_key, data[start:reader.position], 'sha1').digest()
+        if not hmac.compare_digest(expected, reader.read_bytes(20)):
+            raise KeystorePasswordError("Keystore was tampered with, or password was incorrect.")
+        return Keystore('BKS', entries)
+
+    def read_certificate(self, reader):
+        cert_type = reader.read_utf()
+        if cert_type != 'X.509':
+            raise NotImplementedError(f"Unsupported certificate type '{cert_type}'.")
+        return CertificateInfo(reader.read_data())
+
+    def read_key(self, reader):
+        key_type = reader.unpack('>B')
+        key_format = reader.read_utf()
+        key_algorithm = reader.read_utf()
+        return key_type, key_format, key_algorithm, reader.read_data()
+
+    def decrypt_sealed_key(self, sealed, password):
+        reader = JavaDataReader(sealed)
+        salt = reader.read_data()
+        iterations = reader.unpack('>I')
+        password_bytes = pkcs12_password(password)
+        key = pkcs12_kdf('sha1', password_bytes, salt, PURPOSE_KEY, iterations, 24)
+        iv = pkcs12_kdf('sha1', password_bytes, salt, PURPOSE_IV, iterations, 8)
+        plain = block_decrypt('3des', key, iv, sealed[reader.position:])
+        key_type, key_format, _, encoded = self.read_key(JavaDataReader(plain))
+        if key_type != 0 or key_format != 'PKCS#8':
+            raise NotImplementedError(f"Unsupported BKS key format '{key_format}'.")
+        return encoded
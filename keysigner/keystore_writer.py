@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+
+import os
+import hmac
+import time
+import struct
+import hashlib
+import datetime
+import tempfile
+from . import der
+from .keystore_reader import (
+    JKS_MAGIC, JKS_INTEGRITY_SALT, JKS_KEY_PROTECTOR, PURPOSE_KEY, PURPOSE_IV, PURPOSE_MAC, HASHES, PRIVATE_KEY_ENTRY, TRUSTED_CERT_ENTRY,
+    OID_DATA, OID_ENCRYPTED_DATA, OID_SHROUDED_KEY_BAG, OID_CERT_BAG, OID_X509_CERTIFICATE, OID_FRIENDLY_NAME,
+    OID_LOCAL_KEY_ID, OID_JAVA_TRUSTED_USAGE, OID_PBES2, OID_PBKDF2, pkcs12_kdf, pkcs12_password
+)
+from .trace import traced
+
+try:
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, rsa
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    try:
+        from cryptography.hazmat.decrepit.ciphers.algorithms import TripleDES
+    except ImportError:
+        from cryptography.hazmat.primitives.ciphers.algorithms import TripleDES
+except ImportError:
+    x509 = None
+
+STORE_TYPES = ['JKS', 'BKS', 'PKCS12']
+# Key sizes keytool accepts for -genkeypair, EC sizes select the NIST curve
+KEY_SIZES = {'RSA': [2048, 3072, 4096], 'EC': [256, 384, 521]}
+DEFAULT_KEY_SIZES = {'RSA': 2048, 'EC': 256}
+EC_CURVES = {256: 'secp256r1', 384: 'secp384r1', 521: 'secp521r1'}
+DEFAULT_VALIDITY = 36500
+BKS_ITERATIONS = 1024
+JKS_SALT_SIZE = 20
+
+# PKCS12 protection: PBES2 with PBKDF2-HMAC-SHA256 and AES (keytool's default since JDK 12) or the legacy
+# pbeWithSHAAnd3-KeyTripleDES-CBC that old Android tools and OpenSSL 1.x need; the MAC is an HMAC
+# Keys are always encrypted, Java ignores plain key bags
+PKCS12_KEY_ENCRYPTIONS = ['AES-256', 'AES-128', '3DES']
+PKCS12_CERT_ENCRYPTIONS = PKCS12_KEY_ENCRYPTIONS + ['NONE']
+PKCS12_MACS = ['SHA256', 'SHA384', 'SHA512', 'SHA1', 'NONE']
+PKCS12_ITERATIONS = 10000
+OID_PBE_SHA1_3DES = '1.2.840.113549.1.12.1.3'
+OID_HMAC_SHA256 = '1.2.840.113549.2.9'
+OID_ANY_EXTENDED_KEY_USAGE = '2.5.29.37.0'
+AES_OIDS = {'AES-128': '2.16.840.1.101.3.4.1.2', 'AES-256': '2.16.840.1.101.3.4.1.42'}
+HASH_OIDS = {name: oid for oid, name in HASHES.items()}
+
+# keytool -dname attribute names
+DNAME_ATTRIBUTES = {
+    'CN': 'COMMON_NAME',
+    'OU': 'ORGANIZATIONAL_UNIT_NAME',
+    'O': 'ORGANIZATION_NAME',
+    'L': 'LOCALITY_NAME',
+    'ST': 'STATE_OR_PROVINCE_NAME',
+    'S': 'STATE_OR_PROVINCE_NAME',
+    'C': 'COUNTRY_NAME',
+    'STREET': 'STREET_ADDRESS',
+    'DC': 'DOMAIN_COMPONENT',
+    'UID': 'USER_ID',
+    'EMAILADDRESS': 'EMAIL_ADDRESS',
+    'EMAIL': 'EMAIL_ADDRESS',
+    'SERIALNUMBER': 'SERIAL_NUMBER',
+    'T': 'TITLE',
+}
+
+def writer_available():
+    return x509 is not None
+
+def parse_key_algorithm(value, key_size=None):
+    # RSA, RSA-4096, EC, EC-P256 or EC-256
+    text = str(value or 'RSA').upper().replace('_', '-')
+    algorithm, _, size = text.partition('-')
+    if algorithm not in KEY_SIZES:
+        raise ValueError(f"Invalid key algorithm '{value}'. Expected RSA or EC, e.g. RSA-3072 or EC-P256.")
+    size = int(size.lstrip('P')) if size else int(key_size or DEFAULT_KEY_SIZES[algorithm])
+    if size not in KEY_SIZES[algorithm]:
+        raise ValueError(f"Invalid {algorithm} key size {size}. Expected one of: {', '.join(map(str, KEY_SIZES[algorithm]))}.")
+    return algorithm, size
+
+def key_algorithm_name(algorithm, key_size):
+    return f"EC-P{key_size}" if algorithm == 'EC' else f"{algorithm}-{key_size}"
+
+@traced('generate key', 'crypto')
+def generate_private_key(algorithm, key_size):
+    if algorithm == 'EC':
+        return ec.generate_private_key({256: ec.SECP256R1(), 384: ec.SECP384R1(), 521: ec.SECP521R1()}[key_size])
+    return rsa.generate_private_key(public_exponent=65537, key_size=key_size)
+
+def parse_dname(dname):
+    # keytool syntax: "CN=Name, OU=Unit, O=Org", commas inside values escaped with a backslash
+    parts, current, escaped = [], '', False
+    for char in dname or 'CN=Unknown':
+        if escaped:
+            current += char
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == ',':
+            parts.append(current)
+            current = ''
+        else:
+            current += char
+    parts.append(current)
+
+    attributes = []
+    for part in parts:
+        name, separator, value = part.partition('=')
+        oid_name = DNAME_ATTRIBUTES.get(name.strip().upper())
+        if not separator or oid_name is None:
+            raise ValueError(f"Invalid distinguished name component '{part.strip()}' in '{dname}'.")
+        attributes.append(x509.NameAttribute(getattr(NameOID, oid_name), value.strip()))
+    # The first component is the most specific one, it is encoded last
+    return x509.Name(list(reversed(attributes)))
+
+@traced('certificate', 'crypto')
+def self_signed_certificate(private_key, dname, validity=DEFAULT_VALIDITY):
+    name = parse_dname(dname)
+    now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+    public_key = private_key.public_key()
+    signature_hash = hashes.SHA384() if isinstance(private_key, ec.EllipticCurvePrivateKey) and private_key.key_size > 256 else hashes.SHA256()
+    builder = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(public_key)
+        .serial_number(int.from_bytes(os.urandom(8), 'big') >> 1 or 1)
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=int(validity)))
+        .add_extension(x509.SubjectKeyIdentifier.from_public_key(public_key), critical=False)
+    )
+    return builder.sign(private_key, signature_hash)
+
+def pkcs8(private_key):
+    return private_key.private_bytes(serialization.Encoding.DER, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+
+def certificate_der(certificate):
+    return certificate.public_bytes(serialization.Encoding.DER)
+
+def block_encrypt(cipher_name, key, iv, data):
+    # PKCS#7 padding and CBC, the inverse of keystore_reader.block_decrypt
+    padding = len(iv) - len(data) % len(iv)
+    algorithm = algorithms.AES(key) if cipher_name == 'aes' else TripleDES(key)
+    encryptor = Cipher(algorithm, modes.CBC(iv)).encryptor()
+    return encryptor.update(data + bytes([padding]) * padding) + encryptor.finalize()
+
+def pbe_encrypt(encryption, data, password, iterations):
+    # Returns the AlgorithmIdentifier and the ciphertext, the inverse of keystore_reader.pbe_decrypt
+    if encryption == '3DES':
+        salt = os.urandom(20)
+        password_bytes = pkcs12_password(password)
+        key = pkcs12_kdf('sha1', password_bytes, salt, PURPOSE_KEY, iterations, 24)
+        iv = pkcs12_kdf('sha1', password_bytes, salt, PURPOSE_IV, iterations, 8)
+        parameters = der.sequence(der.octet_string(salt), der.integer(iterations))
+        return der.sequence(der.oid(OID_PBE_SHA1_3DES), parameters), block_encrypt('3des', key, iv, data)
+    salt = os.urandom(16)
+    iv = os.urandom(16)
+    key = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations, 32 if encryption == 'AES-256' else 16)
+    kdf = der.sequence(der.oid(OID_PBKDF2), der.sequence(der.octet_string(salt), der.integer(iterations), der.algorithm(OID_HMAC_SHA256)))
+    scheme = der.sequence(der.oid(AES_OIDS[encryption]), der.octet_string(iv))
+    return der.sequence(der.oid(OID_PBES2), der.sequence(kdf, scheme)), block_encrypt('aes', key, iv, data)
+
+def java_utf(text):
+    data = text.encode('utf-8')
+    return struct.pack('>H', len(data)) + data
+
+def java_data(data):
+    return struct.pack('>I', len(data)) + data
+
+class KeystoreWriterEntry:
+    def __init__(self, alias, private_key=None, certificates=None, key_pass=None, created=None):
+        self.alias = alias
+        self.private_key = private_key
+        self.certificates = certificates or []
+        self.key_pass = key_pass
+        # Java timestamps are milliseconds
+        self.created = int((created if created is not None else time.time()) * 1000)
+
+class JKSWriter:
+    def protect_key(self, key_der, password):
+        # Sun's proprietary key protector, the inverse of JKSReader.decrypt_key
+        password_bytes = password.encode('utf-16-be')
+        salt = os.urandom(JKS_SALT_SIZE)
+        stream = bytearray()
+        digest = salt
+        while len(stream) < len(key_der):
+            digest = hashlib.sha1(password_bytes + digest).digest()
+            stream += digest
+        encrypted = salt + bytes(a ^ b for a, b in zip(key_der, stream)) + hashlib.sha1(password_bytes + key_der).digest()
+        return der.sequence(der.algorithm(JKS_KEY_PROTECTOR), der.octet_string(encrypted))
+
+    def serialize(self, entries, store_pass):
+        body = struct.pack('>III', JKS_MAGIC, 2, len(entries))
+        for entry in entries:
+            # JavaKeyStore stores aliases lowercased and lowercases the alias it looks up, without normalizing
+            # the aliases it loads: keytool, apksigner and Gradle would not find a mixed-case alias
+            alias = entry.alias.lower()
+            if entry.private_key is not None:
+                body += struct.pack('>I', 1) + java_utf(alias) + struct.pack('>Q', entry.created)
+                body += java_data(self.protect_key(pkcs8(entry.private_key), entry.key_pass or store_pass))
+                body += struct.pack('>I', len(entry.certificates))
+            else:
+                body += struct.pack('>I', 2) + java_utf(alias) + struct.pack('>Q', entry.created)
+            for cert in entry.certificates:
+                body += java_utf('X.509') + java_data(certificate_der(cert))
+        return body + hashlib.sha1(store_pass.encode('utf-16-be') + JKS_INTEGRITY_SALT + body).digest()
+
+class BKSWriter:
+    # BouncyCastle BKS version 2, keys sealed with PBEWithSHAAnd3-KeyTripleDES-CBC
+    def seal_key(self, private_key, password):
+        salt = os.urandom(20)
+        password_bytes = pkcs12_password(password)
+        key = pkcs12_kdf('sha1', password_bytes, salt, PURPOSE_KEY, BKS_ITERATIONS, 24)
+        iv = pkcs12_kdf('sha1', password_bytes, salt, PURPOSE_IV, BKS_ITERATIONS, 8)
+        # BouncyCastle rebuilds the key with a KeyFactory for this algorithm name
+        algorithm = 'EC' if isinstance(private_key, ec.EllipticCurvePrivateKey) else 'RSA'
+        plain = bytes([0]) + java_utf('PKCS#8') + java_utf(algorithm) + java_data(pkcs8(private_key))
+        return java_data(salt) + struct.pack('>I', BKS_ITERATIONS) + block_encrypt('3des', key, iv, plain)
+
+    def certificate(self, cert):
+        return java_utf('X.509') + java_data(certificate_der(cert))
+
+    def serialize(self, entries, store_pass):
+        body = b''
+        for entry in entries:
+            if entry.private_key is not None:
+                body += bytes([4]) + java_utf(entry.alias) + struct.pack('>Q', entry.created)
+                body += struct.pack('>I', len(entry.certificates)) + b''.join(self.certificate(cert) for cert in entry.certificates)
+                body += java_data(self.seal_key(entry.private_key, entry.key_pass or store_pass))
+            else:
+                body += bytes([1]) + java_utf(entry.alias) + struct.pack('>Q', entry.created) + struct.pack('>I', 0)
+                body += self.certificate(entry.certificates[0])
+        body += bytes([0])
+        salt = os.urandom(20)
+        mac_key = pkcs12_kdf('sha1', pkcs12_password(store_pass), salt, PURPOSE_MAC, BKS_ITERATIONS, 20)
+        header = struct.pack('>I', 2) + java_data(salt) + struct.pack('>I', BKS_ITERATIONS)
+        return header + body + hmac.new(mac_key, body, 'sha1').digest()
+
+class PKCS12Writer:
+    # RFC 7292 with any number of key and trusted certificate entries: certificates in one encrypted
+    # SafeContents, shrouded keys in a plain one, the layout keytool and OpenSSL write
+    def __init__(self, key_encryption='AES-256', cert_encryption='AES-256', iterations=PKCS12_ITERATIONS, mac='SHA256', mac_iterations=PKCS12_ITERATIONS):
+        self.key_encryption = key_encryption.upper()
+        self.cert_encryption = cert_encryption.upper()
+        self.iterations = int(iterations)
+        self.mac = mac.upper()
+        self.mac_iterations = int(mac_iterations)
+        for label, value, choices in [('key encryption', self.key_encryption, PKCS12_KEY_ENCRYPTIONS), ('certificate encryption', self.cert_encryption, PKCS12_CERT_ENCRYPTIONS), ('MAC', self.mac, PKCS12_MACS)]:
+            if value not in choices:
+                raise ValueError(f"Invalid PKCS12 {label} '{value}'. Expected one of: {', '.join(choices)}.")
+        if self.iterations < 1 or self.mac_iterations < 1:
+            raise ValueError("PKCS12 iteration counts must be positive.")
+
+    def attributes(self, alias=None, local_key_id=None, trusted=False):
+        attributes = []
+        if alias is not None:
+            attributes.append(der.sequence(der.oid(OID_FRIENDLY_NAME), der.set_of(der.encode(der.TAG_BMP_STRING, alias.encode('utf-16-be')))))
+        if local_key_id is not None:
+            attributes.append(der.sequence(der.oid(OID_LOCAL_KEY_ID), der.set_of(der.octet_string(local_key_id))))
+        if trusted:
+            # Java only lists certificates with a trusted usage as trustedCertEntry
+            attributes.append(der.sequence(der.oid(OID_JAVA_TRUSTED_USAGE), der.set_of(der.oid(OID_ANY_EXTENDED_KEY_USAGE))))
+        return der.set_of(*attributes) if attributes else b''
+
+    def bag(self, bag_type, value, attributes=b''):
+        return der.sequence(der.oid(bag_type), der.context(0, value), attributes)
+
+    def cert_bag(self, cert_der, attributes=b''):
+        return self.bag(OID_CERT_BAG, der.sequence(der.oid(OID_X509_CERTIFICATE), der.context(0, der.octet_string(cert_der))), attributes)
+
+    def key_bag(self, private_key, store_pass, attributes):
+        algorithm, encrypted = pbe_encrypt(self.key_encryption, pkcs8(private_key), store_pass, self.iterations)
+        return self.bag(OID_SHROUDED_KEY_BAG, der.sequence(algorithm, der.octet_string(encrypted)), attributes)
+
+    def data_content(self, data):
+        return der.sequence(der.oid(OID_DATA), der.context(0, der.octet_string(data)))
+
+    def encrypted_content(self, safe_contents, store_pass):
+        algorithm, encrypted = pbe_encrypt(self.cert_encryption, safe_contents, store_pass, self.iterations)
+        encrypted_content_info = der.sequence(der.oid(OID_DATA), algorithm, der.context(0, encrypted, constructed=False))
+        return der.sequence(der.oid(OID_ENCRYPTED_DATA), der.context(0, der.sequence(der.integer(0), encrypted_content_info)))
+
+    def mac_data(self, auth_safe, store_pass):
+        hash_name = self.mac.lower()
+        salt = os.urandom(20)
+        key = pkcs12_kdf(hash_name, pkcs12_password(store_pass), salt, PURPOSE_MAC, self.mac_iterations, hashlib.new(hash_name).digest_size)
+        digest = hmac.new(key, auth_safe, hash_name).digest()
+        return der.sequence(der.sequence(der.algorithm(HASH_OIDS[hash_name]), der.octet_string(digest)), der.octet_string(salt), der.integer(self.mac_iterations))
+
+    def serialize(self, entries, store_pass):
+        key_bags, cert_bags, written = [], [], set()
+        for entry in entries:
+            if not entry.certificates:
+                raise ValueError(f"Entry '{entry.alias}' has no certificate.")
+            if entry.private_key is None:
+                cert_bags.append(self.cert_bag(certificate_der(entry.certificates[0]), self.attributes(entry.alias, trusted=True)))
+                continue
+            # PKCS12 has no per-entry password, every key is protected with the keystore password
+            leaf = certificate_der(entry.certificates[0])
+            local_key_id = hashlib.sha1(leaf).digest()
+            if leaf in written:
+                raise ValueError(f"Entry '{entry.alias}' uses the certificate of another entry.")
+            written.add(leaf)
+            key_bags.append(self.key_bag(entry.private_key, store_pass, self.attributes(entry.alias, local_key_id)))
+            cert_bags.append(self.cert_bag(leaf, self.attributes(entry.alias, local_key_id)))
+            for cert in entry.certificates[1:]:
+                # CA certificates shared by several chains are stored once
+                cert_der = certificate_der(cert)
+                if cert_der not in written:
+                    written.add(cert_der)
+                    cert_bags.append(self.cert_bag(cert_der))
+
+        contents = []
+        if cert_bags:
+            safe_contents = der.sequence(*cert_bags)
+            contents.append(self.data_content(safe_contents) if self.cert_encryption == 'NONE' else self.encrypted_content(safe_contents, store_pass))
+        if key_bags:
+            contents.append(self.data_content(der.sequence(*key_bags)))
+        auth_safe = der.sequence(*contents)
+        pfx = [der.integer(3), self.data_content(auth_safe)]
+        if self.mac != 'NONE':
+            pfx.append(self.mac_data(auth_safe, store_pass))
+        return der.sequence(*pfx)
+
+def check_aliases(aliases):
+    # Java keystores match aliases case-insensitively
+    aliases = [alias.lower() for alias in aliases]
+    duplicates = {alias for alias in aliases if aliases.count(alias) > 1}
+    if duplicates:
+        raise ValueError(f"Duplicate aliases: {', '.join(sorted(duplicates))}")
+
+WRITERS = {'JKS': JKSWriter, 'BKS': BKSWriter, 'PKCS12': PKCS12Writer}
+
+def serialize_keystore(store_type, entries, store_pass, options=None):
+    # options: PKCS12Writer parameters (key_encryption, cert_encryption, iterations, mac, mac_iterations)
+    if x509 is None:
+        raise ImportError("Writing keystores in-process requires the 'cryptography' package (pip install keysigner[native]).")
+    store_type = store_type.upper()
+    if store_type not in WRITERS:
+        raise ValueError(f"Invalid keystore type '{store_type}'. Expected one of: {', '.join(STORE_TYPES)}.")
+    if options and store_type != 'PKCS12':
+        raise ValueError(f"Encryption options are only supported for PKCS12 keystores, not {store_type}.")
+    check_aliases([entry.alias for entry in entries])
+    return WRITERS[store_type](**(options or {})).serialize(entries, store_pass)
+
+def writer_entries(keystore, store_pass, key_passes=None):
+    # Entries of a keystore read with keystore_reader, decrypted for writing; key_passes: alias -> key password
+    # Matched like the aliases themselves, case-insensitively
+    key_passes = {alias.lower(): password for alias, password in (key_passes or {}).items()}
+    entries = []
+    for entry in keystore.entries:
+        if entry.entry_type == PRIVATE_KEY_ENTRY:
+            private_key = entry.private_key(key_passes.get(entry.alias.lower(), store_pass))
+        elif entry.entry_type == TRUSTED_CERT_ENTRY:
+            private_key = None
+        else:
+            raise NotImplementedError(f"Entry '{entry.alias}' is a {entry.entry_type}, which cannot be copied.")
+        created = entry.created.timestamp() if entry.created else None
+        entries.append(KeystoreWriterEntry(entry.alias, private_key, [cert.certificate for cert in entry.certificates], key_passes.get(entry.alias.lower()), created))
+    return entries
+
+@traced('write keystore', 'io')
+def write_keystore(path, store_type, entries, store_pass, options=None):
+    data = serialize_keystore(store_type, entries, store_pass, options)
+    # Written under a temporary name and renamed, an existing keystore is never left half written
+    fd, temp_path = tempfile.mkstemp(prefix='.keysigner-', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return path
@@ -0,0 +1,198 @@
+import java.io.BufferedInputStream;
+import java.io.BufferedOutputStream;
+import java.io.ByteArrayInputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.DataInputStream;
+import java.io.DataOutputStream;
+import java.io.EOFException;
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.io.InputStream;
+import java.io.PrintStream;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.nio.charset.StandardCharsets;
+import java.security.Permission;
+import java.security.Provider;
+import java.security.Security;
+import java.util.Arrays;
+
+/*
+ * Long-lived JVM hosting the keytool and apksigner entry points for keysigner.
+ *
+ * Requests and responses are length-prefixed frames on stdin/stdout (see keysigner/jvm_worker.py):
+ *   request:  tool, argc, argv[argc]            (each string: int length + UTF-8 bytes)
+ *   response: ACCEPTED once the request is read, then exit code, captured stdout, captured stderr
+ */
+public class KeySignerWorker {
+    private static final int READY = 0x4B53574B;
+    private static final int ACCEPTED = 0x4B535741;
+    private static final String BC_PROVIDER = "org.bouncycastle.jce.provider.BouncyCastleProvider";
+    private static volatile boolean exitAllowed = false;
+
+    static class ExitTrappedException extends SecurityException {
+        final int status;
+
+        ExitTrappedException(int status) {
+            super("System.exit(" + status + ")");
+            this.status = status;
+        }
+    }
+
+    public static void main(String[] args) throws Exception {
+        DataInputStream in = new DataInputStream(new BufferedInputStream(System.in));
+        DataOutputStream out = new DataOutputStream(new BufferedOutputStream(new FileOutputStream(FileDescriptor.out)));
+
+        preloadProvider();
+        trapExit();
+        out.writeInt(READY);
+        out.flush();
+
+        while (true) {
+            String tool;
+            try {
+                tool = readString(in);
+            } catch (EOFException e) {
+                break;
+            }
+            int argc = in.readInt();
+            String[] toolArgs = new String[argc];
+            for (int i = 0; i < argc; i++) {
+                toolArgs[i] = readString(in);
+            }
+            // Tells the client the request was read: if the worker dies after this, the command may have run
+            out.writeInt(ACCEPTED);
+            out.flush();
+
+            ByteArrayOutputStream capturedOut = new ByteArrayOutputStream();
+            ByteArrayOutputStream capturedErr = new ByteArrayOutputStream();
+            PrintStream originalOut = System.out;
+            PrintStream originalErr = System.err;
+            InputStream originalIn = System.in;
+            PrintStream toolOut = new PrintStream(capturedOut, true, "UTF-8");
+            PrintStream toolErr = new PrintStream(capturedErr, true, "UTF-8");
+            int code;
+
+            System.setOut(toolOut);
+            System.setErr(toolErr);
+            System.setIn(new ByteArrayInputStream(new byte[0]));
+            try {
+                code = run(tool, toolArgs, toolOut);
+            } catch (InvocationTargetException e) {
+                code = failure(e.getCause(), toolErr);
+            } catch (Throwable t) {
+                code = failure(t, toolErr);
+            } finally {
+                toolOut.flush();
+                toolErr.flush();
+                System.setOut(originalOut);
+                System.setErr(originalErr);
+                System.setIn(originalIn);
+            }
+
+            out.writeInt(code);
+            writeBytes(out, capturedOut.toByteArray());
+            writeBytes(out, capturedErr.toByteArray());
+            out.flush();
+        }
+
+        exitAllowed = true;
+        System.exit(0);
+    }
+
+    private static int run(String tool, String[] args, PrintStream out) throws Exception {
+        if ("keytool".equals(tool)) {
+            Class<?> cls = Class.forName("sun.security.tools.keytool.Main");
+            java.lang.reflect.Constructor<?> constructor = cls.getDeclaredConstructor();
+            constructor.setAccessible(true);
+            Object keytool = constructor.newInstance();
+            Method method = cls.getDeclaredMethod("run", String[].class, PrintStream.class);
+            method.setAccessible(true);
+            Object result = method.invoke(keytool, args, out);
+            return result instanceof Integer ? (Integer) result : 0;
+        }
+        if ("apksigner".equals(tool)) {
+            Class<?> cls = Class.forName("com.android.apksigner.ApkSignerTool");
+            if (args.length > 0 && "sign".equals(args[0])) {
+                // main() turns option errors into System.exit(1), which ends the worker when exits cannot be
+                // trapped (JDK 24+). sign() reports every failure as an exception instead.
+                Method sign = null;
+                try {
+                    sign = cls.getDeclaredMethod("sign", String[].class);
+                } catch (NoSuchMethodException e) {
+                    // Other apksigner versions, fall back to main()
+                }
+                if (sign != null) {
+                    sign.setAccessible(true);
+                    sign.invoke(null, (Object) Arrays.copyOfRange(args, 1, args.length));
+                    return 0;
+                }
+            }
+            Method method = cls.getMethod("main", String[].class);
+            method.invoke(null, (Object) args);
+            return 0;
+        }
+        throw new IllegalArgumentException("Unknown tool: " + tool);
+    }
+
+    private static int failure(Throwable t, PrintStream err) {
+        if (t instanceof ExitTrappedException) {
+            return ((ExitTrappedException) t).status;
+        }
+        String name = t.getClass().getSimpleName();
+        if ("ParameterException".equals(name) || "OptionsException".equals(name)) {
+            // Printed the way ApkSignerTool.main() prints them
+            err.println(t.getMessage());
+        } else {
+            err.println("Exception: " + t);
+        }
+        return 1;
+    }
+
+    private static void preloadProvider() {
+        try {
+            Class<?> cls = Class.forName(BC_PROVIDER);
+            Security.addProvider((Provider) cls.getDeclaredConstructor().newInstance());
+        } catch (Throwable t) {
+            // BouncyCastle is optional, BKS requests fail the same way the keytool process would.
+        }
+    }
+
+    @SuppressWarnings("removal")
+    private static void trapExit() {
+        try {
+            System.setSecurityManager(new SecurityManager() {
+                @Override
+                public void checkExit(int status) {
+                    if (!exitAllowed) {
+                        throw new ExitTrappedException(status);
+                    }
+                }
+
+                @Override
+                public void checkPermission(Permission perm) {
+                }
+
+                @Override
+                public void checkPermission(Permission perm, Object context) {
+                }
+            });
+        } catch (Throwable t) {
+            // JDK 24+ removed the Security Manager (JDK 18-23 need -Djava.security.manager=allow, see
+            // jvm_worker.py). A tool calling System.exit() ends the worker instead, and the client reruns
+            // that request in a fresh process.
+        }
+    }
+
+    private static String readString(DataInputStream in) throws IOException {
+        byte[] data = new byte[in.readInt()];
+        in.readFully(data);
+        return new String(data, StandardCharsets.UTF_8);
+    }
+
+    private static void writeBytes(DataOutputStream out, byte[] data) throws IOException {
+        out.writeInt(data.length);
+        out.write(data);
+    }
+}
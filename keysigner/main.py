@@ -2,22 +2,24 @@
 # -*- coding: utf-8 -*-
 
 # import readline
+import sys
 from .keystore_generator import KeystoreGenerator
 from .keystore_migrator import KeystoreMigrator
 from .pkcs12_to_pem import PKCS12ToPEM
 from .pem_to_pkcs12 import PEMToPKCS12
 from .keystore_info import KeystoreInfo
 from .apk_signer import APKSigner
+from .cli import run_cli
 from .utils import *
 
 def show_notes():
     print(color_text("1. '.keystore' is just an extension name that is actually another form of the '.jks' extension. So, if you have a '.keystore' extension, you should consider it as '.jks'.", 36))
     print(color_text("\n2. Our suggestion is that if you need to generate a new keystore, generate it in PKCS12. Or, if you have already generated a JKS, migrate it to PKCS12. This is because PKCS12 is modern, secure, and widely compatible. We do not recommend migrating from PKCS12 to JKS at all. This option is provided because some third-party tools do not consider users' independence and force them to use a specific keystore.", 36))
-    print(color_text("\n3. If you want to add multiple entries to the existing keystore, just keep the 'keystore name', 'keystore password', and 'output path' the same, and tweak the other details for each new entry.", 36))
+    print(color_text("\n3. If you want to add multiple entries to the existing keystore, just keep the 'keystore name', 'keystore password', and 'output path' the same, and tweak the other details for each new entry. To create a keystore with many entries at once, use 'keysigner build-keystore', which writes the keystore only once.", 36))
     print(color_text("\n4. During migration from keystores to each other, there are opportunity to adjust the source information. So, feel free to change the 'keystore password' and 'alias name'. Don’t worry, your certificate and key will stay unchanged. You can check integrity of your certificate using option five.", 36))
     print(color_text("\n5. PKCS12 format doesn’t deal with different passwords for the keystore and aliases. So, the alias password will automatically be set to the keystore password.", 36))
     print(color_text("\n6. The default workflow of keytool is to access the first entry of the source keystore and match the alias key password with the keystore password.", 36))
-    print(color_text("\n7. Before you convert from PKCS12 to PEM, remember that 'x509.pem' and '.pk8' files will only come from the first entry. If you’ve got more entries, you’ll need to handle those one by one.", 36))
+    print(color_text("\n7. Before you convert from PKCS12 to PEM, remember that 'x509.pem' and '.pk8' files will only come from the first entry. If you’ve got more entries, answer yes to 'Export all entries?' (or use 'keysigner export-pem --all') to export every entry at once.", 36))
     print(color_text("\n8. Each time you create a keystore, make sure to generate its '.x509.pem' and '.pk8' files too. This way, you don’t have to keep re-entering passwords and names when you’re signing your APK.", 36))
     print(color_text("\n9. Direct signing of an APK file using apksigner with a BKS-type keystore is not supported. Therefore, it is necessary to first migrate from BKS to other keystores.", 36))
     print(color_text("\n10. If you sign your APK using apksigner and make further changes to the APK, the APK's signature is invalidated. If you use zipalign to align your APK, use it before signing the APK.", 36))
@@ -32,6 +34,11 @@ def show_notes():
     print("https://developer.android.com/tools/apksigner")
 
 def main():
+    if len(sys.argv) > 1:
+        return run_cli(sys.argv[1:], interactive=run_menu)
+    run_menu()
+
+def run_menu():
     logo_ascii_art()
     meta_data()
     while True:
@@ -81,4 +88,4 @@ def main():
             print_red("Invalid choice. Please select a valid option.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
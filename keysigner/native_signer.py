@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+
+import os
+import mmap
+import struct
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from .digest_cache import chunk_fingerprint
+from .jar_signer import JarSigner
+from .keystore_reader import read_keystore, PRIVATE_KEY_ENTRY
+from .trace import traced
+
+try:
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa, utils
+    from cryptography.hazmat.primitives.serialization import pkcs12
+except ImportError:
+    x509 = None
+
+CHUNK_SIZE = 1024 * 1024
+EOCD_SIG = b'PK\x05\x06'
+EOCD_MIN_SIZE = 22
+ZIP64_EOCD_LOCATOR_SIG = b'PK\x06\x07'
+APK_SIG_BLOCK_MAGIC = b'APK Sig Block 42'
+APK_SIG_BLOCK_MIN_SIZE = 32
+
+V2_BLOCK_ID = 0x7109871a
+V3_BLOCK_ID = 0xf05368c0
+STRIPPING_PROTECTION_ATTR_ID = 0xbeeff00d
+V3_MIN_SDK = 28
+V3_MAX_SDK = 0x7fffffff
+
+RSA_PKCS1_V1_5_WITH_SHA256 = 0x0103
+RSA_PKCS1_V1_5_WITH_SHA512 = 0x0104
+ECDSA_WITH_SHA256 = 0x0201
+ECDSA_WITH_SHA512 = 0x0202
+
+# signature algorithm id -> content digest hash
+CONTENT_DIGESTS = {
+    RSA_PKCS1_V1_5_WITH_SHA256: 'sha256',
+    RSA_PKCS1_V1_5_WITH_SHA512: 'sha512',
+    ECDSA_WITH_SHA256: 'sha256',
+    ECDSA_WITH_SHA512: 'sha512',
+}
+
+def native_signing_available():
+    return x509 is not None
+
+def sign_digest(private_key, hash_name, digest):
+    # Signs a SHA-256/512 digest computed elsewhere, the signature is the one sign_data() gives for the data itself
+    hash_algorithm = utils.Prehashed(hashes.SHA256() if hash_name == 'sha256' else hashes.SHA512())
+    if len(digest) != hash_algorithm.digest_size:
+        raise ValueError(f"Expected a {hash_algorithm.digest_size} byte {hash_name.upper()} digest, got {len(digest)} bytes.")
+    if isinstance(private_key, rsa.RSAPrivateKey):
+        return private_key.sign(digest, padding.PKCS1v15(), hash_algorithm)
+    return private_key.sign(digest, ec.ECDSA(hash_algorithm))
+
+def lp(data):
+    # Length-prefixed value, as used throughout the APK Signing Block
+    return struct.pack('<I', len(data)) + data
+
+def lp_sequence(items):
+    return lp(b''.join(lp(item) for item in items))
+
+def load_certificate(data):
+    if b'-----BEGIN' in data:
+        return x509.load_pem_x509_certificate(data)
+    return x509.load_der_x509_certificate(data)
+
+def load_private_key(data):
+    if b'-----BEGIN' in data:
+        return serialization.load_pem_private_key(data, password=None)
+    return serialization.load_der_private_key(data, password=None)
+
+def read_secret_file(path):
+    # Key material is read into a mutable buffer so that it can be wiped once parsed
+    with open(path, 'rb', buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        data = bytearray(size)
+        view = memoryview(data)
+        read = 0
+        while read < size:
+            count = f.readinto(view[read:])
+            if not count:
+                break
+            read += count
+        view.release()
+    del data[read:]
+    return data
+
+def wipe(buffer):
+    buffer[:] = b'\x00' * len(buffer)
+
+def load_keystore_entry(key_spec):
+    keystore = read_keystore(key_spec['keystore'], key_spec['store_pass'])
+    entry = keystore.entry(key_spec['alias'])
+    if entry.entry_type != PRIVATE_KEY_ENTRY:
+        raise ValueError(f"Alias '{entry.alias}' is a {entry.entry_type}, not a private key entry.")
+    private_key = entry.private_key(key_spec.get('key_pass') or key_spec['store_pass'])
+    return private_key, [cert.certificate for cert in entry.certificates]
+
+@traced('unlock key', 'crypto')
+def load_signing_key(key_spec, lib_path):
+    if x509 is None:
+        raise ImportError("The native signing engine requires the 'cryptography' package (pip install keysigner[native]).")
+
+    store_type = key_spec.get('type', '').lower()
+    if store_type in ['pem', 'test']:
+        cert_path = key_spec.get('cert') or os.path.join(lib_path, 'testkey.x509.pem')
+        key_path = key_spec.get('key') or os.path.join(lib_path, 'testkey.pk8')
+        with open(cert_path, 'rb') as f:
+            certificates = [load_certificate(f.read())]
+        key_data = read_secret_file(key_path)
+        try:
+            private_key = load_private_key(key_data)
+        finally:
+            wipe(key_data)
+    elif store_type == 'p12':
+        store_data = read_secret_file(key_spec['keystore'])
+        password = bytearray(key_spec['store_pass'].encode('utf-8'))
+        try:
+            store = pkcs12.load_pkcs12(store_data, password)
+        finally:
+            wipe(store_data)
+            wipe(password)
+        if store.key is None or store.cert is None:
+            raise ValueError("PKCS12 keystore does not contain a private key entry.")
+        alias = key_spec.get('alias')
+        friendly_name = store.cert.friendly_name.decode('utf-8') if store.cert.friendly_name else None
+        if alias and friendly_name and friendly_name.lower() != alias.lower():
+            # Not the first entry: look the alias up in the full keystore
+            private_key, certificates = load_keystore_entry(key_spec)
+        else:
+            private_key = store.key
+            certificates = [store.cert.certificate] + [cert.certificate for cert in store.additional_certs]
+    elif store_type == 'jks':
+        private_key, certificates = load_keystore_entry(key_spec)
+    else:
+        raise NotImplementedError(f"{store_type.upper()} keys are not supported by the native signing engine.")
+
+    public_key = serialization.PublicFormat.SubjectPublicKeyInfo
+    if private_key.public_key().public_bytes(serialization.Encoding.DER, public_key) != certificates[0].public_key().public_bytes(serialization.Encoding.DER, public_key):
+        raise ValueError("Private key does not match the certificate.")
+    return private_key, certificates
+
+def create_output(output_dir, prefix='.keysigner-', suffix='.apk'):
+    # Unlike mkstemp (always 0600), the file is created 0666 less the process umask, as apksigner's output is
+    while True:
+        temp_path = os.path.join(output_dir, f"{prefix}{os.urandom(8).hex()}{suffix}")
+        try:
+            return os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666), temp_path
+        except FileExistsError:
+            continue
+
+class ApkSections:
+    def __init__(self, data):
+        # data: read-only buffer (memoryview of an mmap) over the whole APK
+        size = len(data)
+        if size < EOCD_MIN_SIZE:
+            raise ValueError("Not a ZIP file: too small.")
+
+        self.eocd_offset = self.find_eocd(data, size)
+        if self.eocd_offset >= 20 and bytes(data[self.eocd_offset - 20:self.eocd_offset - 16]) == ZIP64_EOCD_LOCATOR_SIG:
+            raise ValueError("ZIP64 archives are not supported by the native signing engine.")
+
+        self.cd_size, self.cd_offset = struct.unpack('<II', data[self.eocd_offset + 12:self.eocd_offset + 20])
+        if self.cd_offset + self.cd_size != self.eocd_offset:
+            raise ValueError("ZIP Central Directory is not immediately followed by End of Central Directory.")
+
+        self.content_end = self.cd_offset
+        self.has_signing_block = False
+        if self.cd_offset >= APK_SIG_BLOCK_MIN_SIZE and bytes(data[self.cd_offset - 16:self.cd_offset]) == APK_SIG_BLOCK_MAGIC:
+            # Strip the existing APK Signing Block, it is replaced by the new one
+            (block_size,) = struct.unpack('<Q', data[self.cd_offset - 24:self.cd_offset - 16])
+            block_start = self.cd_offset - block_size - 8
+            if block_start < 0 or struct.unpack('<Q', data[block_start:block_start + 8])[0] != block_size:
+                raise ValueError("Malformed APK Signing Block.")
+            self.content_end = block_start
+            self.has_signing_block = True
+
+        self.eocd = bytes(data[self.eocd_offset:])
+
+    def find_eocd(self, data, size):
+        # The EOCD is followed by a comment of at most 65535 bytes
+        search_start = max(0, size - EOCD_MIN_SIZE - 0xFFFF)
+        tail = bytes(data[search_start:])
+        position = len(tail) - EOCD_MIN_SIZE
+        while position >= 0:
+            position = tail.rfind(EOCD_SIG, 0, position + 4)
+            if position < 0:
+                break
+            (comment_length,) = struct.unpack('<H', tail[position + 20:position + 22])
+            if position + EOCD_MIN_SIZE + comment_length == len(tail):
+                return search_start + position
+            position -= 1
+        raise ValueError("Not a ZIP file: End of Central Directory not found.")
+
+    def eocd_with_cd_offset(self, cd_offset):
+        return self.eocd[:16] + struct.pack('<I', cd_offset) + self.eocd[20:]
+
+    def digest_sections(self, data):
+        # Contents of ZIP entries, Central Directory, EOCD pointing at the start of the signing block
+        return [
+            data[:self.content_end],
+            data[self.cd_offset:self.cd_offset + self.cd_size],
+            self.eocd_with_cd_offset(self.content_end),
+        ]
+
+def chunk_digest(chunk, hash_name):
+    digest = hashlib.new(hash_name)
+    digest.update(b'\xa5' + struct.pack('<I', len(chunk)))
+    digest.update(chunk)
+    return digest.digest()
+
+def chunk_ranges(sections):
+    for index, section in enumerate(sections):
+        for offset in range(0, len(section), CHUNK_SIZE):
+            yield index, offset
+
+def parallel_map(func, items, workers):
+    # Ordered map over contiguous batches, hashlib and zlib release the GIL on large buffers
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    batch_count = min(len(items), workers * 4)
+    batch_size = -(-len(items) // batch_count)
+    batches = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return [result for batch in executor.map(lambda batch: [func(item) for item in batch], batches) for result in batch]
+
+@traced('content digest', 'digest')
+def compute_content_digest(sections, hash_name, workers=1, cache=None):
+    # Slicing the memoryview is zero-copy, the workers read straight from the mmap
+    chunk = lambda item: sections[item[0]][item[1]:item[1] + CHUNK_SIZE]
+    ranges = list(chunk_ranges(sections))
+
+    if cache is None or not cache.supports(hash_name):
+        digests = parallel_map(lambda item: chunk_digest(chunk(item), hash_name), ranges, workers)
+    else:
+        fingerprints = parallel_map(lambda item: chunk_fingerprint(chunk(item)), ranges, workers)
+        known = cache.lookup(fingerprints, hash_name)
+        missing = [i for i, fingerprint in enumerate(fingerprints) if fingerprint not in known]
+        computed = parallel_map(lambda i: chunk_digest(chunk(ranges[i]), hash_name), missing, workers)
+        fresh = {fingerprints[i]: digest for i, digest in zip(missing, computed)}
+        cache.store(fresh, hash_name)
+        known.update(fresh)
+        digests = [known[fingerprint] for fingerprint in fingerprints]
+
+    top = hashlib.new(hash_name)
+    top.update(b'\x5a' + struct.pack('<I', len(digests)))
+    for digest in digests:
+        top.update(digest)
+    return top.digest()
+
+class NativeAPKSigner:
+    def __init__(self, private_key, certificates, v2_enabled=True, v3_enabled=True, digest_workers=1, digest_cache=None, v1_enabled=False, min_sdk=None):
+        if not v1_enabled and not v2_enabled and not v3_enabled:
+            raise ValueError("At least one of the v1, v2 and v3 signature schemes must be enabled.")
+        self.private_key = private_key
+        self.certificates = certificates
+        self.v1_enabled = v1_enabled
+        self.min_sdk = min_sdk
+        self.v2_enabled = v2_enabled
+        self.v3_enabled = v3_enabled
+        self.digest_workers = max(1, digest_workers or 1)
+        self.digest_cache = digest_cache
+        self.algorithm = self.signature_algorithm()
+        self.hash_name = CONTENT_DIGESTS[self.algorithm]
+
+    def signature_algorithm(self):
+        # Same choice as apksigner: SHA-512 only for keys where SHA-256 would be the weak link
+        if isinstance(self.private_key, rsa.RSAPrivateKey):
+            return RSA_PKCS1_V1_5_WITH_SHA256 if self.private_key.key_size <= 3072 else RSA_PKCS1_V1_5_WITH_SHA512
+        if isinstance(self.private_key, ec.EllipticCurvePrivateKey):
+            return ECDSA_WITH_SHA256 if self.private_key.key_size <= 256 else ECDSA_WITH_SHA512
+        raise NotImplementedError(f"Unsupported key type for native signing: {type(self.private_key).__name__}")
+
+    def sign_data(self, data):
+        hash_algorithm = hashes.SHA256() if self.hash_name == 'sha256' else hashes.SHA512()
+        if isinstance(self.private_key, rsa.RSAPrivateKey):
+            return self.private_key.sign(data, padding.PKCS1v15(), hash_algorithm)
+        return self.private_key.sign(data, ec.ECDSA(hash_algorithm))
+
+    def public_key_der(self):
+        return self.certificates[0].public_key().public_bytes(serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)
+
+    def certificates_der(self):
+        return [cert.public_bytes(serialization.Encoding.DER) for cert in self.certificates]
+
+    def digests(self, content_digest):
+        return lp_sequence([struct.pack('<I', self.algorithm) + lp(content_digest)])
+
+    def signatures(self, signed_data):
+        return lp_sequence([struct.pack('<I', self.algorithm) + lp(self.sign_data(signed_data))])
+
+    def v2_signer(self, content_digest):
+        attributes = []
+        if self.v3_enabled:
+            # Stripping protection: tells v2 verifiers that a v3 signature must also be present
+            attributes.append(struct.pack('<II', STRIPPING_PROTECTION_ATTR_ID, 3))
+        signed_data = self.digests(content_digest) + lp_sequence(self.certificates_der()) + lp_sequence(attributes)
+        return lp_sequence([lp(signed_data) + self.signatures(signed_data) + lp(self.public_key_der())])
+
+    def v3_signer(self, content_digest):
+        sdk_range = struct.pack('<II', V3_MIN_SDK, V3_MAX_SDK)
+        signed_data = self.digests(content_digest) + lp_sequence(self.certificates_der()) + sdk_range + lp_sequence([])
+        return lp_sequence([lp(signed_data) + sdk_range + self.signatures(signed_data) + lp(self.public_key_der())])
+
+    @traced('signing block', 'crypto')
+    def signing_block(self, content_digest):
+        pairs = []
+        if self.v2_enabled:
+            pairs.append((V2_BLOCK_ID, self.v2_signer(content_digest)))
+        if self.v3_enabled:
+            pairs.append((V3_BLOCK_ID, self.v3_signer(content_digest)))
+        body = b''.join(struct.pack('<QI', len(value) + 4, block_id) + value for block_id, value in pairs)
+        block_size = len(body) + 8 + 16
+        return struct.pack('<Q', block_size) + body + struct.pack('<Q', block_size) + APK_SIG_BLOCK_MAGIC
+
+    def content_digest(self, sections):
+        cache = self.digest_cache
+        if cache is not None and not cache.supports(self.hash_name):
+            cache.record_skip()
+            cache = None
+        digest = compute_content_digest(sections, self.hash_name, self.digest_workers, cache)
+        if cache is not None and cache.verify:
+            # Signatures are only byte-identical to an uncached run if the content digests are
+            uncached = compute_content_digest(sections, self.hash_name, self.digest_workers)
+            if uncached != digest:
+                cache.record_mismatch()
+                return uncached
+        return digest
+
+    def sign(self, apk_file, signed_apk):
+        if not self.v1_enabled:
+            return self.sign_apk_schemes(apk_file, signed_apk)
+
+        # v1 first: the v2/v3 content digests cover the JAR signature entries
+        output_dir = os.path.dirname(os.path.abspath(signed_apk))
+        fd, jar_signed = create_output(output_dir, prefix='.keysigner-v1-')
+        os.close(fd)
+        try:
+            with open(apk_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as apk_map:
+                data = memoryview(apk_map)
+                try:
+                    self.jar_signer().sign(apk_file, data, ApkSections(data), jar_signed)
+                finally:
+                    data.release()
+            if self.v2_enabled or self.v3_enabled:
+                self.sign_apk_schemes(jar_signed, signed_apk)
+            else:
+                os.replace(jar_signed, signed_apk)
+        finally:
+            if os.path.exists(jar_signed):
+                os.remove(jar_signed)
+        return signed_apk
+
+    def jar_signer(self):
+        schemes = [scheme for scheme, enabled in [(2, self.v2_enabled), (3, self.v3_enabled)] if enabled]
+        return JarSigner(self.private_key, self.certificates, min_sdk=self.min_sdk, apk_signed_schemes=schemes)
+
+    def sign_apk_schemes(self, apk_file, signed_apk):
+        with open(apk_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as apk_map:
+            data = memoryview(apk_map)
+            try:
+                apk = ApkSections(data)
+                sections = apk.digest_sections(data)
+                block = self.signing_block(self.content_digest(sections))
+                del sections
+                self.write_signed_apk(data, apk, block, signed_apk)
+            finally:
+                data.release()
+        return signed_apk
+
+    @traced('write apk', 'io')
+    def write_signed_apk(self, data, apk, block, signed_apk):
+        # One sequential pass: entries, new signing block, Central Directory, EOCD with the shifted CD offset
+        output_dir = os.path.dirname(os.path.abspath(signed_apk))
+        fd, temp_path = create_output(output_dir)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                for offset in range(0, apk.content_end, CHUNK_SIZE):
+                    out.write(data[offset:min(offset + CHUNK_SIZE, apk.content_end)])
+                out.write(block)
+                out.write(data[apk.cd_offset:apk.cd_offset + apk.cd_size])
+                out.write(apk.eocd_with_cd_offset(apk.content_end + len(block)))
+            os.replace(temp_path, signed_apk)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
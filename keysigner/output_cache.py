@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import fcntl
+import base64
+import shutil
+import hashlib
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+
+DEFAULT_MAX_SIZE = 5 * 1024 ** 3
+READ_SIZE = 1024 * 1024
+FICLONE = 0x40049409
+# Bump when a change to the signers makes previously cached outputs invalid. 2: outputs of version 1 could be
+# hardlinks of the cached objects, and an output edited in place (zipalign -f, re-signing) corrupted its object
+KEY_VERSION = 2
+
+def default_output_cache_path():
+    return os.path.join(os.path.expanduser('~'), '.cache', 'keysigner', 'signed')
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb', buffering=0) as f:
+        for block in iter(lambda: f.read(READ_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def pem_certificate_fingerprint(path):
+    # SHA-256 of the DER certificate, the same value apksigner and keytool print
+    with open(path, 'rb') as f:
+        data = f.read()
+    if b'-----BEGIN CERTIFICATE-----' in data:
+        body = data.split(b'-----BEGIN CERTIFICATE-----', 1)[1].split(b'-----END CERTIFICATE-----', 1)[0]
+        data = base64.b64decode(b''.join(body.split()))
+    return hashlib.sha256(data).hexdigest()
+
+def signer_identity(key_spec, lib_path):
+    store_type = key_spec.get('type', '').lower()
+    if store_type in ['pem', 'test']:
+        cert = key_spec.get('cert') or os.path.join(lib_path, 'testkey.x509.pem')
+        return f"cert:{pem_certificate_fingerprint(cert)}"
+    if store_type in ['jks', 'p12']:
+        # The certificate is only readable with the password: the keystore contents and alias stand in for it
+        return f"keystore:{file_sha256(key_spec['keystore'])}:{key_spec['alias'].lower()}"
+    raise ValueError(f"Invalid keystore type '{store_type}'. Expected one of: jks, p12, pem, test.")
+
+def clone_file(source, target):
+    # Copy-on-write clone (btrfs, XFS, bcachefs), else a plain copy. Never a hardlink: the output and the cached
+    # object would be one file, and editing the output in place would corrupt every later hit
+    try:
+        with open(source, 'rb') as src, open(target, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return 'reflink'
+    except OSError:
+        if os.path.exists(target):
+            os.remove(target)
+    shutil.copyfile(source, target)
+    return 'copy'
+
+def detach_output(path):
+    # Outputs of earlier versions can be hardlinks of cached objects, signing into one in place would corrupt the cache
+    if os.path.exists(path) and os.stat(path).st_nlink > 1:
+        os.remove(path)
+
+def materialize(source, target):
+    # Cloned through a temporary name, so an existing target is replaced atomically
+    target_dir = os.path.dirname(os.path.abspath(target))
+    fd, temp_path = tempfile.mkstemp(prefix='.keysigner-', suffix='.apk', dir=target_dir)
+    os.close(fd)
+    os.remove(temp_path)
+    try:
+        method = clone_file(source, temp_path)
+        os.replace(temp_path, target)
+        return method
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+class SignedOutputCache:
+    def __init__(self, path=None, max_size=DEFAULT_MAX_SIZE):
+        self.path = os.path.abspath(path or default_output_cache_path())
+        self.objects_path = os.path.join(self.path, 'objects')
+        self.index_path = os.path.join(self.path, 'index.sqlite')
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.objects_path, exist_ok=True)
+        with self.connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS outputs ('
+                'key TEXT PRIMARY KEY, size INTEGER NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)'
+            )
+            db.execute('CREATE INDEX IF NOT EXISTS outputs_last_used ON outputs (last_used)')
+
+    @contextmanager
+    def connect(self):
+        db = sqlite3.connect(self.index_path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def cache_key(self, apk_file, identity, schemes):
+        flags = ','.join(f"{name}={int(bool(schemes.get(name)))}" for name in ['v1', 'v2', 'v3', 'v4'])
+        material = f"{KEY_VERSION}\n{file_sha256(apk_file)}\n{identity}\n{flags}"
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def object_path(self, key):
+        return os.path.join(self.objects_path, key[:2], f"{key}.apk")
+
+    def fetch(self, key, signed_apk):
+        # Returns how the output was materialized, or None on a miss
+        path = self.object_path(key)
+        with self.connect() as db:
+            row = db.execute('SELECT size FROM outputs WHERE key = ?', (key,)).fetchone()
+            if row is not None and (not os.path.exists(path) or os.path.getsize(path) != row[0]):
+                # Removed or truncated behind our back
+                db.execute('DELETE FROM outputs WHERE key = ?', (key,))
+                row = None
+            if row is not None:
+                db.execute('UPDATE outputs SET last_used = ? WHERE key = ?', (time.time(), key))
+        if row is None:
+            with self.lock:
+                self.misses += 1
+            return None
+        method = materialize(path, signed_apk)
+        with self.lock:
+            self.hits += 1
+        return method
+
+    def store(self, key, signed_apk):
+        path = self.object_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        materialize(signed_apk, path)
+        now = time.time()
+        with self.connect() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO outputs (key, size, created, last_used) VALUES (?, ?, ?, ?)',
+                (key, os.path.getsize(path), now, now)
+            )
+            self.evict(db, self.max_size)
+
+    def evict(self, db, max_size):
+        removed = 0
+        (total,) = db.execute('SELECT COALESCE(SUM(size), 0) FROM outputs').fetchone()
+        for key, size in db.execute('SELECT key, size FROM outputs ORDER BY last_used').fetchall():
+            if total <= max_size:
+                break
+            db.execute('DELETE FROM outputs WHERE key = ?', (key,))
+            if os.path.exists(self.object_path(key)):
+                os.remove(self.object_path(key))
+            total -= size
+            removed += 1
+        return removed
+
+    def prune(self, max_size=None):
+        with self.connect() as db:
+            removed = self.evict(db, self.max_size if max_size is None else max_size)
+            known = {key for (key,) in db.execute('SELECT key FROM outputs')}
+        # Objects without an index row are left over from interrupted runs
+        stale_before = time.time() - 3600
+        for directory, _, names in os.walk(self.objects_path):
+            for name in names:
+                path = os.path.join(directory, name)
+                if name.startswith('.keysigner-') and os.path.getmtime(path) > stale_before:
+                    # Possibly being stored by a running batch
+                    continue
+                if name[:-4] not in known:
+                    os.remove(path)
+                    removed += 1
+        return removed
+
+    def stats(self):
+        with self.connect() as db:
+            entries, size = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM outputs').fetchone()
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'entries': entries,
+            'size': size,
+            'max_size': self.max_size,
+            'path': self.path,
+        }
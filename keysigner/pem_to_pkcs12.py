@@ -1,11 +1,44 @@
 # -*- coding: utf-8 -*-
 
 import os
-import subprocess
+import tempfile
+from .keystore_reader import read_keystore
+from .keystore_writer import KeystoreWriterEntry, write_keystore, writer_entries, writer_available
+from .native_signer import load_private_key, read_secret_file, wipe
+from .pkcs12_to_pem import BACKENDS, default_backend
+from .tool_runner import run_process
+from .journal import log_command, record
+from .trace import traced
 from .utils import *
 
+try:
+    from cryptography import x509
+    from cryptography.hazmat.primitives import serialization
+except ImportError:
+    x509 = None
+
+@traced('read pem', 'io')
+def load_pem_pair(cert_path, key_path):
+    # The certificate (a PEM chain, leaf first, or DER) and the PKCS8 key (DER or PEM) are each read once
+    with open(cert_path, 'rb') as f:
+        cert_data = f.read()
+    if b'-----BEGIN' in cert_data:
+        certificates = x509.load_pem_x509_certificates(cert_data)
+    else:
+        certificates = [x509.load_der_x509_certificate(cert_data)]
+    key_data = read_secret_file(key_path)
+    try:
+        private_key = load_private_key(key_data)
+    finally:
+        wipe(key_data)
+
+    public_key = serialization.PublicFormat.SubjectPublicKeyInfo
+    if private_key.public_key().public_bytes(serialization.Encoding.DER, public_key) != certificates[0].public_key().public_bytes(serialization.Encoding.DER, public_key):
+        raise ValueError(f"Private key {key_path} does not match the certificate {cert_path}.")
+    return private_key, certificates
+
 class PEMToPKCS12:
-    def __init__(self):
+    def __init__(self, backend=None, options=None, timeout=None):
         self.cert_path = None
         self.key_path = None
         self.pem_key_path = None
@@ -14,7 +47,18 @@ class PEMToPKCS12:
         self.store_pass = None
         self.output_path = None
         self.keystore_path = None
-
+        # PKCS12Writer parameters: key_encryption, cert_encryption, iterations, mac, mac_iterations
+        self.options = options or {}
+        self.timeout = timeout
+        self.backend = backend or default_backend()
+        if self.backend not in BACKENDS:
+            raise ValueError(f"Invalid backend '{self.backend}'. Expected one of: {', '.join(BACKENDS)}.")
+        if self.backend == 'native' and not writer_available():
+            raise ImportError("The native backend requires the 'cryptography' package (pip install keysigner[native]).")
+        if self.backend == 'openssl' and self.options:
+            raise ValueError("PBE and MAC options are only supported by the native backend.")
+
+    @traced('input', 'prompt')
     def get_conversion_input(self):
         print_blue("\n--- Gathering PEM to PKCS12 Conversion Input ---")
         self.cert_path = validate_input(cyan_text("Enter x509 certificate path: "), path=True)
@@ -47,19 +91,62 @@ class PEMToPKCS12:
                 "-out", self.pem_key_path
             ]
 
-            result = subprocess.run(pk8_to_pem_cmd)
+            result = run_process(pk8_to_pem_cmd, timeout=self.timeout)
             if result.returncode != 0:
                 print_red("Private key conversion to PEM format failed.")
                 exit()
 
             print_green("Private key successfully converted to PEM format!")
             print_green(f"Private key exported to: {self.pem_key_path}")
-            self.handle_and_generate_command([pk8_to_pem_cmd], "OpenSSL Command for PK8 to PEM Conversion")
+            log_command(self.output_path, "OpenSSL Command for PK8 to PEM Conversion", pk8_to_pem_cmd)
         except Exception as e:
             print_red(f"Error occurred: {e}")
             exit()
 
+    @traced('build pkcs12', 'keystore')
+    def build(self, pairs, keystore_path, store_pass, append=False):
+        # pairs: (alias, certificate path, PKCS8 key path); all entries are assembled in memory and written once
+        entries = []
+        if append and os.path.exists(keystore_path):
+            entries = writer_entries(read_keystore(keystore_path, store_pass), store_pass)
+        for alias, cert_path, key_path in pairs:
+            private_key, certificates = load_pem_pair(cert_path, key_path)
+            entries.append(KeystoreWriterEntry(alias, private_key, certificates))
+        write_keystore(keystore_path, 'PKCS12', entries, store_pass, self.options)
+        record(os.path.dirname(keystore_path), 'import', keystore=keystore_path, aliases=[alias for alias, _, _ in pairs], store_type='PKCS12', backend='native', append=append)
+        return [entry.alias for entry in entries]
+
+    def export(self, pairs, keystore_path, store_pass, append=False):
+        keystore_path = os.path.abspath(keystore_path)
+        os.makedirs(os.path.dirname(keystore_path), exist_ok=True)
+        if self.backend == 'native':
+            return self.build(pairs, keystore_path, store_pass, append)
+
+        if append or len(pairs) != 1:
+            raise ValueError("The openssl backend writes one entry per keystore, use the native backend to add several.")
+        alias, cert_path, key_path = pairs[0]
+        with tempfile.TemporaryDirectory(prefix='keysigner-') as temp_dir:
+            pem_key_path = os.path.join(temp_dir, 'key.pem')
+            for cmd, error in [
+                (["openssl", "pkcs8", "-inform", "DER", "-outform", "PEM", "-nocrypt", "-in", key_path, "-out", pem_key_path], "Private key conversion to PEM format failed."),
+                (["openssl", "pkcs12", "-export", "-in", cert_path, "-inkey", pem_key_path, "-name", alias, "-out", keystore_path, "-password", f"pass:{store_pass}"], "PKCS12 conversion failed."),
+            ]:
+                result = run_process(cmd, capture_output=True, timeout=self.timeout)
+                if result.returncode != 0:
+                    raise RuntimeError(f"{error} {result.stderr.strip()}")
+        record(os.path.dirname(keystore_path), 'import', keystore=keystore_path, alias=alias, store_type='PKCS12', backend='openssl')
+        return [alias]
+
     def convert_pem_to_p12(self):
+        if self.backend == 'native':
+            try:
+                self.get_conversion_input()
+                self.execute_native()
+            except Exception as e:
+                print_red(f"Error occurred: {e}")
+                exit()
+            return
+
         try:
             self.convert_pk8_to_pem()
 
@@ -80,9 +167,21 @@ class PEMToPKCS12:
             print_red(f"Error occurred: {e}")
             exit()
 
+    def execute_native(self):
+        print_blue("\n--- Building PKCS12 Keystore from PEM Certificate and PKCS8 Key ---")
+        try:
+            self.build([(self.alias, self.cert_path, self.key_path)], self.keystore_path, self.store_pass)
+        except ValueError as e:
+            print_red(f"PKCS12 conversion failed: {e}")
+            return
+
+        print_green("PKCS12 keystore built successfully!")
+        print_green(f"Keystore PKCS12 exported to: {self.keystore_path}")
+        self.generate_apksigner_command()
+
     def execute_command(self):
         try:
-            result = subprocess.run(self.p12_cmd)
+            result = run_process(self.p12_cmd, timeout=self.timeout)
             if result.returncode != 0:
                 print_red("PKCS12 conversion failed.")
                 return
@@ -90,7 +189,7 @@ class PEMToPKCS12:
             print_green("OpenSSL command executed successfully!")
             if os.path.exists(self.keystore_path):
                 print_green(f"Keystore PKCS12 exported to: {self.keystore_path}")
-                self.handle_and_generate_command([self.p12_cmd], "OpenSSL Command for PEM to PKCS12 Conversion")
+                log_command(self.output_path, "OpenSSL Command for PEM to PKCS12 Conversion", self.p12_cmd, event='import', keystore=self.keystore_path, alias=self.alias, store_type='PKCS12')
             else:
                 print_red("Error: Keystore file missing after conversion.")
         except Exception as e:
@@ -114,43 +213,7 @@ class PEMToPKCS12:
             ]
 
             print_green("APKSigner command generated successfully!")
-            self.handle_and_generate_command([self.apksigner_cmd], "APKSigner Command")
+            log_command(self.output_path, "APKSigner Command", self.apksigner_cmd, keystore=self.keystore_path, alias=self.alias)
         except Exception as e:
             print_red(f"Error occurred: {e}")
             exit()
-
-    def handle_and_generate_command(self, cmd_list, description):
-        print_blue(f"\n--- {description} ---")
-        if any(isinstance(i, list) for i in cmd_list):
-            cmd_list = [item for sublist in cmd_list for item in sublist]
-
-        def format_cmd(cmd):
-            full_cmd = []
-            for c in cmd:
-                if ' ' in c:
-                    full_cmd.append(f'"{c}"')
-                else:
-                    full_cmd.append(c)
-            return " ".join(full_cmd)
-
-        commands = []
-
-        if "PK8 to PEM" in description:
-            commands.append("OpenSSL command to convert PKCS8 (PK8) Key to PEM:")
-            commands.append(format_cmd(cmd_list))
-        elif "PEM to PKCS12" in description:
-            commands.append("OpenSSL command to convert PEM to PKCS12:")
-            commands.append(format_cmd(self.p12_cmd))
-        elif "APKSigner" in description:
-            commands.append("APKSigner command to sign APK:")
-            commands.append(format_cmd(self.apksigner_cmd))
-        else:
-            commands.append(f"{description}:")
-            commands.append(format_cmd(cmd_list))
-
-        full_command_output = "\n".join(commands)
-
-        cmd_file = os.path.abspath(os.path.join(self.output_path, f"{self.store_name}_PKCS12_commands.txt"))
-        with open(cmd_file, 'a') as f:
-            f.write(f"{full_command_output}\n\n")
-        print_green(f"{description} exported to {cmd_file}")
\ No newline at end of file
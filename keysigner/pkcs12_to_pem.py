@@ -1,20 +1,60 @@
 # -*- coding: utf-8 -*-
 
 import os
-import subprocess
+import re
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from .tool_runner import run_process
+from .keystore_reader import PRIVATE_KEY_ENTRY, TRUSTED_CERT_ENTRY, read_keystore
+from .journal import log_command, record, journal_batch
+from .checkpoint import Checkpoint, file_state
+from .trace import traced
 from .utils import *
 
+try:
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.serialization import pkcs12
+except ImportError:
+    serialization = pkcs12 = None
+
+BACKENDS = ['native', 'openssl']
+
+def default_backend():
+    backend = os.environ.get('KEYSIGNER_PKCS12_BACKEND', '').lower()
+    if backend in BACKENDS:
+        return backend
+    return 'native' if pkcs12 is not None else 'openssl'
+
+def pem_file_name(alias):
+    # Aliases are free text, file names keep letters, digits, '.', '_' and '-'
+    return re.sub(r'[^A-Za-z0-9._-]', '_', alias).strip('.') or 'entry'
+
+def write_private_key(path, key_der):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key_der)
+
 class PKCS12ToPEM:
-    def __init__(self):
+    def __init__(self, backend=None, timeout=None):
         self.p12_path = None
         self.store_pass = None
         self.output_path = None
+        self.all_entries = False
+        self.timeout = timeout
+        self.backend = backend or default_backend()
+        if self.backend not in BACKENDS:
+            raise ValueError(f"Invalid backend '{self.backend}'. Expected one of: {', '.join(BACKENDS)}.")
+        if self.backend == 'native' and pkcs12 is None:
+            raise ImportError("The native backend requires the 'cryptography' package (pip install keysigner[native]).")
 
+    @traced('input', 'prompt')
     def get_conversion_input(self):
         print_blue("\n--- Gathering PKCS12 Conversion Input ---")
         self.p12_path = validate_input(cyan_text("Enter PKCS12 keystore path: "), path=True)
         self.store_pass = validate_input(cyan_text("Enter keystore password: "), password=True, min_length=6)
         self.output_path = validate_input(cyan_text(f"Enter output path (default: {os.path.abspath('keystore')}): "), required=False)
+        if self.backend == 'native':
+            self.all_entries = validate_input(cyan_text("Export all entries? (y/N): "), required=False).lower() in ['y', 'yes']
 
         if not self.output_path or not os.path.exists(self.output_path):
             self.output_path = ensure_directory(self.output_path)
@@ -26,47 +66,207 @@ class PKCS12ToPEM:
     def convert_p12_to_pem(self):
         try:
             self.get_conversion_input()
-            self.pem_path = os.path.join(self.output_path, os.path.basename(self.p12_path).replace(".p12", ".pem"))
-            self.x509_path = os.path.join(self.output_path, os.path.basename(self.p12_path).replace(".p12", ".x509.pem"))
-            self.key_path = os.path.join(self.output_path, os.path.basename(self.p12_path).replace(".p12", ".pk8"))
-    
-            self.pem_cmd = ['openssl', 'pkcs12', '-in', self.p12_path, '-out', self.pem_path, '-nodes', '-password', f'pass:{self.store_pass}']
-            self.x509_cmd = ['openssl', 'x509', '-in', self.pem_path, '-out', self.x509_path, '-outform', 'PEM']
-            self.key_cmd = ['openssl', 'pkcs8', '-topk8', '-inform', 'PEM', '-outform', 'DER', '-in', self.pem_path, '-out', self.key_path, '-nocrypt']
-    
-            self.execute_commands()
+            self.prepare_paths()
+            if self.all_entries:
+                self.execute_all()
+            elif self.backend == 'native':
+                self.execute_native()
+            else:
+                self.execute_commands()
         except Exception as e:
             print_red(f"Error occurred: {e}")
             exit()
 
+    @traced('build command', 'command')
+    def prepare_paths(self):
+        self.pem_path = os.path.join(self.output_path, os.path.basename(self.p12_path).replace(".p12", ".pem"))
+        self.x509_path = os.path.join(self.output_path, os.path.basename(self.p12_path).replace(".p12", ".x509.pem"))
+        self.key_path = os.path.join(self.output_path, os.path.basename(self.p12_path).replace(".p12", ".pk8"))
+
+        self.pem_cmd = ['openssl', 'pkcs12', '-in', self.p12_path, '-out', self.pem_path, '-nodes', '-password', f'pass:{self.store_pass}']
+        self.x509_cmd = ['openssl', 'x509', '-in', self.pem_path, '-out', self.x509_path, '-outform', 'PEM']
+        self.key_cmd = ['openssl', 'pkcs8', '-topk8', '-inform', 'PEM', '-outform', 'DER', '-in', self.pem_path, '-out', self.key_path, '-nocrypt']
+
+    def export(self, p12_path, store_pass, output_path=None):
+        self.p12_path = os.path.abspath(p12_path)
+        self.store_pass = store_pass
+        self.output_path = ensure_directory(output_path)
+        self.prepare_paths()
+        if self.backend == 'native':
+            self.write_native()
+        else:
+            for cmd, error in [(self.pem_cmd, "PEM conversion failed."), (self.x509_cmd, "x509 certificate extraction failed."), (self.key_cmd, "Private key extraction failed.")]:
+                result = run_process(cmd, capture_output=True, timeout=self.timeout)
+                if result.returncode != 0:
+                    raise RuntimeError(f"{error} {result.stderr.strip()}")
+            record(self.output_path, 'export', keystore=self.p12_path, backend='openssl', outputs=[self.x509_path, self.key_path])
+        return self.x509_path, self.key_path
+
+    @traced('export pem', 'keystore')
+    def write_native(self):
+        # Decrypt once in memory and write the certificate and PKCS8 key directly, no plaintext intermediate file
+        with open(self.p12_path, 'rb') as f:
+            key, cert, _ = pkcs12.load_key_and_certificates(f.read(), self.store_pass.encode('utf-8'))
+        if key is None or cert is None:
+            raise ValueError("PKCS12 keystore does not contain a private key entry with a certificate.")
+
+        with open(self.x509_path, 'wb') as f:
+            f.write(cert.public_bytes(serialization.Encoding.PEM))
+
+        write_private_key(self.key_path, key.private_bytes(serialization.Encoding.DER, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+        record(self.output_path, 'export', keystore=self.p12_path, backend='native', outputs=[self.x509_path, self.key_path])
+
+    @traced('export pem entries', 'keystore')
+    def export_all(self, p12_path, store_pass, output_path=None, workers=None):
+        # Every entry from one parse of the keystore: <alias>.x509.pem and <alias>.pk8 for key entries, plus
+        # <alias>.chain.pem when the chain has more than the certificate, and <alias>.x509.pem for trusted certificates
+        if self.backend != 'native':
+            raise ValueError("Exporting all entries needs the native backend, the openssl backend only exports the first entry.")
+        self.p12_path = os.path.abspath(p12_path)
+        self.store_pass = store_pass
+        self.output_path = ensure_directory(output_path)
+        keystore = read_keystore(self.p12_path, store_pass, 'PKCS12')
+        entries = [entry for entry in keystore.entries if entry.entry_type in [PRIVATE_KEY_ENTRY, TRUSTED_CERT_ENTRY] and entry.certificates]
+        if not entries:
+            raise ValueError("PKCS12 keystore does not contain any entry with a certificate.")
+        names = [pem_file_name(entry.alias).lower() for entry in entries]
+        duplicates = {entry.alias for entry, name in zip(entries, names) if names.count(name) > 1}
+        if duplicates:
+            raise ValueError(f"Aliases would be written to the same files: {', '.join(sorted(duplicates))}")
+
+        # The keys are decrypted and the files written concurrently, each entry has its own key encryption
+        with ThreadPoolExecutor(max_workers=max(1, min(workers or os.cpu_count() or 1, len(entries)))) as executor:
+            results = list(executor.map(self.write_entry, entries))
+        outputs = [path for result in results for path in [result['cert'], result['chain'], result['key']] if path]
+        record(self.output_path, 'export', keystore=self.p12_path, aliases=[result['alias'] for result in results], backend='native', outputs=outputs)
+        return results
+
+    def export_one(self, p12_path, store_pass, output_path, all_entries=False, workers=None):
+        # A converter per keystore, export() and export_all() keep the paths of the keystore they convert
+        result = {'keystore': p12_path, 'output_path': output_path, 'success': False, 'error': None, 'outputs': [], 'entries': None}
+        converter = PKCS12ToPEM(self.backend, self.timeout)
+        try:
+            if all_entries:
+                result['entries'] = converter.export_all(p12_path, store_pass, output_path, workers)
+                result['outputs'] = [path for entry in result['entries'] for path in [entry['cert'], entry['chain'], entry['key']] if path]
+            else:
+                result['outputs'] = list(converter.export(p12_path, store_pass, output_path))
+            result['success'] = True
+        except Exception as e:
+            result['error'] = str(e)
+        return result
+
+    def checkpoint_inputs(self, p12_path, all_entries):
+        return {'keystore': file_state(p12_path), 'all': all_entries, 'backend': self.backend}
+
+    @journal_batch()
+    def export_many(self, p12_paths, store_pass, output_path=None, all_entries=False, workers=None, checkpoint=None):
+        self.output_path = ensure_directory(output_path)
+        p12_paths = [os.path.abspath(path) for path in p12_paths]
+        names = [os.path.splitext(os.path.basename(path))[0] for path in p12_paths]
+        duplicates = {name for name in names if names.count(name) > 1}
+        if duplicates:
+            raise ValueError(f"Multiple keystores would be exported to the same files: {', '.join(sorted(duplicates))}")
+        # The entries of several keystores could share aliases, each keystore gets its own directory
+        output_paths = [os.path.join(self.output_path, name) if all_entries and len(p12_paths) > 1 else self.output_path for name in names]
+
+        checkpoint = (checkpoint or Checkpoint('export', retries=0, enabled=False)).start(self.output_path)
+        workers = max(1, workers or os.cpu_count() or 1)
+        # The workers are shared between keystores and, with all_entries, the entries of each keystore
+        keystore_workers = min(workers, len(p12_paths) or 1)
+        entry_workers = max(1, workers // keystore_workers)
+        with ThreadPoolExecutor(max_workers=keystore_workers) as executor:
+            return list(executor.map(
+                lambda item: checkpoint.run(
+                    item[0], functools.partial(self.export_one, item[0], store_pass, item[1], all_entries, entry_workers),
+                    functools.partial(self.checkpoint_inputs, item[0], all_entries), lambda result: result['outputs']
+                ),
+                zip(p12_paths, output_paths)
+            ))
+
+    def write_entry(self, entry):
+        base = os.path.join(self.output_path, pem_file_name(entry.alias))
+        result = {'alias': entry.alias, 'type': entry.entry_type, 'sha256': entry.certificates[0].fingerprint('sha256'), 'cert': f"{base}.x509.pem", 'chain': None, 'key': None}
+        key_der = None
+        if entry.entry_type == PRIVATE_KEY_ENTRY:
+            # Decrypted before any file of the entry is written
+            key = entry.private_key(self.store_pass)
+            key_der = key.private_bytes(serialization.Encoding.DER, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+        with open(result['cert'], 'wb') as f:
+            f.write(entry.certificates[0].certificate.public_bytes(serialization.Encoding.PEM))
+        if len(entry.certificates) > 1:
+            result['chain'] = f"{base}.chain.pem"
+            with open(result['chain'], 'wb') as f:
+                f.write(b''.join(cert.certificate.public_bytes(serialization.Encoding.PEM) for cert in entry.certificates))
+        if key_der is not None:
+            result['key'] = f"{base}.pk8"
+            write_private_key(result['key'], key_der)
+        return result
+
+    def execute_all(self):
+        print_blue("\n--- Extracting All Entries ---")
+        try:
+            results = self.export_all(self.p12_path, self.store_pass, self.output_path)
+        except ValueError as e:
+            print_red(f"PKCS12 extraction failed: {e}")
+            return
+
+        print_green("PKCS12 keystore decrypted successfully!")
+        print_green(f"Files exported to: {self.output_path}")
+        for result in results:
+            print_green(f"{result['alias']} ({result['type']}):")
+            for label, path in [('x509 certificate:', result['cert']), ('Certificate chain:', result['chain']), ('Private key (PKCS8 format):', result['key'])]:
+                if path:
+                    print_green(f"    {label} {path}")
+        for result in results:
+            if result['key']:
+                self.generate_apksigner_command(result['cert'], result['key'])
+
+    def execute_native(self):
+        print_blue("\n--- Extracting Certificate and Private Key ---")
+        try:
+            self.write_native()
+        except ValueError as e:
+            print_red(f"PKCS12 extraction failed: {e}")
+            return
+
+        print_green("PKCS12 keystore decrypted successfully!")
+        print_green(f"Files exported to: {self.output_path}")
+        print_green(f"{'x509 certificate:'} {self.x509_path}")
+        print_green(f"{'Private key (PKCS8 format):'} {self.key_path}")
+        self.generate_apksigner_command(self.x509_path, self.key_path)
+
     def execute_commands(self):
         try:
             print_blue("\n--- Executing Openssl Command ---")
-            result = subprocess.run(self.pem_cmd)
+            result = run_process(self.pem_cmd, timeout=self.timeout)
             if result.returncode != 0:
                 print_red("PEM conversion failed.")
                 return
     
-            result = subprocess.run(self.x509_cmd)
+            result = run_process(self.x509_cmd, timeout=self.timeout)
             if result.returncode != 0:
                 print_red("x509 certificate extraction failed.")
                 return
     
-            result = subprocess.run(self.key_cmd)
+            result = run_process(self.key_cmd, timeout=self.timeout)
             if result.returncode != 0:
                 print_red("Private key extraction failed.")
                 return
     
             print_green("Openssl command executed successfully!")
-            self.store_name = os.path.join(self.output_path, f"{os.path.basename(self.x509_path).split('.x509')[0]}")
-            self.store_type = "PEM"
             
             if os.path.exists(self.x509_path) and os.path.exists(self.key_path):
                 print_green(f"Files exported to: {self.output_path}")
                 print_green(f"{'PEM file:'} {self.pem_path}")
                 print_green(f"{'x509 certificate:'} {self.x509_path}")
                 print_green(f"{'Private key (PKCS8 format):'} {self.key_path}")
-                self.handle_and_generate_command([self.pem_cmd, self.x509_cmd, self.key_cmd], "Openssl Commands")
+                for cmd, description in [
+                    (self.pem_cmd, "Openssl command to convert PKCS12 to PEM"),
+                    (self.x509_cmd, "Openssl command to extract x509 certificate"),
+                    (self.key_cmd, "Openssl command to extract private key"),
+                ]:
+                    log_command(self.output_path, description, cmd, event='export', keystore=self.p12_path)
     
                 self.generate_apksigner_command(self.x509_path, self.key_path)
             else:
@@ -75,40 +275,6 @@ class PKCS12ToPEM:
             print_red(f"Error occurred: {e}")
             exit()
             
-    def handle_and_generate_command(self, cmd_list, description):
-        print_blue(f"\n--- {description} ---")
-        if any(isinstance(i, list) for i in cmd_list):
-            cmd_list = [item for sublist in cmd_list for item in sublist]
-    
-        def format_cmd(cmd):
-            full_cmd = []
-            for c in cmd:
-                if ' ' in c:
-                    full_cmd.append(f'"{c}"')
-                else:
-                    full_cmd.append(c)
-            return " ".join(full_cmd)
-    
-        commands = []
-        
-        if "Openssl" in description:
-            commands.append("Openssl command to convert PKCS12 to PEM:")
-            commands.append(format_cmd(self.pem_cmd))
-            commands.append("\nOpenssl command to extract x509 certificate:")
-            commands.append(format_cmd(self.x509_cmd))
-            commands.append("\nOpenssl command to extract private key:")
-            commands.append(format_cmd(self.key_cmd))
-        else:
-            commands.append(f"{description}:")
-            commands.append(format_cmd(cmd_list))
-        
-        full_command_output = "\n".join(commands)
-        
-        cmd_file = os.path.abspath(os.path.join(self.output_path, f"{self.store_name}_{self.store_type}_commands.txt"))
-        with open(cmd_file, 'a') as f:
-            f.write(f"{full_command_output}\n\n")
-        print_green(f"{description} exported to {cmd_file}")
-    
     def generate_apksigner_command(self, cert, key):
         if not cert or not key:
             raise ValueError("Certificate and key file paths are required for APK signing.")
@@ -124,4 +290,4 @@ class PKCS12ToPEM:
             "--out", "signed.apk", "unsigned.apk"
         ]
 
-        self.handle_and_generate_command(cmd, "APK signer Command")
\ No newline at end of file
+        log_command(self.output_path, "APK signer Command", cmd, keystore=cert)
\ No newline at end of file
@@ -0,0 +1,501 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import hmac
+import base64
+import socket
+import hashlib
+import tempfile
+import threading
+import contextlib
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import urlsplit, parse_qs, quote, unquote, urlencode
+from .apk_scanner import APKScanner
+from .native_signer import NativeAPKSigner, create_output, load_signing_key, sign_digest, CONTENT_DIGESTS
+from .trace import traced, span
+
+try:
+    from cryptography import x509
+    from cryptography.hazmat.primitives import serialization
+except ImportError:
+    x509 = None
+
+DEFAULT_ADDRESS = '127.0.0.1:8470'
+DEFAULT_QUEUE = 32
+DEFAULT_MAX_APK_SIZE = 2 * 1024 * 1024 * 1024
+MAX_JSON_SIZE = 64 * 1024
+CHUNK_SIZE = 1024 * 1024
+RETRY_AFTER = 1
+
+class ServiceError(Exception):
+    def __init__(self, status, message, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+class ServiceKey:
+    def __init__(self, name, private_key, certificates):
+        self.name = name
+        self.private_key = private_key
+        self.certificates = certificates
+        # Same algorithm choice as local native signing, clients build their signed data for it
+        signer = NativeAPKSigner(private_key, certificates)
+        self.algorithm = signer.algorithm
+        self.hash_name = signer.hash_name
+
+    def to_dict(self):
+        leaf = self.certificates[0].public_bytes(serialization.Encoding.DER)
+        return {
+            'name': self.name,
+            'algorithm': self.algorithm,
+            'hash': self.hash_name,
+            'sha256': hashlib.sha256(leaf).hexdigest(),
+            'certificates': [base64.b64encode(cert.public_bytes(serialization.Encoding.DER)).decode('ascii') for cert in self.certificates],
+        }
+
+class SigningService:
+    # Keys are unlocked once at start. Requests beyond max_workers wait in a queue of max_queue,
+    # requests beyond that are refused with 503 and Retry-After instead of piling up
+    def __init__(self, key_specs, max_workers=None, max_queue=DEFAULT_QUEUE, max_apk_size=DEFAULT_MAX_APK_SIZE, token=None, digest_workers=1, work_dir=None):
+        if x509 is None:
+            raise ImportError("The signing service requires the 'cryptography' package (pip install keysigner[native]).")
+        if not key_specs:
+            raise ValueError("The signing service needs at least one key.")
+        self.lib_path = os.path.join(os.path.dirname(__file__), 'lib')
+        self.max_workers = max(1, max_workers or os.cpu_count() or 1)
+        self.max_queue = max(0, max_queue)
+        self.max_apk_size = max_apk_size
+        self.token = token
+        self.digest_workers = digest_workers
+        self.work_dir = work_dir
+        self.keys = {}
+        for name, key_spec in key_specs.items():
+            private_key, certificates = load_signing_key(key_spec, self.lib_path)
+            self.keys[name] = ServiceKey(name, private_key, certificates)
+        self.slots = threading.BoundedSemaphore(self.max_workers)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.active = 0
+        self.counts = {'digests': 0, 'apks': 0, 'rejected': 0, 'failed': 0}
+
+    def authorized(self, header):
+        if not self.token:
+            return True
+        return hmac.compare_digest((header or '').encode('utf-8'), f"Bearer {self.token}".encode('utf-8'))
+
+    def key(self, name):
+        if name not in self.keys:
+            raise ServiceError(404, f"Unknown key '{name}'.")
+        return self.keys[name]
+
+    @contextlib.contextmanager
+    def admit(self):
+        # Held from the first byte of the request to the last byte of the response, so it also bounds uploads on disk
+        with self.lock:
+            if self.pending >= self.max_workers + self.max_queue:
+                self.counts['rejected'] += 1
+                raise ServiceError(503, "Signing service is busy, retry later.", RETRY_AFTER)
+            self.pending += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    @contextlib.contextmanager
+    def worker(self):
+        with span('wait for worker', 'service'):
+            self.slots.acquire()
+        with self.lock:
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active -= 1
+            self.slots.release()
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    @traced('sign digest', 'crypto')
+    def sign_digest(self, name, algorithm, digest):
+        key = self.key(name)
+        if algorithm != key.algorithm:
+            raise ServiceError(400, f"Key '{name}' signs with algorithm {key.algorithm:#06x}, not {algorithm:#06x}.")
+        return sign_digest(key.private_key, key.hash_name, digest)
+
+    @traced('sign apk', 'apk')
+    def sign_apk(self, name, apk_file, signed_apk, schemes):
+        key = self.key(name)
+        min_sdk = None
+        if schemes['v1']:
+            # The v1 digest algorithm depends on the minSdkVersion, as for local native signing
+            try:
+                min_sdk = APKScanner().scan(apk_file)['min_sdk']
+            except Exception:
+                pass
+        signer = NativeAPKSigner(
+            key.private_key, key.certificates, v2_enabled=schemes['v2'], v3_enabled=schemes['v3'],
+            digest_workers=self.digest_workers, v1_enabled=schemes['v1'], min_sdk=min_sdk
+        )
+        return signer.sign(apk_file, signed_apk)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'workers': self.max_workers,
+                'queue': self.max_queue,
+                'active': self.active,
+                'queued': self.pending - self.active,
+                'keys': sorted(self.keys),
+                **self.counts,
+            }
+
+    def close(self):
+        # Dropping the last references frees the OpenSSL key objects, see KeyCacheEntry.clear
+        for key in self.keys.values():
+            key.private_key = None
+        self.keys = {}
+
+class SigningRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'keysigner'
+    # Idle keep-alive connections and stalled uploads release their thread
+    timeout = 60
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def address_string(self):
+        # Unix socket peers have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def dispatch(self, method):
+        service = self.server.service
+        url = urlsplit(self.path)
+        parts = [unquote(part) for part in url.path.split('/') if part]
+        try:
+            if not service.authorized(self.headers.get('Authorization')):
+                raise ServiceError(401, "Missing or invalid token.")
+            if method == 'GET' and parts == ['status']:
+                return self.send_json(200, service.stats())
+            if method == 'GET' and parts == ['keys']:
+                return self.send_json(200, {'keys': [key.to_dict() for key in service.keys.values()]})
+            if method == 'POST' and len(parts) == 3 and parts[0] == 'keys' and parts[2] == 'sign-digest':
+                return self.sign_digest(service, parts[1])
+            if method == 'POST' and len(parts) == 3 and parts[0] == 'keys' and parts[2] == 'sign-apk':
+                return self.sign_apk(service, parts[1], parse_qs(url.query))
+            raise ServiceError(404, f"Unknown endpoint: {method} {url.path}")
+        except ServiceError as e:
+            self.send_error_json(e.status, str(e), e.retry_after)
+        except (ValueError, NotImplementedError) as e:
+            service.count('failed')
+            self.send_error_json(400, str(e))
+        except (ConnectionError, socket.timeout):
+            self.close_connection = True
+        except Exception as e:
+            service.count('failed')
+            self.send_error_json(500, str(e))
+
+    def content_length(self, limit):
+        value = self.headers.get('Content-Length')
+        if value is None or not value.isdigit():
+            raise ServiceError(411, "Content-Length is required.")
+        if int(value) > limit:
+            raise ServiceError(413, f"Request body of {value} bytes exceeds the limit of {limit} bytes.")
+        return int(value)
+
+    def sign_digest(self, service, name):
+        length = self.content_length(MAX_JSON_SIZE)
+        with service.admit():
+            try:
+                request = json.loads(self.rfile.read(length))
+                algorithm = int(request['algorithm'])
+                digest = base64.b64decode(request['digest'], validate=True)
+            except (ValueError, KeyError, TypeError) as e:
+                raise ServiceError(400, f"Invalid digest request: {e}")
+            with service.worker():
+                signature = service.sign_digest(name, algorithm, digest)
+            service.count('digests')
+        self.send_json(200, {'algorithm': algorithm, 'signature': base64.b64encode(signature).decode('ascii')})
+
+    def sign_apk(self, service, name, query):
+        service.key(name)
+        schemes = {}
+        for scheme, default in [('v1', True), ('v2', True), ('v3', True)]:
+            value = query.get(scheme, [str(default)])[-1].lower()
+            if value not in ['true', 'false']:
+                raise ServiceError(400, f"Expected {scheme}=true or {scheme}=false, got '{value}'.")
+            schemes[scheme] = value == 'true'
+        length = self.content_length(service.max_apk_size)
+        with service.admit():
+            with tempfile.TemporaryDirectory(prefix='keysigner-serve-', dir=service.work_dir) as temp_dir:
+                apk_file = os.path.join(temp_dir, 'input.apk')
+                signed_apk = os.path.join(temp_dir, 'signed.apk')
+                self.receive_file(apk_file, length)
+                with service.worker():
+                    service.sign_apk(name, apk_file, signed_apk, schemes)
+                service.count('apks')
+                self.send_file(signed_apk)
+
+    @traced('receive apk', 'io')
+    def receive_file(self, path, length):
+        with open(path, 'wb') as f:
+            remaining = length
+            while remaining:
+                chunk = self.rfile.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise ConnectionError("Client closed the connection during the upload.")
+                f.write(chunk)
+                remaining -= len(chunk)
+
+    @traced('send apk', 'io')
+    def send_file(self, path):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/vnd.android.package-archive')
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.end_headers()
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, message, retry_after=None):
+        # The request body may be unread, the connection cannot be reused
+        self.close_connection = True
+        body = json.dumps({'error': message}).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Connection', 'close')
+        if retry_after is not None:
+            self.send_header('Retry-After', str(retry_after))
+        self.end_headers()
+        self.wfile.write(body)
+
+class TCPSigningServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+class UnixSigningServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        # Only the owner of the service can connect to the socket
+        umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+
+def parse_address(address):
+    # unix:/path/to/socket (or a path) for a Unix socket, host:port or http://host:port for TCP
+    address = address or DEFAULT_ADDRESS
+    if address.startswith('unix:'):
+        return 'unix', address[len('unix:'):]
+    if address.startswith('/') or address.startswith('.'):
+        return 'unix', address
+    url = urlsplit(address if '://' in address else f"http://{address}")
+    if url.scheme != 'http' or not url.port:
+        raise ValueError(f"Invalid address '{address}'. Expected unix:<path> or <host>:<port>.")
+    return 'tcp', (url.hostname, url.port)
+
+def create_server(service, address, verbose=False):
+    kind, location = parse_address(address)
+    if kind == 'unix':
+        if os.path.exists(location):
+            # A stale socket of a previous run, anything else is left alone
+            with contextlib.closing(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)) as probe:
+                if probe.connect_ex(location) == 0:
+                    raise ValueError(f"Another service is already listening on {location}.")
+            os.remove(location)
+        server = UnixSigningServer(location, SigningRequestHandler)
+    else:
+        # Every local user and process can reach a TCP port, loopback included, and sign-digest signs any digest
+        if not service.token:
+            raise ValueError(f"Listening on {address} requires a token (--token), or listen on a unix:<path> socket, which only its owner can use.")
+        server = TCPSigningServer(location, SigningRequestHandler)
+    server.service = service
+    server.verbose = verbose
+    return server
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+class SigningClient:
+    # One keep-alive connection per thread; 503 responses are retried after Retry-After up to retries times
+    def __init__(self, address, token=None, timeout=300, retries=10):
+        self.kind, self.location = parse_address(address)
+        self.token = token
+        self.timeout = timeout
+        self.retries = retries
+        self.local = threading.local()
+        self.key_info = {}
+        self.lock = threading.Lock()
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            if self.kind == 'unix':
+                connection = UnixHTTPConnection(self.location, self.timeout)
+            else:
+                connection = http.client.HTTPConnection(*self.location, timeout=self.timeout)
+            self.local.connection = connection
+        return connection
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+    def request(self, method, path, body=None, headers=None, output=None):
+        headers = dict(headers or {})
+        if self.token:
+            headers['Authorization'] = f"Bearer {self.token}"
+        attempt = reconnects = 0
+        while True:
+            if hasattr(body, 'seek'):
+                body.seek(0)
+            connection = self.connection()
+            try:
+                try:
+                    connection.request(method, path, body=body, headers=headers)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The service refuses an upload (503, 413) without reading it, its response is still readable
+                    pass
+                response = connection.getresponse()
+            except (http.client.HTTPException, ConnectionError):
+                # Also raised when the service closed an idle keep-alive connection
+                self.close()
+                if reconnects >= 1:
+                    raise
+                reconnects += 1
+                continue
+
+            if response.status == 503 and attempt < self.retries:
+                response.read()
+                self.close()
+                attempt += 1
+                time.sleep(float(response.getheader('Retry-After') or RETRY_AFTER))
+                continue
+            if response.status != 200:
+                data = response.read()
+                self.close()
+                try:
+                    message = json.loads(data)['error']
+                except (ValueError, KeyError, TypeError):
+                    message = data.decode('utf-8', 'replace').strip() or response.reason
+                raise RuntimeError(f"Signing service: {message} (HTTP {response.status})")
+            if output is None:
+                return json.loads(response.read())
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                output.write(chunk)
+            return None
+
+    def status(self):
+        return self.request('GET', '/status')
+
+    def keys(self):
+        keys = {key['name']: key for key in self.request('GET', '/keys')['keys']}
+        with self.lock:
+            self.key_info = keys
+        return keys
+
+    def key(self, name):
+        with self.lock:
+            key = self.key_info.get(name)
+        if key is None:
+            key = self.keys().get(name)
+            if key is None:
+                raise ValueError(f"The signing service has no key '{name}'.")
+        return key
+
+    @traced('remote sign digest', 'service')
+    def sign_digest(self, name, algorithm, digest):
+        body = json.dumps({'algorithm': algorithm, 'digest': base64.b64encode(digest).decode('ascii')})
+        response = self.request('POST', f"/keys/{quote(name, safe='')}/sign-digest", body, {'Content-Type': 'application/json'})
+        return base64.b64decode(response['signature'])
+
+    @traced('remote sign apk', 'service')
+    def sign_apk(self, name, apk_file, signed_apk, schemes):
+        # The APK is streamed to the service and the signed APK streamed back, neither is held in memory
+        query = urlencode({scheme: str(schemes[scheme]).lower() for scheme in ['v1', 'v2', 'v3']})
+        output_dir = os.path.dirname(os.path.abspath(signed_apk))
+        fd, temp_path = create_output(output_dir)
+        try:
+            with open(apk_file, 'rb') as body, os.fdopen(fd, 'wb') as out:
+                headers = {'Content-Type': 'application/vnd.android.package-archive', 'Content-Length': str(os.fstat(body.fileno()).st_size)}
+                self.request('POST', f"/keys/{quote(name, safe='')}/sign-apk?{query}", body, headers, output=out)
+            os.replace(temp_path, signed_apk)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return signed_apk
+
+    def sign(self, name, apk_file, signed_apk, schemes, mode='auto', digest_workers=1, digest_cache=None):
+        # digest: only the digest of each signed data leaves this machine; apk: the service signs the whole APK.
+        # v1 signatures need the key for the JAR signature, auto streams those APKs and sends digests otherwise
+        if schemes.get('v4'):
+            raise ValueError("v4 signing is not supported by the signing service.")
+        if mode == 'auto':
+            mode = 'apk' if schemes.get('v1') else 'digest'
+        if mode == 'apk':
+            self.sign_apk(name, apk_file, signed_apk, schemes)
+        elif schemes.get('v1'):
+            raise ValueError("Digest-only signing covers v2/v3, disable v1 or sign the whole APK.")
+        else:
+            signer = RemoteAPKSigner(self, self.key(name), schemes.get('v2', True), schemes.get('v3', True), digest_workers, digest_cache)
+            signer.sign(apk_file, signed_apk)
+        return mode
+
+class RemoteAPKSigner(NativeAPKSigner):
+    # Content digests and the signed data are computed locally, only the SHA-256/512 of each signed data is sent
+    def __init__(self, client, key, v2_enabled=True, v3_enabled=True, digest_workers=1, digest_cache=None):
+        if x509 is None:
+            raise ImportError("Digest-only signing requires the 'cryptography' package (pip install keysigner[native]).")
+        self.client = client
+        self.key = key
+        certificates = [x509.load_der_x509_certificate(base64.b64decode(cert)) for cert in key['certificates']]
+        super().__init__(None, certificates, v2_enabled=v2_enabled, v3_enabled=v3_enabled, digest_workers=digest_workers, digest_cache=digest_cache)
+
+    def signature_algorithm(self):
+        if self.key['algorithm'] not in CONTENT_DIGESTS:
+            raise NotImplementedError(f"Unsupported signature algorithm {self.key['algorithm']:#06x}.")
+        return self.key['algorithm']
+
+    def sign_data(self, data):
+        return self.client.sign_digest(self.key['name'], self.algorithm, hashlib.new(self.hash_name, data).digest())
@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import select
+import shutil
+import struct
+import datetime
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from .checkpoint import Checkpoint, DEFAULT_BACKOFF
+from .utils import *
+
+try:
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    libc.inotify_init1
+    libc.inotify_add_watch
+except (ImportError, OSError, AttributeError):
+    # Not Linux, the spool directory is polled
+    libc = None
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+EVENT_HEADER = struct.Struct('iIII')
+
+DEFAULT_BATCH_WINDOW = 2.0
+DEFAULT_BATCH_SIZE = 32
+DEFAULT_POLL_INTERVAL = 2.0
+DEFAULT_SETTLE = 5.0
+METRICS_NAME = 'keysigner_watch_metrics.json'
+METRICS_INTERVAL = 5.0
+THROUGHPUT_WINDOW = 60.0
+# Longest wait of the main loop, so that a stop request is noticed quickly
+TICK = 0.5
+
+def spool_candidate(name):
+    # Uploads written under a hidden or temporary name and renamed once complete are picked up after the rename
+    return name.lower().endswith('.apk') and not name.startswith('.')
+
+def inotify_available():
+    return libc is not None
+
+class PollingMonitor:
+    # Lists the directory every interval. An APK is complete once its size and mtime have not changed for settle
+    # seconds, which also works on network filesystems where writes of other hosts raise no inotify events.
+    mode = 'poll'
+
+    def __init__(self, path, interval=DEFAULT_POLL_INTERVAL, settle=DEFAULT_SETTLE):
+        self.path = path
+        self.interval = interval
+        self.settle = settle
+        self.settling = {}
+        self.next_scan = 0
+
+    def scan(self):
+        ready = []
+        now = time.monotonic()
+        settling = {}
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if not spool_candidate(entry.name):
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                state = (stat.st_size, stat.st_mtime_ns)
+                previous = self.settling.get(entry.path)
+                since = previous[1] if previous is not None and previous[0] == state else now
+                if now - since >= self.settle or time.time() - stat.st_mtime >= self.settle:
+                    ready.append(entry.path)
+                else:
+                    settling[entry.path] = (state, since)
+        self.settling = settling
+        self.next_scan = now + self.interval
+        return sorted(ready)
+
+    def wait(self, timeout):
+        # Complete APKs found within timeout, the same APK is reported again by each scan until it is moved away
+        delay = self.next_scan - time.monotonic()
+        if delay > 0:
+            time.sleep(min(timeout, delay))
+            if time.monotonic() < self.next_scan:
+                return []
+        return self.scan()
+
+    def close(self):
+        pass
+
+class InotifyMonitor(PollingMonitor):
+    # APKs are complete when the writer closes them or when they are renamed into the directory.
+    # The directory is listed at start and after an event queue overflow, and polled only while the
+    # APKs found by a listing settle.
+    mode = 'inotify'
+
+    def __init__(self, path, interval=DEFAULT_POLL_INTERVAL, settle=DEFAULT_SETTLE):
+        super().__init__(path, interval, settle)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, os.strerror(error), path)
+        self.rescan = True
+
+    def read_events(self):
+        ready = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return ready
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+                offset += EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    self.rescan = True
+                elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    raise OSError(f"The spool directory {self.path} was removed or moved.")
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and spool_candidate(os.fsdecode(name)):
+                    path = os.path.join(self.path, os.fsdecode(name))
+                    self.settling.pop(path, None)
+                    ready.append(path)
+
+    def wait(self, timeout):
+        if self.rescan:
+            self.rescan = False
+            # Events raised during the listing are read afterwards, an APK may be reported twice
+            return self.scan()
+        if self.settling:
+            timeout = max(0, min(timeout, self.next_scan - time.monotonic()))
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        ready = self.read_events() if readable else []
+        if self.settling and time.monotonic() >= self.next_scan:
+            ready.extend(self.scan())
+        return ready
+
+    def close(self):
+        os.close(self.fd)
+
+class SpoolWatcher:
+    # Complete APKs of the spool directory are queued and coalesced into micro-batches: a batch is signed as soon
+    # as batch_size APKs are queued, or batch_window seconds after the first of them arrived. One batch is signed
+    # at a time, by up to workers threads, so that APKs arriving meanwhile make the next batch larger.
+    # Signed APKs go to output_path and their inputs are deleted (or moved to processed_path), failed inputs are
+    # moved to failed_path with a <name>.error.json next to them.
+    def __init__(self, signer, key_spec, spool_path, output_path=None, failed_path=None, processed_path=None, workers=None,
+                 batch_window=DEFAULT_BATCH_WINDOW, batch_size=DEFAULT_BATCH_SIZE, retries=0, backoff=DEFAULT_BACKOFF,
+                 poll=False, poll_interval=DEFAULT_POLL_INTERVAL, settle=DEFAULT_SETTLE, metrics_path=None, once=False):
+        if not os.path.isdir(spool_path):
+            raise ValueError(f"Spool directory not found: {spool_path}")
+        self.signer = signer
+        self.key_spec = key_spec
+        self.spool_path = os.path.abspath(spool_path)
+        self.output_path = os.path.abspath(ensure_directory(output_path, caller='signer'))
+        self.failed_path = os.path.abspath(ensure_directory(failed_path, dir_name='failed_apks'))
+        self.processed_path = os.path.abspath(ensure_directory(processed_path)) if processed_path else None
+        if self.spool_path in [self.output_path, self.failed_path, self.processed_path]:
+            raise ValueError("The output, failed and processed directories must differ from the spool directory.")
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.batch_window = batch_window
+        self.batch_size = max(1, batch_size)
+        self.retries = retries
+        self.backoff = backoff
+        self.metrics_path = os.path.abspath(metrics_path) if metrics_path else os.path.join(self.output_path, METRICS_NAME)
+        self.once = once
+        if poll or not inotify_available():
+            self.monitor = PollingMonitor(self.spool_path, poll_interval, settle)
+        else:
+            self.monitor = InotifyMonitor(self.spool_path, poll_interval, settle)
+        self.queue = deque()
+        # APKs queued or being signed, and the size and mtime of APKs taken or left in the spool after an error
+        self.pending = set()
+        self.known = {}
+        self.batch = None
+        self.batch_deadline = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.stop = threading.Event()
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.completed = deque()
+        self.counts = {'signed': 0, 'failed': 0, 'batches': 0, 'bytes': 0}
+        self.in_flight = 0
+        self.last_batch = None
+        self.metrics_due = 0
+
+    def preload(self):
+        # The native engine unlocks the key once here, a wrong password stops the daemon before any APK is taken
+        signer = self.signer
+        if signer.engine == 'native' and signer.key_cache is not None and signer.native_unsupported_reason(self.key_spec) is None:
+            signer.key_cache.get(self.key_spec, signer.lib_path)
+
+    def add(self, paths):
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            state = (stat.st_size, stat.st_mtime_ns)
+            with self.lock:
+                if path in self.pending or self.known.get(path) == state:
+                    continue
+                self.known[path] = state
+                self.pending.add(path)
+                self.queue.append(path)
+                if self.batch_deadline is None:
+                    self.batch_deadline = time.monotonic() + self.batch_window
+
+    def batch_ready(self):
+        if self.batch is not None and not self.batch.done():
+            return False
+        if not self.queue:
+            return False
+        # With once, everything is already in the spool directory and there is nothing to wait for
+        return self.once or len(self.queue) >= self.batch_size or time.monotonic() >= self.batch_deadline
+
+    def next_batch(self):
+        with self.lock:
+            batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+            self.batch_deadline = time.monotonic() + self.batch_window if self.queue else None
+            self.in_flight = len(batch)
+        return batch
+
+    def run(self):
+        self.preload()
+        print_green(f"Watching {self.spool_path} ({self.monitor.mode}), signed APKs go to {self.output_path}, failed ones to {self.failed_path}")
+        print_blue(f"Metrics: {self.metrics_path}")
+        try:
+            while not self.stop.is_set():
+                timeout = TICK
+                if self.batch_deadline is not None:
+                    timeout = max(0, min(timeout, self.batch_deadline - time.monotonic()))
+                self.add(self.monitor.wait(timeout))
+                if self.batch is not None and self.batch.done():
+                    # Raises what sign_batch could not handle
+                    self.batch.result()
+                    self.batch = None
+                if self.batch_ready():
+                    self.batch = self.executor.submit(self.sign_batch, self.next_batch())
+                if time.monotonic() >= self.metrics_due:
+                    self.write_metrics()
+                if self.once and self.batch is None and not self.queue and not self.monitor.settling:
+                    break
+        finally:
+            # APKs still queued stay in the spool directory for the next run
+            self.executor.shutdown(wait=True)
+            self.batch = None
+            self.write_metrics()
+            self.monitor.close()
+        return self.counts
+
+    def sign_batch(self, batch):
+        start = time.monotonic()
+        print_blue(f"\n--- Signing {len(batch)} APK(s) ---")
+        checkpoint = Checkpoint('watch', retries=self.retries, backoff=self.backoff, enabled=False)
+        try:
+            results = self.signer.sign_many(batch, self.key_spec, workers=self.workers, output_path=self.output_path, checkpoint=checkpoint)
+        except Exception as e:
+            results = [{'apk': apk, 'signed_apk': None, 'success': False, 'error': str(e)} for apk in batch]
+        signed = 0
+        size = 0
+        for result in results:
+            try:
+                size += os.path.getsize(result['apk'])
+            except OSError:
+                pass
+            if result['success']:
+                signed += 1
+                print_green(f"Signed: {result['signed_apk']}")
+            else:
+                print_red(f"Failed: {result['apk']}: {result['error']}")
+            self.take(result)
+        seconds = time.monotonic() - start
+        with self.lock:
+            now = time.monotonic()
+            self.completed.extend([now] * len(results))
+            self.counts['signed'] += signed
+            self.counts['failed'] += len(results) - signed
+            self.counts['batches'] += 1
+            self.counts['bytes'] += size
+            self.in_flight = 0
+            self.last_batch = {'size': len(results), 'seconds': round(seconds, 3)}
+        print_blue(f"{signed} signed, {len(results) - signed} failed in {seconds:.2f}s, {len(self.queue)} queued.")
+        self.write_metrics()
+
+    def take(self, result):
+        # Removes the input from the spool, an input that cannot be moved stays known and is not signed again until it changes
+        apk = result['apk']
+        with self.lock:
+            self.pending.discard(apk)
+        try:
+            if result['success']:
+                if self.processed_path:
+                    shutil.move(apk, os.path.join(self.processed_path, os.path.basename(apk)))
+                else:
+                    os.remove(apk)
+            else:
+                name = os.path.basename(apk)
+                shutil.move(apk, os.path.join(self.failed_path, name))
+                error = {
+                    'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='milliseconds'),
+                    'apk': name,
+                    'error': result['error'],
+                    'attempts': result.get('attempts', 1),
+                }
+                with open(os.path.join(self.failed_path, f"{os.path.splitext(name)[0]}.error.json"), 'w', encoding='utf-8') as f:
+                    json.dump(error, f, indent=2)
+        except OSError as e:
+            print_yellow(f"Could not move {apk} out of the spool directory: {e}")
+            return
+        with self.lock:
+            self.known.pop(apk, None)
+
+    def metrics(self):
+        with self.lock:
+            now = time.monotonic()
+            while self.completed and now - self.completed[0] > THROUGHPUT_WINDOW:
+                self.completed.popleft()
+            uptime = now - self.started
+            done = self.counts['signed'] + self.counts['failed']
+            return {
+                'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+                'spool': self.spool_path,
+                'mode': self.monitor.mode,
+                'workers': self.workers,
+                'uptime': round(uptime, 1),
+                'queue_depth': len(self.queue),
+                'settling': len(self.monitor.settling),
+                'in_flight': self.in_flight,
+                **self.counts,
+                'throughput': round(len(self.completed) / min(uptime, THROUGHPUT_WINDOW), 3) if uptime > 0 else 0.0,
+                'average_batch_size': round(done / self.counts['batches'], 2) if self.counts['batches'] else 0.0,
+                'last_batch': self.last_batch,
+            }
+
+    def write_metrics(self):
+        # JSON, or the Prometheus text format for a .prom path (node_exporter textfile collector)
+        metrics = self.metrics()
+        if self.metrics_path.endswith('.prom'):
+            lines = []
+            for name, help_text, kind in [
+                ('queue_depth', "APKs waiting for a batch", 'gauge'),
+                ('settling', "APKs still being written", 'gauge'),
+                ('in_flight', "APKs of the batch being signed", 'gauge'),
+                ('signed', "APKs signed", 'counter'),
+                ('failed', "APKs that failed", 'counter'),
+                ('batches', "Batches signed", 'counter'),
+                ('bytes', "Bytes of APKs signed or failed", 'counter'),
+                ('throughput', f"APKs per second over the last {int(THROUGHPUT_WINDOW)} seconds", 'gauge'),
+            ]:
+                metric = f"keysigner_watch_{name}{'_total' if kind == 'counter' else ''}"
+                lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} {kind}", f"{metric} {metrics[name]}"]
+            data = '\n'.join(lines) + '\n'
+        else:
+            data = json.dumps(metrics, indent=2) + '\n'
+        directory = os.path.dirname(self.metrics_path)
+        os.makedirs(directory, exist_ok=True)
+        # Readers never see a partial file
+        fd, temp_path = tempfile.mkstemp(prefix='.metrics-', dir=directory)
+        try:
+            # mkstemp creates 0600 files, collectors such as node_exporter read the metrics as another user
+            os.fchmod(fd, 0o644)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(temp_path, self.metrics_path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self.metrics_due = time.monotonic() + METRICS_INTERVAL
+
+    def close(self):
+        self.stop.set()
+        if self.signer.key_cache is not None:
+            self.signer.key_cache.clear()
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import asyncio
+import threading
+import subprocess
+from .trace import span, current_tracer
+
+def default_max_processes():
+    value = os.environ.get('KEYSIGNER_TOOL_PROCESSES', '')
+    return max(1, int(value)) if value else (os.cpu_count() or 1)
+
+def default_timeout():
+    value = os.environ.get('KEYSIGNER_TOOL_TIMEOUT', '')
+    return float(value) if value else None
+
+class ToolResult:
+    # Same fields as subprocess.CompletedProcess, so callers check returncode, stdout and stderr either way
+    def __init__(self, args, returncode, stdout=None, stderr=None, duration=0.0, timed_out=False):
+        self.args = args
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.duration = duration
+        self.timed_out = timed_out
+
+    def check_returncode(self):
+        if self.returncode != 0:
+            raise subprocess.CalledProcessError(self.returncode, self.args, self.stdout, self.stderr)
+
+    def to_dict(self):
+        # The arguments carry passwords, only the tool name is reported
+        return {
+            'tool': os.path.basename(self.args[0]) if self.args else None,
+            'returncode': self.returncode,
+            'duration': round(self.duration, 3),
+            'timed_out': self.timed_out,
+            'stdout': self.stdout,
+            'stderr': self.stderr,
+        }
+
+class ToolRunner:
+    # Every child process is started and awaited on one event loop thread. Callers, synchronous or running on
+    # their own event loop, only wait for the result, and the semaphore bounds the processes of all of them.
+    def __init__(self, max_processes=None, timeout=None):
+        self.max_processes = max_processes or default_max_processes()
+        self.timeout = timeout if timeout is not None else default_timeout()
+        self.loop = None
+        self.thread = None
+        self.semaphore = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self.loop.run_forever, name='keysigner-tools', daemon=True)
+                self.thread.start()
+        return self.loop
+
+    async def execute(self, cmd, capture_output=False, text=True, stdin=None, input=None, timeout=None, cwd=None, env=None):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_processes)
+        pipe = subprocess.PIPE if capture_output else None
+        async with self.semaphore:
+            start = time.perf_counter()
+            process = await asyncio.create_subprocess_exec(
+                *cmd, stdin=subprocess.PIPE if input is not None else stdin, stdout=pipe, stderr=pipe, cwd=cwd, env=env
+            )
+            tracer = current_tracer()
+            if tracer is not None:
+                # Spawn to exit of the child, processes overlap on this thread so they are async events
+                event_id = tracer.begin_async(os.path.basename(cmd[0]), 'process', {'pid': process.pid})
+            timed_out = False
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(input), timeout)
+            except asyncio.TimeoutError:
+                timed_out = True
+                process.kill()
+                stdout, stderr = await process.communicate()
+            except asyncio.CancelledError:
+                process.kill()
+                await process.wait()
+                raise
+            duration = time.perf_counter() - start
+            if tracer is not None:
+                tracer.end_async(event_id, os.path.basename(cmd[0]), 'process', {'returncode': process.returncode, 'timed_out': timed_out})
+
+        if text and capture_output:
+            stdout = stdout.decode('utf-8', 'replace')
+            stderr = stderr.decode('utf-8', 'replace')
+        if timed_out:
+            message = f"{os.path.basename(cmd[0])} was killed after {timeout:g} seconds."
+            if capture_output:
+                stderr += message if text else message.encode('utf-8')
+            else:
+                sys.stderr.write(message + '\n')
+        return ToolResult(list(cmd), process.returncode, stdout, stderr, duration, timed_out)
+
+    def submit(self, cmd, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return asyncio.run_coroutine_threadsafe(self.execute(cmd, **kwargs), self.start())
+
+    def run(self, cmd, **kwargs):
+        with span(f"run {os.path.basename(cmd[0])}", 'process') as current:
+            result = self.submit(cmd, **kwargs).result()
+            current.set(returncode=result.returncode)
+            return result
+
+    async def run_async(self, cmd, **kwargs):
+        # Cancelling the caller's task cancels the process task, which kills the child
+        return await asyncio.wrap_future(self.submit(cmd, **kwargs))
+
+    def resize(self, max_processes):
+        # The next process takes a new semaphore, processes holding the previous one finish without waiting
+        self.max_processes = max(1, max_processes)
+        self.semaphore = None
+
+    def close(self):
+        with self.lock:
+            if self.loop is not None:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self.thread.join()
+                self.loop.close()
+            self.loop = self.thread = self.semaphore = None
+
+_runner = None
+_runner_lock = threading.Lock()
+
+def tool_runner():
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            _runner = ToolRunner()
+        return _runner
+
+def configure_tool_runner(max_processes=None, timeout=None):
+    runner = tool_runner()
+    if max_processes is not None:
+        runner.resize(max_processes)
+    if timeout is not None:
+        # Default for the calls that do not pass their own timeout
+        runner.timeout = timeout
+    return runner
+
+def run_process(cmd, capture_output=False, text=True, stdin=None, input=None, timeout=None, cwd=None, env=None):
+    return tool_runner().run(cmd, capture_output=capture_output, text=text, stdin=stdin, input=input, timeout=timeout, cwd=cwd, env=env)
+
+async def run_process_async(cmd, capture_output=True, text=True, stdin=None, input=None, timeout=None, cwd=None, env=None):
+    return await tool_runner().run_async(cmd, capture_output=capture_output, text=text, stdin=stdin, input=input, timeout=timeout, cwd=cwd, env=env)
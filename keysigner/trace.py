@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import itertools
+import functools
+import threading
+
+class NullSpan:
+    # Returned by span() while tracing is off, entering it costs a method call and nothing else
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **args):
+        pass
+
+NULL_SPAN = NullSpan()
+
+class Span:
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.args['error'] = f"{exc_type.__name__}: {exc}"
+        self.tracer.complete(self.name, self.category, self.start, time.perf_counter(), self.args)
+        return False
+
+    def set(self, **args):
+        self.args.update(args)
+
+class Tracer:
+    # Collects Chrome trace events (chrome://tracing, Perfetto): timestamps and durations in microseconds
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+        self.events = []
+        self.threads = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def timestamp(self, value):
+        return round((value - self.origin) * 1000000, 1)
+
+    def record(self, event, args):
+        thread = threading.current_thread()
+        event.update({'pid': self.pid, 'tid': thread.ident})
+        if args:
+            event['args'] = args
+        with self.lock:
+            self.threads.setdefault(thread.ident, thread.name)
+            self.events.append(event)
+
+    def complete(self, name, category, start, end, args):
+        self.record({'name': name, 'cat': category, 'ph': 'X', 'ts': self.timestamp(start), 'dur': round((end - start) * 1000000, 1)}, args)
+
+    def begin_async(self, name, category, args=None):
+        # Async events may overlap on one thread, the tool runner's child processes are recorded this way
+        event_id = next(self.ids)
+        self.record({'name': name, 'cat': category, 'ph': 'b', 'id': event_id, 'ts': self.timestamp(time.perf_counter())}, args)
+        return event_id
+
+    def end_async(self, event_id, name, category, args=None):
+        self.record({'name': name, 'cat': category, 'ph': 'e', 'id': event_id, 'ts': self.timestamp(time.perf_counter())}, args)
+
+    def to_dict(self):
+        with self.lock:
+            metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': ident, 'args': {'name': name}} for ident, name in self.threads.items()]
+            metadata.append({'name': 'process_name', 'ph': 'M', 'pid': self.pid, 'tid': 0, 'args': {'name': 'keysigner'}})
+            return {'traceEvents': metadata + list(self.events), 'displayTimeUnit': 'ms'}
+
+    def write(self, path):
+        data = self.to_dict()
+        with open(path, 'w') as f:
+            json.dump(data, f)
+        return len(data['traceEvents'])
+
+_tracer = None
+
+def enable_tracing():
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+def disable_tracing():
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+def current_tracer():
+    return _tracer
+
+def span(name, category='keysigner', **args):
+    if _tracer is None:
+        return NULL_SPAN
+    return Span(_tracer, name, category, args)
+
+def traced(name, category='keysigner'):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return func(*args, **kwargs)
+            with Span(_tracer, name, category, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class Profiler:
+    # cProfile for where the time goes and tracemalloc for where the memory was allocated
+    def __init__(self, limit=20):
+        self.limit = limit
+        self.profile = None
+
+    def __enter__(self):
+        import cProfile
+        import tracemalloc
+        tracemalloc.start(10)
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        import pstats
+        import tracemalloc
+        self.profile.disable()
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        out = sys.stderr
+        out.write(f"\n--- Profile: top {self.limit} functions by cumulative time ---\n")
+        pstats.Stats(self.profile, stream=out).sort_stats('cumulative').print_stats(self.limit)
+        out.write(f"--- Memory: peak {peak / 1048576:.1f} MiB traced, top {self.limit} allocators ---\n")
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        for stat in snapshot.statistics('lineno')[:self.limit]:
+            frame = stat.traceback[0]
+            out.write(f"{stat.size / 1024:10.1f} KiB {stat.count:8d} blocks  {frame.filename}:{frame.lineno}\n")
+        out.flush()
+        return False
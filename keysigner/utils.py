@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import os
+import json
 from getpass import getpass
 
 def color_text(text, color_code):
@@ -130,4 +131,28 @@ def validate_input(prompt, required=True, password=False, path=False, pass_opt=N
                     print_red("Path is not accessible. Please check permissions.")
                     continue
                 
-        return user_input
\ No newline at end of file
+        return user_input
+
+def write_json(path, data):
+    # Reports are read by other tools: replace the file in one rename instead of truncating it first
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.write('\n')
+    os.replace(temp_path, path)
+
+def read_secret(value, prompt):
+    # Same password syntax as apksigner: pass:<password>, env:<name> or file:<path>
+    if value is None:
+        return getpass(cyan_text(prompt))
+    if value.startswith('pass:'):
+        return value[len('pass:'):]
+    if value.startswith('env:'):
+        name = value[len('env:'):]
+        if name not in os.environ:
+            raise ValueError(f"Environment variable '{name}' is not set.")
+        return os.environ[name]
+    if value.startswith('file:'):
+        with open(value[len('file:'):], 'r') as f:
+            return f.readline().rstrip('\r\n')
+    return value